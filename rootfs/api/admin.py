@@ -13,6 +13,8 @@ from .models import Build
 from .models import Config
 from .models import Domain
 from .models import Key
+from .models import Operation
+from .models import PrunedRelease
 from .models import Release
 
 
@@ -66,6 +68,16 @@ class KeyAdmin(admin.ModelAdmin):
 admin.site.register(Key, KeyAdmin)
 
 
+class OperationAdmin(admin.ModelAdmin):
+    """Set presentation options for :class:`~api.models.Operation` models
+    in the Django admin.
+    """
+    date_hierarchy = 'created'
+    list_display = ('created', 'type', 'state', 'owner', 'app')
+    list_filter = ('type', 'state', 'app')
+admin.site.register(Operation, OperationAdmin)
+
+
 class ReleaseAdmin(admin.ModelAdmin):
     """Set presentation options for :class:`~api.models.Release` models
     in the Django admin.
@@ -75,3 +87,14 @@ class ReleaseAdmin(admin.ModelAdmin):
     list_display_links = ('created', 'version')
     list_filter = ('owner', 'app')
 admin.site.register(Release, ReleaseAdmin)
+
+
+class PrunedReleaseAdmin(admin.ModelAdmin):
+    """Set presentation options for :class:`~api.models.PrunedRelease` models
+    in the Django admin.
+    """
+    date_hierarchy = 'released'
+    list_display = ('released', 'version', 'owner', 'app', 'created')
+    list_display_links = ('released', 'version')
+    list_filter = ('app',)
+admin.site.register(PrunedRelease, PrunedReleaseAdmin)
@@ -0,0 +1,499 @@
+from collections import defaultdict
+from contextlib import ExitStack
+from datetime import datetime
+import importlib
+import json
+import random
+import resource
+import threading
+import time
+from unittest import mock
+
+import requests
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from deis import __version__ as deis_version
+from deis import clock, metrics
+from api.models import App, Build, Config, Key, Push, Release
+from api.models.config import EMPTY
+from scheduler import get_scheduler
+
+
+class CountingAdapter(requests.adapters.BaseAdapter):
+    """
+    Counts the connections a scheduler client opens to the API server, each of them a
+    TLS handshake. The pools of a real transport count them as they open them. The mock
+    transport has no connections, there one is opened whenever the client has no idle
+    one left and it is idle again once the response is in, as with keep-alive
+    """
+
+    def __init__(self, adapter, handshakes):
+        super(CountingAdapter, self).__init__()
+        self.adapter = adapter
+        self.handshakes = handshakes
+        self.idle = 0
+        self.manager = getattr(adapter, 'poolmanager', None)
+        if self.manager is not None:
+            # a cold start, connections opened before the benchmark do not count
+            self.manager.clear()
+            self.pool_classes = self.manager.pool_classes_by_scheme
+            self.manager.pool_classes_by_scheme = {
+                scheme: self._counting(pool) for scheme, pool in self.pool_classes.items()
+            }
+
+    def _counting(self, pool_class):
+        handshakes = self.handshakes
+
+        class CountingPool(pool_class):
+            def _new_conn(self):
+                handshakes.connected()
+                return super(CountingPool, self)._new_conn()
+
+        return CountingPool
+
+    def send(self, request, **kwargs):
+        if self.manager is not None:
+            return self.adapter.send(request, **kwargs)
+
+        with self.handshakes.lock:
+            if self.idle:
+                self.idle -= 1
+            else:
+                self.handshakes.connections += 1
+        try:
+            return self.adapter.send(request, **kwargs)
+        finally:
+            with self.handshakes.lock:
+                self.idle += 1
+
+    def close(self):
+        self.adapter.close()
+
+    def unwrap(self):
+        """The adapter this one counts for, as it was before"""
+        if self.manager is not None:
+            self.manager.pool_classes_by_scheme = self.pool_classes
+        return self.adapter
+
+
+class Handshakes(object):
+    """Scheduler clients built during a benchmark and the connections they opened"""
+
+    def __init__(self):
+        self.clients = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    def count(self, client):
+        """Send the requests of a client through an adapter counting its connections"""
+        adapter = CountingAdapter(client.session.get_adapter(client.url), self)
+        client.session.mount(client.url, adapter)
+        with self.lock:
+            self.clients += 1
+        return adapter
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+
+
+def scheduler_client(options):
+    """
+    Handshakes with the API server per deploy of an existing app when every access builds
+    a new scheduler client, the way it used to be, against the shared client. The release
+    cleanup runs inline so its requests count too. Against the mock scheduler the router
+    health checks are faked and waits are skipped on a virtual clock:
+
+        ./manage.py benchmark scheduler-client --app example --iterations 10
+    """
+    if options['app'] is None:
+        raise CommandError('scheduler-client deploys an existing app, pass --app')
+
+    try:
+        release = Release.objects.filter(app__id=options['app']).latest()
+    except Release.DoesNotExist:
+        raise CommandError('{} has no release to deploy'.format(options['app']))
+    if release.build is None:
+        raise CommandError('the latest release of {} has no build'.format(options['app']))
+
+    module = importlib.import_module(settings.SCHEDULER_MODULE)
+    results = {}
+    with ExitStack() as stack:
+        if settings.SCHEDULER_MODULE == 'scheduler.mock':
+            # imported here, test dependencies are not part of the image
+            import requests_mock
+            from api.tests import adapter
+            stack.enter_context(requests_mock.Mocker(real_http=True, adapter=adapter))
+            stack.callback(clock.install, clock.install(clock.VirtualClock()))
+        stack.enter_context(override_settings(DEIS_OPERATION_WORKERS=0))
+
+        for mode in ['per-access', 'shared']:
+            handshakes = Handshakes()
+            if mode == 'per-access':
+
+                def build():
+                    client = module.SchedulerClient()
+                    handshakes.count(client)
+                    return client
+
+                scheduler = mock.patch('api.models.get_scheduler', side_effect=build)
+            else:
+                client = get_scheduler()
+                counting = handshakes.count(client)
+                scheduler = mock.patch('api.models.get_scheduler', return_value=client)
+
+            before = _kubernetes_requests()
+            start = time.time()
+            try:
+                with scheduler:
+                    for _ in range(options['iterations']):
+                        release.app.deploy(release)
+            finally:
+                if mode == 'shared':
+                    client.session.mount(client.url, counting.unwrap())
+
+            results[mode] = {
+                'deploys': options['iterations'],
+                'seconds': round(time.time() - start, 4),
+                'kubernetes_requests': sum(_kubernetes_requests().values()) - sum(before.values()),  # noqa
+                'clients': handshakes.clients,
+                'connections': handshakes.connections,
+                'handshakes_per_deploy': round(handshakes.connections / options['iterations'], 2),  # noqa
+            }
+
+    return results
+
+
+class Rollback(Exception):
+    """Raised to throw away everything a benchmark wrote to the database"""
+
+
+# generated rows, the newest release of every app has the highest version
+GENERATE_SQL = [
+    """
+    INSERT INTO api_app (uuid, created, updated, owner_id, id, structure)
+    SELECT md5('benchmark-app-' || i)::uuid, now(), now(), %(owner)s, 'benchmark-' || i, '{}'
+    FROM generate_series(1, %(apps)s) AS i
+    """,
+    """
+    INSERT INTO api_configpayload (digest, data, created)
+    SELECT %(empty)s, '{}', now()
+    WHERE NOT EXISTS (SELECT 1 FROM api_configpayload WHERE digest = %(empty)s)
+    """,
+    """
+    INSERT INTO api_config (uuid, created, updated, owner_id, app_id,
+                            values_payload_id, memory_payload_id, cpu_payload_id,
+                            tags_payload_id, registry_payload_id)
+    SELECT md5(a.uuid::text || '-config-' || j)::uuid, now() - j * interval '1 minute', now(),
+           a.owner_id, a.uuid, %(empty)s, %(empty)s, %(empty)s, %(empty)s, %(empty)s
+    FROM api_app a, generate_series(1, %(releases)s) AS j WHERE a.id LIKE 'benchmark-%%'
+    """,
+    """
+    INSERT INTO api_build (uuid, created, updated, owner_id, app_id,
+                           image, sha, procfile, dockerfile, image_digest, ports)
+    SELECT md5(a.uuid::text || '-build-' || j)::uuid, now() - j * interval '1 minute', now(),
+           a.owner_id, a.uuid, a.id, '', '{}', '', '', '[]'
+    FROM api_app a, generate_series(1, %(releases)s) AS j WHERE a.id LIKE 'benchmark-%%'
+    """,
+    """
+    INSERT INTO api_release (uuid, created, updated, owner_id, app_id,
+                             version, summary, config_id, build_id, traces)
+    SELECT md5(a.uuid::text || '-release-' || j)::uuid, now() - j * interval '1 minute', now(),
+           a.owner_id, a.uuid, %(releases)s - j + 1, '',
+           md5(a.uuid::text || '-config-' || j)::uuid, md5(a.uuid::text || '-build-' || j)::uuid,
+           '[]'
+    FROM api_app a, generate_series(1, %(releases)s) AS j WHERE a.id LIKE 'benchmark-%%'
+    """,
+    """
+    INSERT INTO api_push (uuid, created, updated, owner_id, app_id, sha, fingerprint,
+                          receive_user, receive_repo, ssh_connection, ssh_original_command)
+    SELECT md5(a.uuid::text || '-push-' || j)::uuid, now() - j * interval '1 minute', now(),
+           a.owner_id, a.uuid, '', '', '', a.id, '', ''
+    FROM api_app a, generate_series(1, %(releases)s) AS j WHERE a.id LIKE 'benchmark-%%'
+    """,
+    """
+    INSERT INTO api_key (uuid, created, updated, owner_id, id, public, fingerprint)
+    SELECT md5(a.uuid::text || '-key')::uuid, now(), now(), a.owner_id, a.id,
+           'ssh-rsa ' || a.uuid, md5(a.uuid::text)
+    FROM api_app a WHERE a.id LIKE 'benchmark-%%'
+    """,
+]
+
+# lookups done on nearly every API call and the index each of them needs
+HOT_QUERIES = [
+    ('release-latest', lambda app: Release.objects.filter(app=app).latest()),
+    ('config-latest', lambda app: Config.objects.filter(app=app).latest()),
+    ('build-latest', lambda app: Build.objects.filter(app=app).latest()),
+    ('push-latest', lambda app: Push.objects.filter(app=app).latest()),
+    ('key-fingerprint', lambda app: Key.objects.get(fingerprint=app.fingerprint)),
+]
+
+
+def _indexes(cursor, model):
+    """Names of the (app, created) and fingerprint indexes of a model"""
+    table = model._meta.db_table
+    names = []
+    for name, info in connection.introspection.get_constraints(cursor, table).items():
+        if info['index'] and not info['unique'] and \
+                info['columns'] in [['app_id', 'created'], ['fingerprint']]:
+            names.append(name)
+
+    return names
+
+
+def _time_queries(apps):
+    results = {}
+    for name, query in HOT_QUERIES:
+        timings = []
+        for app in apps:
+            start = time.time()
+            query(app)
+            timings.append(time.time() - start)
+
+        timings.sort()
+        results[name] = {
+            'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+            'p95_ms': round(timings[int(len(timings) * 0.95)] * 1000, 3),
+        }
+
+    return results
+
+
+def latest_lookups(options):
+    """
+    Latency of the latest-by-created and key fingerprint lookups with and without
+    their indexes, on generated apps with many releases each. Everything happens in
+    a transaction that is rolled back, including dropping the indexes
+    """
+    results = {}
+    try:
+        with transaction.atomic():
+            owner = User.objects.create(username='benchmark-{}'.format(random.randint(0, 1e9)))
+            params = {'owner': owner.pk, 'apps': options['apps'], 'releases': options['releases'],  # noqa
+                      'empty': EMPTY}
+            start = time.time()
+            with connection.cursor() as cursor:
+                for sql in GENERATE_SQL:
+                    cursor.execute(sql, params)
+
+                for model in [App, Config, Build, Release, Push, Key]:
+                    cursor.execute('ANALYZE {}'.format(model._meta.db_table))
+
+            results['generate_seconds'] = round(time.time() - start, 2)
+
+            apps = list(App.objects.filter(owner=owner).order_by('?')[:options['iterations']])
+            for app in apps:
+                app.fingerprint = Key.objects.get(id=app.id).fingerprint
+
+            results['indexed'] = _time_queries(apps)
+
+            with connection.cursor() as cursor:
+                for model in [Config, Build, Release, Push, Key]:
+                    for name in _indexes(cursor, model):
+                        cursor.execute('DROP INDEX {}'.format(connection.ops.quote_name(name)))
+
+            results['unindexed'] = _time_queries(apps)
+
+            raise Rollback()
+    except Rollback:
+        pass
+
+    return results
+
+
+def _percentiles(timings):
+    """Latency summary in milliseconds"""
+    timings = sorted(timings)
+
+    def rank(q):
+        return round(timings[min(len(timings) - 1, int(len(timings) * q))] * 1000, 3)
+
+    return {
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 3),
+        'p50_ms': rank(0.5),
+        'p90_ms': rank(0.9),
+        'p99_ms': rank(0.99),
+        'max_ms': round(timings[-1] * 1000, 3),
+    }
+
+
+def _kubernetes_requests():
+    """Kubernetes API requests sent by this process so far, by verb"""
+    verbs = defaultdict(int)
+    for name, labels, value in metrics.registry.snapshot()['counters']:
+        if name == 'deis_kubernetes_requests_total':
+            verbs[labels['verb']] += int(value)
+
+    return verbs
+
+
+class Load(object):
+    """Runs an operation against every app and records what it took"""
+
+    def __init__(self, client):
+        self.client = client
+        self.results = {}
+
+    def run(self, operation, apps, method, url, body=None, status=200):
+        timings = []
+        queries = []
+        before = _kubernetes_requests()
+        simulated = clock.time()
+        for app in apps:
+            start = time.time()
+            with CaptureQueriesContext(connection) as captured:
+                response = getattr(self.client, method)(url.format(app=app), body)
+            timings.append(time.time() - start)
+            queries.append(len(captured))
+            if response.status_code != status:
+                raise CommandError('{} of {} failed with {}: {}'.format(
+                    operation, app, response.status_code, getattr(response, 'data', '')))
+
+        after = _kubernetes_requests()
+        verbs = {verb: after[verb] - before.get(verb, 0) for verb in after
+                 if after[verb] != before.get(verb, 0)}
+        self.results[operation] = {
+            'calls': len(apps),
+            'latency': _percentiles(timings),
+            'sql_queries': {'total': sum(queries), 'max': max(queries)},
+            'kubernetes_requests': {'total': sum(verbs.values()), 'by_verb': verbs},
+            # waits on pods and the router, which the virtual clock skips
+            'simulated_seconds': round(clock.time() - simulated, 1),
+            # high-water mark of the process up to the end of the operation (KiB on Linux)
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+
+def controller_load(options):
+    """
+    Create apps, deploy them, scale every process type, list pods, deploy a config
+    change, roll back and destroy the apps through the REST API, against the mock
+    scheduler and router on a virtual clock. Each operation records latency
+    percentiles, SQL queries, Kubernetes API requests and the peak RSS of the process.
+
+    Outside of the test suite run it on a throwaway database:
+
+        ./manage.py benchmark controller-load --settings=api.settings.testing \\
+            --create-db --apps 50 --replicas 10 --output load.json
+    """
+    if settings.SCHEDULER_MODULE != 'scheduler.mock':
+        raise CommandError('controller-load runs against the mock scheduler only, '
+                           'use --settings=api.settings.testing')
+
+    # imported here, test dependencies are not part of the image. The fake router
+    # answers the health checks of routable process types
+    import requests_mock
+    from api.tests import adapter
+
+    database = None
+    if options['create_db']:
+        database = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+    # an empty cluster, the mock scheduler starts over once the cache is cleared
+    cache.clear()
+    previous = clock.install(clock.VirtualClock())
+    try:
+        suffix = random.randint(0, 1e9)
+        user = User.objects.create_user('benchmark-{}'.format(suffix))
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Token ' + Token.objects.get(user=user).key)
+
+        apps = ['load-{}-{}'.format(suffix, i) for i in range(options['apps'])]
+        types = ['web'] + ['worker{}'.format(i) for i in range(1, options['process_types'])]
+        build = {
+            # already in the registry, nothing gets published
+            'image': '{}/benchmark:v1'.format(settings.REGISTRY_URL),
+            'procfile': {name: 'start ' + name for name in types},
+        }
+
+        load = Load(client)
+        with requests_mock.Mocker(real_http=True, adapter=adapter):
+            for app in apps:
+                response = client.post('/v2/apps', {'id': app})
+                if response.status_code != 201:
+                    raise CommandError('could not create {}: {}'.format(app, response.data))
+
+            load.run('config', apps, 'post', '/v2/apps/{app}/config',
+                     {'values': json.dumps({'PORT': '5000'})}, 201)
+            load.run('deploy', apps, 'post', '/v2/apps/{app}/builds', build, 201)
+            load.run('scale', apps, 'post', '/v2/apps/{app}/scale',
+                     {name: options['replicas'] for name in types}, 204)
+            load.run('pods', apps, 'get', '/v2/apps/{app}/pods')
+            load.run('redeploy', apps, 'post', '/v2/apps/{app}/config',
+                     {'values': json.dumps({'BENCHMARK': str(suffix)})}, 201)
+            load.run('rollback', apps, 'post', '/v2/apps/{app}/releases/rollback/',
+                     {'version': 3}, 201)
+            load.run('destroy', apps, 'delete', '/v2/apps/{app}', None, 204)
+
+        user.delete()
+        return dict(load.results, apps=len(apps), process_types=len(types),
+                    replicas=options['replicas'])
+    finally:
+        clock.install(previous)
+        cache.clear()
+        if database is not None:
+            connection.creation.destroy_test_db(database, verbosity=0)
+
+
+SCENARIOS = {
+    'scheduler-client': scheduler_client,
+    'latest-lookups': latest_lookups,
+    'controller-load': controller_load,
+}
+
+# how many apps a scenario generates unless told otherwise
+APPS = {
+    'latest-lookups': 10000,
+    'controller-load': 10,
+}
+
+
+class Command(BaseCommand):
+    """Management command for benchmarking controller code paths"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS.keys()))
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--app', default=None,
+                            help='the app scheduler-client deploys, its latest release again')
+        parser.add_argument('--apps', type=int, default=None)
+        parser.add_argument('--releases', type=int, default=200)
+        parser.add_argument('--replicas', type=int, default=3)
+        parser.add_argument('--process-types', type=int, default=2)
+        parser.add_argument('--create-db', action='store_true', default=False,
+                            help='run on a throwaway database that is dropped afterwards')
+        parser.add_argument('--output', default=None,
+                            help='also save the results as JSON, to compare across versions')
+
+    def handle(self, *args, **options):
+        if options['iterations'] < 1:
+            raise CommandError('--iterations has to be at least 1')
+
+        if options['apps'] is None:
+            options['apps'] = APPS.get(options['scenario'], 10)
+
+        if min(options['apps'], options['process_types']) < 1:
+            raise CommandError('--apps and --process-types have to be at least 1')
+
+        results = SCENARIOS[options['scenario']](options)
+        self.stdout.write(json.dumps({options['scenario']: results}, indent=2, sort_keys=True))
+
+        if options['output']:
+            document = {
+                options['scenario']: results,
+                'version': deis_version,
+                'created': datetime.utcnow().strftime(settings.DEIS_DATETIME_FORMAT),
+                'options': {key: options[key] for key in
+                            ['apps', 'releases', 'replicas', 'process_types', 'iterations']},
+            }
+            with open(options['output'], 'w') as f:
+                json.dump(document, f, indent=2, sort_keys=True)
@@ -0,0 +1,36 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import retention
+from api.models import App
+
+
+class Command(BaseCommand):
+    """Management command for garbage collecting release history"""
+
+    def add_arguments(self, parser):
+        parser.add_argument('apps', nargs='*', help='only these applications')
+        parser.add_argument('--keep', type=int, default=None,
+                            help='releases to keep, overrides the app and global setting')
+        parser.add_argument('--days', type=int, default=None,
+                            help='days of releases to keep, overrides the app and global setting')  # noqa
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='only report what would be removed')
+
+    def handle(self, *args, **options):
+        for option in ['keep', 'days']:
+            if options[option] is not None and options[option] < 0:
+                raise CommandError('--{} can not be negative'.format(option))
+
+        apps = None
+        if options['apps']:
+            apps = App.objects.filter(id__in=options['apps'])
+            missing = set(options['apps']) - set(apps.values_list('id', flat=True))
+            if missing:
+                raise CommandError('unknown apps: {}'.format(', '.join(sorted(missing))))
+
+        report = retention.collect_all(
+            apps=apps, keep=options['keep'], days=options['days'], dry_run=options['dry_run']
+        )
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
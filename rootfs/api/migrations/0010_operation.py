@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0009_auto_20160607_2259'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Operation',
+            fields=[
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('uuid', models.UUIDField(auto_created=True, default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True, verbose_name='UUID')),
+                ('type', models.CharField(choices=[('deploy', 'deploy'), ('scale', 'scale'), ('restart', 'restart'), ('run', 'run')], max_length=16)),
+                ('params', jsonfield.fields.JSONField(blank=True, default={})),
+                ('state', models.CharField(choices=[('pending', 'pending'), ('running', 'running'), ('succeeded', 'succeeded'), ('failed', 'failed')], db_index=True, default='pending', max_length=16)),
+                ('progress', models.CharField(blank=True, max_length=255)),
+                ('result', jsonfield.fields.JSONField(blank=True, default={})),
+                ('error', models.TextField(blank=True)),
+                ('worker', models.CharField(blank=True, max_length=255)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('app', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.App')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created'],
+                'get_latest_by': 'created',
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_operation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='image_digest',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='image_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='build',
+            name='ports',
+            field=jsonfield.fields.JSONField(blank=True, default=[]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_build_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='operation',
+            name='type',
+            field=models.CharField(choices=[('deploy', 'deploy'), ('scale', 'scale'), ('restart', 'restart'), ('run', 'run'), ('cleanup', 'cleanup')], max_length=16),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_operation_cleanup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='key',
+            name='fingerprint',
+            field=models.CharField(db_index=True, editable=False, max_length=128),
+        ),
+        migrations.AlterIndexTogether(
+            name='build',
+            index_together=set([('app', 'created')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='config',
+            index_together=set([('app', 'created')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='push',
+            index_together=set([('app', 'created')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='release',
+            index_together=set([('app', 'created')]),
+        ),
+    ]
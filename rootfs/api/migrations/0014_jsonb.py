@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+import api.models
+import api.models.app
+
+# (table, column, empty value, GIN index) of the jsonfield text columns moving to JSONB
+COLUMNS = [
+    ('api_app', 'structure', '{}', True),
+    ('api_build', 'procfile', '{}', True),
+    ('api_build', 'ports', '[]', False),
+    ('api_config', 'values', '{}', True),
+    ('api_config', 'memory', '{}', False),
+    ('api_config', 'cpu', '{}', False),
+    ('api_config', 'tags', '{}', True),
+    ('api_config', 'registry', '{}', False),
+]
+
+
+def to_jsonb(table, column, empty, index):
+    # a blank text column is not valid JSON
+    sql = [
+        'ALTER TABLE {0} ALTER COLUMN "{1}" TYPE jsonb USING '
+        '(CASE WHEN "{1}" = \'\' THEN \'{2}\' ELSE "{1}" END)::jsonb'.format(table, column, empty),  # noqa
+    ]
+    if index:
+        sql.append('CREATE INDEX {0}_{1}_gin ON {0} USING gin ("{1}")'.format(table, column))
+
+    return sql
+
+
+def to_text(table, column, empty, index):
+    sql = []
+    if index:
+        sql.append('DROP INDEX {}_{}_gin'.format(table, column))
+
+    sql.append('ALTER TABLE {0} ALTER COLUMN "{1}" TYPE text USING "{1}"::text'.format(table, column))  # noqa
+    return sql
+
+
+def field(name, **kwargs):
+    return migrations.AlterField(
+        model_name=name.split('.')[0],
+        name=name.split('.')[1],
+        field=api.models.JSONField(blank=True, **kwargs),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_latest_by_created_indexes'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(to_jsonb(*column), to_text(*column)) for column in COLUMNS
+            ],
+            state_operations=[
+                field('app.structure', default=dict,
+                      validators=[api.models.app.validate_app_structure]),
+                field('build.ports', default=list),
+                field('build.procfile', default=dict),
+                field('config.cpu', default=dict),
+                field('config.memory', default=dict),
+                field('config.registry', default=dict),
+                field('config.tags', default=dict),
+                field('config.values', default=dict),
+            ],
+        ),
+    ]
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+import api.models
+
+PAYLOADS = ('values', 'memory', 'cpu', 'tags', 'registry')
+
+
+def digest(data):
+    """Copy of api.models.config.digest as of this migration"""
+    encoded = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def store_payloads(apps, schema_editor):
+    Config = apps.get_model('api', 'Config')
+    ConfigPayload = apps.get_model('api', 'ConfigPayload')
+
+    existing = set(ConfigPayload.objects.values_list('digest', flat=True))
+    for config in Config.objects.all().iterator():
+        references = {}
+        for attr in PAYLOADS:
+            data = getattr(config, attr) or {}
+            reference = digest(data)
+            if reference not in existing:
+                ConfigPayload.objects.create(digest=reference, data=data)
+                existing.add(reference)
+
+            references[attr + '_payload_id'] = reference
+
+        Config.objects.filter(uuid=config.uuid).update(**references)
+
+
+def restore_payloads(apps, schema_editor):
+    Config = apps.get_model('api', 'Config')
+    ConfigPayload = apps.get_model('api', 'ConfigPayload')
+
+    for config in Config.objects.all().iterator():
+        values = {}
+        for attr in PAYLOADS:
+            reference = getattr(config, attr + '_payload_id')
+            values[attr] = ConfigPayload.objects.get(digest=reference).data if reference else {}
+
+        Config.objects.filter(uuid=config.uuid).update(**values)
+
+
+def payload_field(null):
+    return models.ForeignKey(
+        null=null, on_delete=django.db.models.deletion.PROTECT,
+        related_name='+', to='api.ConfigPayload'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_jsonb'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConfigPayload',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('data', api.models.JSONField(blank=True, default=dict)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX api_configpayload_data_gin ON api_configpayload USING gin ("data")',
+            'DROP INDEX api_configpayload_data_gin'
+        ),
+    ] + [
+        migrations.AddField(model_name='config', name=attr + '_payload', field=payload_field(True))
+        for attr in PAYLOADS
+    ] + [
+        migrations.RunPython(store_payloads, restore_payloads),
+    ] + [
+        migrations.AlterField(model_name='config', name=attr + '_payload', field=payload_field(False))  # noqa
+        for attr in PAYLOADS
+    ] + [
+        # the GIN indexes of 0014 go away with the columns
+        migrations.RunSQL(
+            ['DROP INDEX api_config_values_gin', 'DROP INDEX api_config_tags_gin'],
+            ['CREATE INDEX api_config_values_gin ON api_config USING gin ("values")',
+             'CREATE INDEX api_config_tags_gin ON api_config USING gin ("tags")']
+        ),
+    ] + [
+        migrations.RemoveField(model_name='config', name=attr) for attr in PAYLOADS
+    ]
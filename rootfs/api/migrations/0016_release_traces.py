@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+import api.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0015_configpayload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='release',
+            name='traces',
+            field=api.models.JSONField(blank=True, default=list),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+import api.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0016_release_traces'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrunedRelease',
+            fields=[
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('uuid', models.UUIDField(auto_created=True, default=uuid.uuid4, editable=False, primary_key=True, serialize=False, unique=True, verbose_name='UUID')),  # noqa
+                ('version', models.PositiveIntegerField()),
+                ('summary', models.TextField(blank=True, null=True)),
+                ('owner', models.CharField(max_length=150)),
+                ('released', models.DateTimeField()),
+                ('image', models.TextField(blank=True)),
+                ('sha', models.CharField(blank=True, max_length=40)),
+                ('config', api.models.JSONField(blank=True, default=dict)),
+                ('app', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.App')),  # noqa
+            ],
+            options={
+                'ordering': ['-version'],
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='prunedrelease',
+            unique_together=set([('app', 'version')]),
+        ),
+    ]
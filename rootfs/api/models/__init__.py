@@ -3,23 +3,26 @@
 """
 Data models for the Deis API.
 """
-import importlib
+from functools import partial
+import json
 import logging
 import uuid
 import morph
 import re
 
 from django.conf import settings
+from django.contrib.postgres import fields as postgres_fields
 from django.db import models
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from psycopg2.extras import Json
 
 from rest_framework.exceptions import ValidationError
 from rest_framework.authtoken.models import Token
 
 from api.exceptions import DeisException, AlreadyExists, ServiceUnavailable  # noqa
 from api.utils import dict_merge
-from scheduler import KubeException
+from scheduler import KubeException, get_scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +37,47 @@ def validate_label(value):
         raise ValidationError("Can only contain a-z (lowercase), 0-9 and hypens")
 
 
+class JSONDescriptor(object):
+    """
+    Decode JSON encoded strings assigned to an object that is not saved yet, the
+    way jsonfield did. Clients send e.g. a Procfile either as an object or as a string
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+
+        return obj.__dict__[self.field.name]
+
+    def __set__(self, obj, value):
+        if obj._state.adding and isinstance(value, str) and value:
+            try:
+                value = json.loads(value)
+            except ValueError:
+                raise ValidationError('{} is not valid JSON'.format(self.field.name))
+
+        obj.__dict__[self.field.name] = value
+
+
+class JSONField(postgres_fields.JSONField):
+    """A JSONB column which can be queried and indexed by the database"""
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(JSONField, self).contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.name, JSONDescriptor(self))
+
+    def get_prep_value(self, value):
+        if value is None:
+            return value
+
+        # non-ASCII characters as they are, jsonb only takes \u escapes the server
+        # encoding can represent
+        return Json(value, dumps=partial(json.dumps, ensure_ascii=False))
+
+
 class AuditedModel(models.Model):
     """Add created and updated fields to a model."""
 
@@ -46,8 +90,7 @@ class AuditedModel(models.Model):
 
     @property
     def _scheduler(self):
-        mod = importlib.import_module(settings.SCHEDULER_MODULE)
-        return mod.SchedulerClient()
+        return get_scheduler()
 
     def _fetch_service_config(self, app):
         try:
@@ -115,8 +158,10 @@ from .key import Key, validate_base64  # noqa
 from .certificate import Certificate, validate_certificate  # noqa
 from .domain import Domain  # noqa
 from .release import Release  # noqa
-from .config import Config  # noqa
+from .config import Config, ConfigPayload  # noqa
 from .build import Build  # noqa
+from .operation import Operation  # noqa
+from .pruned_release import PrunedRelease  # noqa
 
 # define update/delete callbacks for synchronizing
 # models with the configuration management backend
@@ -164,6 +209,13 @@ def _log_cert_removed(**kwargs):
     logger.info("cert {} removed".format(cert))
 
 
+def _forget_latest_release(sender, **kwargs):
+    instance = kwargs['instance']
+    # only the app instance the change went through has to know, loading it is not needed
+    if sender.app.is_cached(instance):
+        instance.app.forget_latest_release()
+
+
 # Log significant app-related events
 post_save.connect(_log_build_created, sender=Build, dispatch_uid='api.models.log')
 post_save.connect(_log_release_created, sender=Release, dispatch_uid='api.models.log')
@@ -173,6 +225,11 @@ post_save.connect(_log_cert_added, sender=Certificate, dispatch_uid='api.models.
 post_delete.connect(_log_domain_removed, sender=Domain, dispatch_uid='api.models.log')
 post_delete.connect(_log_cert_removed, sender=Certificate, dispatch_uid='api.models.log')
 
+# Drop the latest release an app instance has cached
+for model in [Release, Config, Build]:
+    post_save.connect(_forget_latest_release, sender=model, dispatch_uid='api.models.release')
+    post_delete.connect(_forget_latest_release, sender=model, dispatch_uid='api.models.release')
+
 
 # automatically generate a new token on creation
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
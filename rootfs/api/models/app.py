@@ -1,27 +1,28 @@
 import backoff
 from collections import OrderedDict
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import random
 import re
 import requests
 from requests_toolbelt import user_agent
 import string
-import time
 from urllib.parse import urljoin
 
 from django.conf import settings
 from django.db import models
 from rest_framework.exceptions import ValidationError, NotFound
-from jsonfield import JSONField
 
 from deis import __version__ as deis_version
-from api.models import UuidAuditedModel, AlreadyExists, DeisException, ServiceUnavailable
+from deis import clock, metrics, trace
+from api.models import JSONField, UuidAuditedModel, AlreadyExists, DeisException, \
+    ServiceUnavailable
 
 from api.utils import generate_app_name
 from api.models.release import Release
 from api.models.config import Config
 from api.models.domain import Domain
+from api.models.operation import Operation
 
 from scheduler import KubeHTTPException, KubeException
 
@@ -66,7 +67,7 @@ class App(UuidAuditedModel):
     id = models.SlugField(max_length=24, unique=True, null=True,
                           validators=[validate_id_is_docker_compatible,
                                       validate_reserved_names])
-    structure = JSONField(default={}, blank=True, validators=[validate_app_structure])
+    structure = JSONField(default=dict, blank=True, validators=[validate_app_structure])
 
     class Meta:
         permissions = (('use_app', 'Can use app'),)
@@ -80,7 +81,7 @@ class App(UuidAuditedModel):
         # verify the application name doesn't exist as a k8s namespace
         # only check for it if there have been on releases
         try:
-            self.release_set.latest()
+            self.latest_release()
         except Release.DoesNotExist:
             try:
                 if self._scheduler.get_namespace(self.id).status_code == 200:
@@ -101,9 +102,26 @@ class App(UuidAuditedModel):
     def __str__(self):
         return self.id
 
+    def latest_release(self):
+        """
+        The latest release with its config and build, looked up once per instance.
+        Instances live as long as a request or an operation, saving or deleting
+        a release, config or build through them drops the cached one
+        """
+        release = getattr(self, '_latest_release', None)
+        if release is None:
+            related = ['config', 'build'] + Config.related('config__')
+            release = self.release_set.select_related(*related).latest()
+            self._latest_release = release
+
+        return release
+
+    def forget_latest_release(self):
+        self._latest_release = None
+
     def _get_job_id(self, container_type):
         app = self.id
-        release = self.release_set.latest()
+        release = self.latest_release()
         version = "v{}".format(release.version)
         job_id = "{app}-{version}-{container_type}".format(**locals())
         return job_id
@@ -113,7 +131,7 @@ class App(UuidAuditedModel):
             # if this is not procfile-based app, ensure they cannot break out
             # and run arbitrary commands on the host
             # FIXME: remove slugrunner's hardcoded entrypoint
-            release = self.release_set.latest()
+            release = self.latest_release()
             if release.build.dockerfile or not release.build.sha:
                 return "bash -c '{}'".format(release.build.procfile[container_type])
 
@@ -129,7 +147,7 @@ class App(UuidAuditedModel):
 
         # if this is a procfile-based app, switch the entrypoint to slugrunner's default
         # FIXME: remove slugrunner's hardcoded entrypoint
-        release = self.release_set.latest()
+        release = self.latest_release()
         if release.build.procfile and \
            release.build.sha and not \
            release.build.dockerfile:
@@ -163,7 +181,7 @@ class App(UuidAuditedModel):
 
         # Only create if no release can be found
         try:
-            rel = self.release_set.latest()
+            rel = self.latest_release()
         except Release.DoesNotExist:
             rel = Release.objects.create(
                 version=1, owner=self.owner, app=self,
@@ -218,6 +236,7 @@ class App(UuidAuditedModel):
         self._clean_app_logs()
         return super(App, self).delete(*args, **kwargs)
 
+    @metrics.timed('restart')  # noqa
     def restart(self, **kwargs):  # noqa
         """
         Restart found pods by deleting them (RC will recreate).
@@ -227,7 +246,7 @@ class App(UuidAuditedModel):
             # Resolve single pod name if short form (worker-asdfg) is passed
             if 'name' in kwargs and kwargs['name'].count('-') == 1:
                 if 'release' not in kwargs or kwargs['release'] is None:
-                    release = self.release_set.latest()
+                    release = self.latest_release()
                 else:
                     release = self.release_set.get(version=kwargs['release'])
 
@@ -240,6 +259,8 @@ class App(UuidAuditedModel):
                 desired = 0
                 labels = self._scheduler_filter(**kwargs)
                 controllers = self._scheduler.get_rcs(kwargs['id'], labels=labels).json()['items']
+                if settings.KUBERNETES_DEPLOYMENTS:
+                    controllers += self._scheduler.get_deployments(kwargs['id'], labels=labels).json()['items']  # noqa
                 for controller in controllers:
                     desired += controller['spec']['replicas']
         except KubeException:
@@ -281,7 +302,7 @@ class App(UuidAuditedModel):
                     break
 
                 elapsed += 5
-                time.sleep(5)
+                clock.sleep(5)
         except Exception as e:
             err = "warning, some pods failed to start:\n{}".format(str(e))
             self.log(err, logging.WARNING)
@@ -302,16 +323,16 @@ class App(UuidAuditedModel):
             err = 'Error deleting existing application logs: {}'.format(e)
             self.log(err, logging.WARNING)
 
+    @metrics.timed('scale')  # noqa
     def scale(self, user, structure):  # noqa
         """Scale containers up or down to match requested structure."""
         # use create to make sure minimum resources are created
         self.create()
 
-        if self.release_set.latest().build is None:
+        release = self.latest_release()
+        if release.build is None:
             raise DeisException('No build associated with this release')
 
-        release = self.release_set.latest()
-
         # Validate structure
         try:
             for target, count in structure.copy().items():
@@ -339,7 +360,8 @@ class App(UuidAuditedModel):
             self.structure = new_structure
             self.save()
 
-            self._scale_pods(structure)
+            with release.traced('scale', {'structure': structure}):
+                self._scale_pods(structure)
 
             msg = '{} scaled pods '.format(user.username) + ' '.join(
                 "{}={}".format(k, v) for k, v in list(structure.items()))
@@ -350,8 +372,9 @@ class App(UuidAuditedModel):
         return False
 
     def _scale_pods(self, scale_types):
-        release = self.release_set.latest()
-        envs = release.config.values
+        release = self.latest_release()
+        # PORT is added per process type, the cached config stays as it is in the database
+        envs = release.config.values.copy()
         for scale_type, replicas in scale_types.items():
             # only web / cmd are routable
             # http://docs.deis.io/en/latest/using_deis/process-types/#web-vs-cmd-process-types
@@ -389,8 +412,13 @@ class App(UuidAuditedModel):
                 self.log(err, logging.ERROR)
                 raise ServiceUnavailable(err) from e
 
+    @metrics.timed('deploy')
     def deploy(self, release):
         """Deploy a new release to this application"""
+        with release.traced('deploy', {'version': release.version}):
+            self._deploy(release)
+
+    def _deploy(self, release):
         if release.build is None:
             raise DeisException('No build associated with this release')
 
@@ -406,7 +434,7 @@ class App(UuidAuditedModel):
 
         # deploy application to k8s. Also handles initial scaling
         deploys = {}
-        envs = release.config.values
+        envs = release.config.values.copy()
         for scale_type, replicas in self.structure.items():
             # only web / cmd are routable
             # http://docs.deis.io/en/latest/using_deis/process-types/#web-vs-cmd-process-types
@@ -433,31 +461,89 @@ class App(UuidAuditedModel):
             }
 
         # Sort deploys so routable comes first
-        deploys = OrderedDict(sorted(deploys.items(), key=lambda d: d[1].get('routable')))
+        deploys = OrderedDict(sorted(deploys.items(), key=lambda d: not d[1].get('routable')))
+
+        # see if the app config has a process concurrency preference, otherwise use global
+        concurrency = int(release.config.values.get(
+            'DEIS_DEPLOY_PROCESS_CONCURRENCY', settings.DEIS_DEPLOY_PROCESS_CONCURRENCY
+        ))
 
+        # only wait for the router when there is no previous build / release
+        old = release.previous()
+        verify = old is None or old.build is None
+
+        # resolve everything that needs the database before any threads are involved
+        jobs = OrderedDict()
         for scale_type, kwargs in deploys.items():
+            jobs[self._get_job_id(scale_type)] = dict(
+                namespace=self.id,
+                image=release.image,
+                command=self._get_command(scale_type),
+                **kwargs
+            )
+
+        # routable process types have to be healthy before anything else is rolled out
+        for name, kwargs in jobs.items():
+            if concurrency > 1 and not kwargs['routable']:
+                continue
+
             try:
-                self._scheduler.deploy(
-                    namespace=self.id,
-                    name=self._get_job_id(scale_type),
-                    image=release.image,
-                    command=self._get_command(scale_type),
-                    **kwargs
-                )
+                self._scheduler.deploy(name=name, **kwargs)
 
                 # Wait until application is available in the router
-                # Only run when there is no previous build / release
-                old = release.previous()
-                if old is None or old.build is None:
+                if verify:
                     self.verify_application_health(**kwargs)
 
             except Exception as e:
-                err = '{} (app::deploy): {}'.format(self._get_job_id(scale_type), e)
+                err = '{} (app::deploy): {}'.format(name, e)
                 self.log(err, logging.ERROR)
                 raise ServiceUnavailable(err) from e
 
+        # roll out the remaining process types side by side
+        if concurrency > 1:
+            self._deploy_concurrently(
+                {name: kwargs for name, kwargs in jobs.items() if not kwargs['routable']},
+                concurrency
+            )
+
         # cleanup old releases from kubernetes
-        release.cleanup_old()
+        self._cleanup_old(release)
+
+    @trace.traced('cleanup_old')
+    def _cleanup_old(self, release):
+        """
+        Tear down older releases in the background when there are workers around,
+        so the deploy does not have to wait for it
+        """
+        if settings.DEIS_OPERATION_WORKERS > 0:
+            Operation.start(release.owner, self, 'cleanup', {'release': str(release.uuid)})
+        else:
+            release.cleanup_old()
+
+    def _deploy_concurrently(self, jobs, concurrency):
+        """
+        Deploy process types on a bounded thread pool. Every process type is
+        rolled back on its own by the scheduler, all failures are reported together
+        """
+        if not jobs:
+            return
+
+        errors = []
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(jobs))) as executor:
+            futures = {
+                executor.submit(trace.bind(self._scheduler.deploy), name=name, **kwargs): name
+                for name, kwargs in jobs.items()
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    err = '{} (app::deploy): {}'.format(futures[future], e)
+                    self.log(err, logging.ERROR)
+                    errors.append(err)
+
+        if errors:
+            raise ServiceUnavailable('\n'.join(sorted(errors)))
 
     def _default_structure(self, release):
         """Scale to default structure based on release type"""
@@ -484,6 +570,7 @@ class App(UuidAuditedModel):
 
         return structure
 
+    @trace.traced('verify_application_health', 'app_type')
     def verify_application_health(self, **kwargs):
         """
         Verify an application is healthy via the router.
@@ -528,7 +615,7 @@ class App(UuidAuditedModel):
 
         # Give the router max of 10 tries or max 30 seconds to become healthy
         # Uses time module to account for the timout value of 3 seconds
-        start = time.time()
+        start = clock.time()
         failed = False
         for _ in range(10):
             try:
@@ -539,11 +626,11 @@ class App(UuidAuditedModel):
                 # In case of a failure where response object is not available
                 failed = True
                 # We are fine with timeouts and request problems, lets keep trying
-                time.sleep(1)  # just a bit of a buffer
+                clock.sleep(1)  # just a bit of a buffer
                 continue
 
             # 30 second timeout (timout per request * 10)
-            if (time.time() - start) > (req_timeout * 10):
+            if (clock.time() - start) > (req_timeout * 10):
                 break
 
             # check response against the allowed pool
@@ -551,11 +638,11 @@ class App(UuidAuditedModel):
                 break
 
             # a small sleep since router usually resolve within 10 seconds
-            time.sleep(1)
+            clock.sleep(1)
 
         # Endpoint did not report healthy in time
         if ('response' in locals() and response.status_code == 404) or failed:
-            delta = time.time() - start
+            delta = clock.time() - start
             self.log(
                 'Router was not ready to serve traffic to process type {} in time, waited {} seconds'.format(app_type, delta),  # noqa
                 level=logging.WARNING
@@ -595,19 +682,25 @@ class App(UuidAuditedModel):
         # cast content to string since it comes as bytes via the requests object
         return str(r.content)
 
-    def run(self, user, command):
-        def pod_name(size=5, chars=string.ascii_lowercase + string.digits):
-            return ''.join(random.choice(chars) for _ in range(size))
+    def run_name(self, size=5, chars=string.ascii_lowercase + string.digits):
+        """Pod name of a new one-off command, doubling as its job id"""
+        return self._get_job_id('run') + '-' + ''.join(random.choice(chars) for _ in range(size))
+
+    def run(self, user, command, name=None, stream=False, timeout=None):
+        """
+        Run a one-off command in an ephemeral app container.
 
-        """Run a one-off command in an ephemeral app container."""
-        release = self.release_set.latest()
+        Returns the exit code and output, or with stream a generator of ('output', bytes)
+        while the command runs followed by ('exit_code', int)
+        """
+        release = self.latest_release()
         if release.build is None:
             raise DeisException('No build associated with this release to run this command')
 
         # TODO: add support for interactive shell
         entrypoint, command = self._get_command_run(command)
 
-        name = self._get_job_id('run') + '-' + pod_name()
+        name = name or self.run_name()
         self.log("{} on {} runs '{}'".format(user.username, name, command))
 
         kwargs = {
@@ -620,17 +713,12 @@ class App(UuidAuditedModel):
             'build_type': release.build.type,
         }
 
-        try:
-            exit_code, output = self._scheduler.run(
-                self.id,
-                name,
-                release.image,
-                entrypoint,
-                command,
-                **kwargs
-            )
+        if timeout is not None:
+            kwargs['timeout'] = timeout
 
-            return exit_code, output
+        try:
+            run = self._scheduler.run_stream if stream else self._scheduler.run
+            return run(self.id, name, release.image, entrypoint, command, **kwargs)
         except Exception as e:
             err = '{} (run): {}'.format(name, e)
             raise ServiceUnavailable(err) from e
@@ -670,7 +758,7 @@ class App(UuidAuditedModel):
                 if 'startTime' in p['status']:
                     started = p['status']['startTime']
                 else:
-                    started = str(datetime.utcnow().strftime(settings.DEIS_DATETIME_FORMAT))
+                    started = str(clock.utcnow().strftime(settings.DEIS_DATETIME_FORMAT))
                 item['started'] = started
 
                 data.append(item)
@@ -691,7 +779,7 @@ class App(UuidAuditedModel):
 
         # always supply a version, either latest or a specific one
         if 'release' not in kwargs or kwargs['release'] is None:
-            release = self.release_set.latest()
+            release = self.latest_release()
         else:
             release = self.release_set.get(version=kwargs['release'])
 
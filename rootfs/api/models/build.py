@@ -1,8 +1,7 @@
 from django.conf import settings
 from django.db import models
-from jsonfield import JSONField
 
-from api.models import UuidAuditedModel, DeisException
+from api.models import JSONField, UuidAuditedModel, DeisException
 
 import logging
 logger = logging.getLogger(__name__)
@@ -19,13 +18,21 @@ class Build(UuidAuditedModel):
 
     # optional fields populated by builder
     sha = models.CharField(max_length=40, blank=True)
-    procfile = JSONField(default={}, blank=True)
+    procfile = JSONField(default=dict, blank=True)
     dockerfile = models.TextField(blank=True)
 
+    # image metadata recorded when the image is published or first inspected, so deploys,
+    # scales and rollbacks of the same build do not have to go back to the registry
+    image_digest = models.CharField(max_length=255, blank=True)
+    ports = JSONField(default=list, blank=True)
+    image_size = models.BigIntegerField(null=True, blank=True)
+
     class Meta:
         get_latest_by = 'created'
         ordering = ['-created']
         unique_together = (('app', 'uuid'),)
+        # latest() of an app walks this backwards
+        index_together = (('app', 'created'),)
 
     @property
     def type(self):
@@ -52,13 +59,7 @@ class Build(UuidAuditedModel):
         return 'git-{}'.format(self.sha) if self.source_based else 'latest'
 
     def create(self, user, *args, **kwargs):
-        latest_release = self.app.release_set.latest()
-        new_release = latest_release.new(
-            user,
-            build=self,
-            config=latest_release.config,
-            source_version=self.version
-        )
+        new_release = self.new_release(user)
 
         try:
             self.app.deploy(new_release)
@@ -70,6 +71,35 @@ class Build(UuidAuditedModel):
 
             raise DeisException(str(e)) from e
 
+    def new_release(self, user):
+        """Create a release out of this build and the latest config"""
+        latest_release = self.app.latest_release()
+        return latest_release.new(
+            user,
+            build=self,
+            config=latest_release.config,
+            source_version=self.version
+        )
+
+    def record_image(self, digest=None, ports=None, size=None):
+        """Remember what is known about the image of this build"""
+        values = {}
+        if digest:
+            values['image_digest'] = digest
+        if ports is not None:
+            values['ports'] = ports
+        if size is not None:
+            values['image_size'] = size
+
+        if not values:
+            return
+
+        for field, value in values.items():
+            setattr(self, field, value)
+
+        # bypass save() as it scales away process types missing from the procfile
+        Build.objects.filter(uuid=self.uuid).update(**values)
+
     def save(self, **kwargs):
         try:
             removed = {}
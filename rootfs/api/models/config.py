@@ -1,11 +1,85 @@
+import hashlib
+import json
+
 from django.conf import settings
-from django.db import models
-from jsonfield import JSONField
+from django.db import models, transaction
 
 from api.models.release import Release
-from api.models import UuidAuditedModel
+from api.models import JSONField, UuidAuditedModel
 from api.exceptions import DeisException, UnprocessableEntity
 
+# parts of a config, each stored once per distinct content
+PAYLOADS = ('values', 'memory', 'cpu', 'tags', 'registry')
+
+
+def digest(data):
+    """SHA-256 of the canonical JSON encoding of a config payload"""
+    encoded = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+EMPTY = digest({})
+
+
+class ConfigPayload(models.Model):
+    """
+    A part of a config (env vars, limits, tags or registry settings) addressed by
+    the digest of its content, shared by every config with the same content
+    """
+
+    digest = models.CharField(max_length=64, primary_key=True)
+    data = JSONField(default=dict, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.digest[:7]
+
+    @classmethod
+    def store(cls, reference, data):
+        """
+        Store a payload unless it is there already and lock it until the transaction
+        ends, so garbage collection can not remove it before the config pointing at it
+        is saved
+        """
+        while cls.objects.select_for_update().filter(digest=reference).first() is None:
+            # garbage collection may remove it again before it is locked
+            cls.objects.get_or_create(digest=reference, defaults={'data': data})
+
+    @classmethod
+    def unused(cls, configs):
+        """
+        Digests of the payloads no config but the given ones points at. The payloads are
+        locked before looking, configs saved with one of them in the meantime are seen
+        """
+        digests = set()
+        for row in configs.values_list(*Config.related()):
+            digests.update(row)
+
+        list(cls.objects.select_for_update().filter(digest__in=digests).order_by('digest')
+             .values_list('digest', flat=True))
+        payloads = cls.objects.filter(digest__in=digests)
+        others = Config.objects.exclude(uuid__in=configs.values('uuid'))
+        for field in Config.related():
+            payloads = payloads.exclude(digest__in=others.values(field))
+
+        return set(payloads.values_list('digest', flat=True))
+
+
+def payload(attr):
+    """The dict of a config part, loaded together with the other parts on first use"""
+
+    def getter(self):
+        data = self.__dict__.setdefault('_payloads', {})
+        if attr not in data:
+            self.load_payloads()
+
+        return data[attr]
+
+    def setter(self, value):
+        self.__dict__.setdefault('_payloads', {})[attr] = value
+
+    return property(getter, setter)
+
 
 class Config(UuidAuditedModel):
     """
@@ -15,20 +89,76 @@ class Config(UuidAuditedModel):
 
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT)
     app = models.ForeignKey('App', on_delete=models.CASCADE)
-    values = JSONField(default={}, blank=True)
-    memory = JSONField(default={}, blank=True)
-    cpu = JSONField(default={}, blank=True)
-    tags = JSONField(default={}, blank=True)
-    registry = JSONField(default={}, blank=True)
+    values_payload = models.ForeignKey(ConfigPayload, on_delete=models.PROTECT, related_name='+')  # noqa
+    memory_payload = models.ForeignKey(ConfigPayload, on_delete=models.PROTECT, related_name='+')  # noqa
+    cpu_payload = models.ForeignKey(ConfigPayload, on_delete=models.PROTECT, related_name='+')  # noqa
+    tags_payload = models.ForeignKey(ConfigPayload, on_delete=models.PROTECT, related_name='+')  # noqa
+    registry_payload = models.ForeignKey(ConfigPayload, on_delete=models.PROTECT, related_name='+')  # noqa
+
+    values = payload('values')
+    memory = payload('memory')
+    cpu = payload('cpu')
+    tags = payload('tags')
+    registry = payload('registry')
 
     class Meta:
         get_latest_by = 'created'
         ordering = ['-created']
         unique_together = (('app', 'uuid'),)
+        # latest() of an app walks this backwards
+        index_together = (('app', 'created'),)
 
     def __str__(self):
         return "{}-{}".format(self.app.id, str(self.uuid)[:7])
 
+    @staticmethod
+    def related(prefix=''):
+        """Lookups for select_related() that fetch the payloads along with configs"""
+        return [prefix + attr + '_payload' for attr in PAYLOADS]
+
+    def digests(self):
+        """Digest of the content of every part"""
+        return {attr: getattr(self, attr + '_payload_id') for attr in PAYLOADS}
+
+    def changed(self, other):
+        """Parts that differ from another config, going by their digests only"""
+        theirs = other.digests() if other is not None else dict.fromkeys(PAYLOADS, EMPTY)
+        return {attr for attr, ours in self.digests().items() if ours != theirs[attr]}
+
+    def load_payloads(self):
+        """Fetch all parts that are neither loaded yet nor select_related in one go"""
+        data = self.__dict__.setdefault('_payloads', {})
+        missing = {}
+        for attr in PAYLOADS:
+            if attr in data:
+                continue
+
+            reference = getattr(self, attr + '_payload_id')
+            descriptor = getattr(type(self), attr + '_payload')
+            if reference is None or reference == EMPTY:
+                data[attr] = {}
+            elif descriptor.is_cached(self):
+                data[attr] = getattr(self, attr + '_payload').data
+            else:
+                missing[attr] = reference
+
+        if missing:
+            payloads = ConfigPayload.objects.in_bulk(set(missing.values()))
+            for attr, reference in missing.items():
+                data[attr] = payloads[reference].data
+
+    def store_payloads(self, known=()):
+        """Point at the payloads of the current content, storing the ones not seen before"""
+        payloads = self.__dict__.get('_payloads', {})
+        references = {attr: digest(data) for attr, data in payloads.items()}
+        # in the order garbage collection locks them in
+        for attr in sorted(references, key=references.get):
+            reference = references[attr]
+            if reference not in known and reference != getattr(self, attr + '_payload_id'):
+                ConfigPayload.store(reference, payloads[attr])
+
+            setattr(self, attr + '_payload_id', reference)
+
     def healthcheck(self):
         """
         Get all healthchecks options together for use in scheduler
@@ -118,10 +248,11 @@ class Config(UuidAuditedModel):
 
     def save(self, **kwargs):
         """merge the old config with the new"""
+        previous_config = None
         try:
             # Get config from the latest available release
             try:
-                previous_config = self.app.release_set.latest().config
+                previous_config = self.app.latest_release().config
             except Release.DoesNotExist:
                 # If that doesn't exist then fallback on app config
                 # usually means a totally new app
@@ -149,4 +280,14 @@ class Config(UuidAuditedModel):
         except Config.DoesNotExist:
             pass
 
-        return super(Config, self).save(**kwargs)
+        # parts that were never set are empty
+        for attr in PAYLOADS:
+            if getattr(self, attr + '_payload_id') is None:
+                self.__dict__.setdefault('_payloads', {}).setdefault(attr, {})
+
+        # content carried over from the previous config is stored already
+        known = previous_config.digests().values() if previous_config is not None else ()
+        # new payloads stay locked until the config pointing at them is in
+        with transaction.atomic():
+            self.store_payloads(known)
+            return super(Config, self).save(**kwargs)
@@ -22,7 +22,7 @@ class Key(UuidAuditedModel):
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     id = models.CharField(max_length=128)
     public = models.TextField(unique=True, validators=[validate_base64])
-    fingerprint = models.CharField(max_length=128, editable=False)
+    fingerprint = models.CharField(max_length=128, editable=False, db_index=True)
 
     class Meta:
         verbose_name = 'SSH Key'
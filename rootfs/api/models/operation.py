@@ -0,0 +1,159 @@
+from contextlib import contextmanager
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.utils import timezone
+from jsonfield import JSONField
+
+from api.models import UuidAuditedModel
+from api.exceptions import DeisException
+
+logger = logging.getLogger(__name__)
+
+
+class Operation(UuidAuditedModel):
+    """
+    Long running work (deploy, scale, restart, run) for an application that is
+    carried out by a worker in the background and polled for by clients.
+    Old releases are also cleaned up this way after a deploy.
+    """
+
+    TYPES = ('deploy', 'scale', 'restart', 'run', 'cleanup')
+    PENDING, RUNNING, SUCCEEDED, FAILED = 'pending', 'running', 'succeeded', 'failed'
+    STATES = (PENDING, RUNNING, SUCCEEDED, FAILED)
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT)
+    app = models.ForeignKey('App', on_delete=models.CASCADE)
+    type = models.CharField(max_length=16, choices=[(t, t) for t in TYPES])
+    params = JSONField(default={}, blank=True)
+    state = models.CharField(max_length=16, choices=[(s, s) for s in STATES],
+                             default=PENDING, db_index=True)
+    progress = models.CharField(max_length=255, blank=True)
+    result = JSONField(default={}, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=255, blank=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        get_latest_by = 'created'
+        ordering = ['-created']
+
+    def __str__(self):
+        return "{}-{}-{}".format(self.app.id, self.type, str(self.uuid)[:7])
+
+    @property
+    def done(self):
+        return self.state in [self.SUCCEEDED, self.FAILED]
+
+    @classmethod
+    def start(cls, owner, app, type, params):
+        """Queue up an operation and let the local workers know about it"""
+        operation = cls.objects.create(
+            owner=owner, app=app, type=type, params=params,
+            progress='waiting for a worker'
+        )
+        app.log('{} queued by {}'.format(operation, owner.username))
+
+        # avoid a circular import, workers need the models
+        from api import workers
+        transaction.on_commit(workers.wake)
+
+        return operation
+
+    def claim(self, worker):
+        """
+        Atomically move a pending operation to running. Only one worker can win
+        the conditional update, everyone else gets False back
+        """
+        now = timezone.now()
+        claimed = Operation.objects.filter(uuid=self.uuid, state=self.PENDING).update(
+            state=self.RUNNING, worker=worker, started=now, updated=now,
+            progress='running {}'.format(self.type)
+        )
+        if claimed:
+            self.refresh_from_db()
+
+        return bool(claimed)
+
+    def execute(self):
+        """Carry out a claimed operation and record how it went"""
+        try:
+            with self._heartbeat():
+                result = getattr(self, '_{}'.format(self.type))(**self.params)
+        except Exception as e:
+            self.app.log('{} failed: {}'.format(self, e), logging.ERROR)
+            self._finish(self.FAILED, error=str(e))
+        else:
+            self._finish(self.SUCCEEDED, result=result or {})
+
+    @contextmanager
+    def _heartbeat(self):
+        """
+        Touch the operation every DEIS_OPERATION_HEARTBEAT_INTERVAL while it runs, so it
+        is not taken for one whose worker went away however long it takes
+        """
+        stop = threading.Event()
+
+        def beat():
+            try:
+                while not stop.wait(settings.DEIS_OPERATION_HEARTBEAT_INTERVAL):
+                    try:
+                        Operation.objects.filter(uuid=self.uuid, state=self.RUNNING).update(
+                            updated=timezone.now()
+                        )
+                    except Exception as e:
+                        logger.warning('could not touch operation {}: {}'.format(self.uuid, e))
+            finally:
+                # the thread has a database connection of its own
+                connection.close()
+
+        thread = threading.Thread(target=beat, name='operation-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def _finish(self, state, result=None, error=''):
+        self.state = state
+        self.result = result or {}
+        self.error = error
+        self.progress = state
+        self.finished = timezone.now()
+        self.save()
+
+    def _deploy(self, release, build=None):
+        release = self.app.release_set.get(uuid=release)
+        try:
+            self.app.deploy(release)
+        except Exception as e:
+            release.delete()
+            if build is not None:
+                self.app.build_set.filter(uuid=build).delete()
+
+            raise DeisException(str(e)) from e
+
+        return {'release': {'version': release.version}}
+
+    def _scale(self, structure):
+        self.app.scale(self.owner, structure)
+
+    def _restart(self, **kwargs):
+        return {'pods': self.app.restart(id=self.app.id, **kwargs)}
+
+    def _run(self, command, name=None):
+        # no API worker is waiting on this one
+        exit_code, output = self.app.run(self.owner, command, name=name,
+                                         timeout=settings.DEIS_RUN_DETACHED_TIMEOUT)
+        return {'exit_code': exit_code, 'output': str(output)}
+
+    def _cleanup(self, release):
+        release = self.app.release_set.filter(uuid=release).first()
+        # the release went away in the meantime, taking its RCs with it
+        if release is not None:
+            with release.traced('cleanup_old'):
+                release.cleanup_old()
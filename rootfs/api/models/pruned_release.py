@@ -0,0 +1,40 @@
+from django.db import models
+
+from api.models import UuidAuditedModel, JSONField
+
+
+class PrunedRelease(UuidAuditedModel):
+    """
+    What is left of a :class:`Release` once release garbage collection removed it,
+    enough to tell who released what and when. The config is kept as the digests of
+    its payloads, created is when the release was pruned.
+    """
+
+    app = models.ForeignKey('App', on_delete=models.CASCADE)
+    version = models.PositiveIntegerField()
+    summary = models.TextField(blank=True, null=True)
+    # the username, users can go away before their releases do
+    owner = models.CharField(max_length=150)
+    released = models.DateTimeField()
+    image = models.TextField(blank=True)
+    sha = models.CharField(max_length=40, blank=True)
+    config = JSONField(default=dict, blank=True)
+
+    class Meta:
+        ordering = ['-version']
+        unique_together = (('app', 'version'),)
+
+    def __str__(self):
+        return "{0}-v{1}".format(self.app.id, self.version)
+
+    @classmethod
+    def of(cls, release):
+        """An unsaved record of a release, its owner, build and config loaded along"""
+        build = release.build
+        return cls(
+            app_id=release.app_id, version=release.version, summary=release.summary,
+            owner=release.owner.username, released=release.created,
+            image=build.image if build is not None else '',
+            sha=build.sha if build is not None else '',
+            config=release.config.digests(),
+        )
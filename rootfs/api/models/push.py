@@ -23,6 +23,8 @@ class Push(UuidAuditedModel):
         get_latest_by = 'created'
         ordering = ['-created']
         unique_together = (('app', 'uuid'),)
+        # latest() of an app walks this backwards
+        index_together = (('app', 'created'),)
 
     def __str__(self):
         return "{0}-{1}".format(self.app.id, self.sha[:7])
@@ -1,16 +1,35 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import json
 import logging
 
 from django.conf import settings
 from django.db import models
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
 
+from deis import clock, trace
 from registry import publish_release, get_port as docker_get_port, RegistryException
 from api.utils import dict_diff
-from api.models import UuidAuditedModel
+from api.models import JSONField, UuidAuditedModel
 from api.exceptions import DeisException, AlreadyExists
 from scheduler import KubeHTTPException
 
 logger = logging.getLogger(__name__)
 
+# span trees kept per release, scales of the latest release keep adding them
+TRACES = 20
+
+# append to the stored list and keep the last TRACES in one statement, so operations
+# recording at the same time do not overwrite each other
+APPEND_TRACE_SQL = """
+SELECT COALESCE(jsonb_agg(item ORDER BY position), '[]'::jsonb) FROM (
+    SELECT item, position
+    FROM jsonb_array_elements(traces || %s::jsonb) WITH ORDINALITY AS t(item, position)
+    ORDER BY position DESC LIMIT %s
+) AS kept
+"""
+
 
 class Release(UuidAuditedModel):
     """
@@ -26,11 +45,15 @@ class Release(UuidAuditedModel):
 
     config = models.ForeignKey('Config', on_delete=models.CASCADE)
     build = models.ForeignKey('Build', null=True, on_delete=models.CASCADE)
+    # span trees of the deploys, scales and rollbacks of this release, oldest first
+    traces = JSONField(default=list, blank=True)
 
     class Meta:
         get_latest_by = 'created'
         ordering = ['-created']
         unique_together = (('app', 'version'),)
+        # latest() of an app walks this backwards
+        index_together = (('app', 'created'),)
 
     def __str__(self):
         return "{0}-v{1}".format(self.app.id, self.version)
@@ -64,6 +87,10 @@ class Release(UuidAuditedModel):
             return '{}/{}:git-{}'.format(settings.REGISTRY_URL, self.app.id, str(self.build.sha))
         elif self.build.type == 'image':
             # Deis Pull, docker image in local registry
+            if self.build.image_digest:
+                # published by an earlier release of the same build, which is reused
+                return '{}/{}@{}'.format(settings.REGISTRY_URL, self.app.id, self.build.image_digest)  # noqa
+
             return '{}/{}:v{}'.format(settings.REGISTRY_URL, self.app.id, str(self.version))
         elif self.build.type == 'buildpack':
             # Build Pack - Registry URL not prepended since slugrunner image will download slug
@@ -85,7 +112,8 @@ class Release(UuidAuditedModel):
         )
 
         try:
-            release.publish()
+            with release.traced('publish'):
+                release.publish()
         except DeisException as e:
             # If we cannot publish this app, just log and carry on
             self.app.log(e)
@@ -125,6 +153,11 @@ class Release(UuidAuditedModel):
             self.app.log('{} exists in the target registry. Using image for release {} of app {}'.format(self.build.image, self.version, self.app))  # noqa
             return
 
+        # published for an earlier release of the same build, the registry has it already
+        if self.build.image_digest:
+            self.app.log('{} exists in the target registry as {}. Using image for release {} of app {}'.format(self.build.image, self.build.image_digest, self.version, self.app))  # noqa
+            return
+
         # add tag if it was not provided
         source_image = self.build.image
         if ':' not in source_image:
@@ -132,8 +165,11 @@ class Release(UuidAuditedModel):
 
         # if build is source based then it was pushed into the deis registry
         deis_registry = bool(self.build.source_based)
-        publish_release(source_image, self.image, deis_registry, self.get_registry_auth())
+        image = publish_release(source_image, self.image, deis_registry, self.get_registry_auth())  # noqa
+        if image:
+            self.build.record_image(**image)
 
+    @trace.traced('get_port', 'routable')
     def get_port(self, routable=False):
         """
         Get application port for a given release. If pulling from private registry
@@ -167,6 +203,10 @@ class Release(UuidAuditedModel):
             if envs.get('PORT', None):
                 return envs.get('PORT')
 
+            # recorded when the image was published or first inspected
+            if self.build.ports:
+                return self.build.ports[0]
+
             # discover port from docker image
             port = docker_get_port(self.image, deis_registry, creds)
             if port is None:
@@ -174,6 +214,7 @@ class Release(UuidAuditedModel):
                 self.app.log(msg, logging.ERROR)
                 raise DeisException(msg)
 
+            self.build.record_image(ports=[port])
             return port
         except Exception as e:
             raise DeisException(str(e)) from e
@@ -211,29 +252,60 @@ class Release(UuidAuditedModel):
         return prev_release
 
     def rollback(self, user, version=None):
+        with trace.start('rollback') as span:
+            try:
+                # if no version is provided then grab version from object
+                version = (self.version - 1) if version is None else int(version)
+
+                if version < 1:
+                    raise DeisException('version cannot be below 0')
+
+                span.attributes['version'] = version
+                prev = self.app.release_set.get(version=version)
+                new_release = self.new(
+                    user,
+                    build=prev.build,
+                    config=prev.config,
+                    summary="{} rolled back to v{}".format(user, version),
+                    source_version='v{}'.format(version)
+                )
+
+                if self.build is not None:
+                    self.app.deploy(new_release)
+            except Exception as e:
+                if 'new_release' in locals():
+                    new_release.delete()
+                raise DeisException(str(e)) from e
+
+        # a failed rollback takes its release along, only a successful one is kept
+        if span.parent is None:
+            new_release.add_trace(span)
+        return new_release
+
+    @contextmanager
+    def traced(self, name, attributes=None):
+        """
+        Trace an operation on this release. Inside a running trace this is one more
+        span, otherwise the span tree is stored with the release once it is done
+        """
+        span = None
         try:
-            # if no version is provided then grab version from object
-            version = (self.version - 1) if version is None else int(version)
-
-            if version < 1:
-                raise DeisException('version cannot be below 0')
-
-            prev = self.app.release_set.get(version=version)
-            new_release = self.new(
-                user,
-                build=prev.build,
-                config=prev.config,
-                summary="{} rolled back to v{}".format(user, version),
-                source_version='v{}'.format(version)
-            )
+            with trace.start(name, attributes) as span:
+                yield span
+        finally:
+            if span is not None and span.parent is None:
+                self.add_trace(span)
 
-            if self.build is not None:
-                self.app.deploy(new_release)
-            return new_release
+    def add_trace(self, span):
+        """Store the span tree of an operation, keeping the most recent TRACES"""
+        try:
+            data = json.dumps([span.as_dict()], ensure_ascii=False)
+            Release.objects.filter(pk=self.pk).update(
+                traces=RawSQL(APPEND_TRACE_SQL, (data, TRACES))
+            )
         except Exception as e:
-            if 'new_release' in locals():
-                new_release.delete()
-            raise DeisException(str(e)) from e
+            # losing a trace must not fail the operation it is about
+            logger.warning('could not store trace {} of {}: {}'.format(span.name, self, e))
 
     def delete(self, *args, **kwargs):
         """Delete release DB record and any RCs from the affect release"""
@@ -250,40 +322,56 @@ class Release(UuidAuditedModel):
             super(Release, self).delete(*args, **kwargs)
 
     def cleanup_old(self):
-        """Cleanup all but the latest release from Kubernetes"""
-        latest_version = 'v{}'.format(self.version)
+        """
+        Cleanup all releases older than this one from Kubernetes
+
+        :return: how many Kubernetes objects were removed
+        """
+        removed = 0
         self.app.log(
-            'Cleaning up RCS for releases older than {} (latest)'.format(latest_version),
+            'Cleaning up RCS for releases older than v{} (latest)'.format(self.version),
             level=logging.DEBUG
         )
 
-        # Cleanup controllers
+        # Find the versions that still have controllers or pods around. Newer versions
+        # are left alone, a deploy of those could be in progress
         labels = {
             'heritage': 'deis'
         }
-        controller_removal = []
-        controllers = self._scheduler.get_rcs(self.app.id, labels=labels).json()
-        for controller in controllers['items']:
-            current_version = controller['metadata']['labels']['version']
-            # skip the latest release
-            if current_version == latest_version:
-                continue
+        items = self._scheduler.get_rcs(self.app.id, labels=labels).json()['items']
+        pods = self._scheduler.get_pods(self.app.id, labels=labels).json()['items']
+        items += [pod for pod in pods if not self._scheduler.pod_deleted(pod)]
 
-            # aggregate versions together to removal all at once
-            if current_version not in controller_removal:
-                controller_removal.append(current_version)
+        versions = set()
+        for item in items:
+            version = item['metadata']['labels'].get('version', '').lstrip('v')
+            if version.isdigit() and int(version) < self.version:
+                versions.add(int(version))
 
-        if controller_removal:
+        if versions:
             self.app.log(
-                'Found the following versions to cleanup: {}'.format(', '.join(controller_removal)),  # noqa
+                'Found the following versions to cleanup: {}'.format(', '.join('v{}'.format(v) for v in sorted(versions))),  # noqa
                 level=logging.DEBUG
             )
 
-        for version in controller_removal:
-            self._delete_release_in_scheduler(self.app.id, version)
-
-        # find stray env secrets to remove that may have been missed
+            # versions do not depend on each other, tear them down side by side
+            workers = min(settings.KUBERNETES_CLEANUP_CONCURRENCY, len(versions))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [
+                    executor.submit(self._delete_release_in_scheduler, self.app.id, version)
+                    for version in versions
+                ]
+                for future in futures:
+                    removed += future.result()
+
+        # env secrets are shared between releases, remove the ones nothing refers to anymore
         self.app.log('Cleaning up orphaned environment var secrets', level=logging.DEBUG)
+        # a deploy of a newer release creates its secret before the controllers that
+        # refer to it, so secrets younger than this release are left alone. Objects are
+        # stamped on the scheduler clock, which the age of the release is measured back on
+        cutoff = clock.utcnow() - (timezone.now() - self.created)
+        cutoff = cutoff.strftime(settings.DEIS_DATETIME_FORMAT)
+        in_use = self._env_secrets_in_use()
         labels = {
             'heritage': 'deis',
             'app': self.app.id,
@@ -291,52 +379,74 @@ class Release(UuidAuditedModel):
         }
         secrets = self._scheduler.get_secrets(self.app.id, labels=labels).json()
         for secret in secrets['items']:
-            current_version = secret['metadata']['labels']['version']
-            # skip the latest release
-            if current_version == latest_version:
+            if secret['metadata']['name'] in in_use:
+                continue
+
+            # timestamps of the same format compare as strings
+            if secret['metadata'].get('creationTimestamp', '') >= cutoff:
                 continue
 
             self._scheduler.delete_secret(self.app.id, secret['metadata']['name'])
+            removed += 1
 
-        # Remove stray pods
+        return removed
+
+    def _env_secrets_in_use(self):
+        """Names of the env secrets referenced by the controllers and pods of the app"""
         labels = {
             'heritage': 'deis'
         }
+        templates = []
+        controllers = self._scheduler.get_rcs(self.app.id, labels=labels).json()['items']
+        if settings.KUBERNETES_DEPLOYMENTS:
+            controllers += self._scheduler.get_deployments(self.app.id, labels=labels).json()['items']  # noqa
+        for controller in controllers:
+            templates.append(controller['spec']['template']['spec'])
+
         pods = self._scheduler.get_pods(self.app.id, labels=labels).json()
         for pod in pods['items']:
-            if self._scheduler.pod_deleted(pod):
-                continue
+            if not self._scheduler.pod_deleted(pod):
+                templates.append(pod['spec'])
 
-            current_version = pod['metadata']['labels']['version']
-            # skip the latest release
-            if current_version == latest_version:
-                continue
+        in_use = set()
+        for spec in templates:
+            for container in spec.get('containers', []):
+                for env in container.get('env', []):
+                    secret = env.get('valueFrom', {}).get('secretKeyRef', {})
+                    if 'name' in secret:
+                        in_use.add(secret['name'])
 
-            self._scheduler.delete_pod(self.app.id, pod['metadata']['name'])
+        return in_use
 
     def _delete_release_in_scheduler(self, namespace, version):
         """
         Deletes a specific release in k8s
 
-        Scale RCs to 0 then delete RCs and the version specific
-        secret that container the env var
+        Delete the RCs and then their pods with one request each, k8s takes care of
+        the graceful termination of the pods. Also removes the version specific
+        secret that contained the env vars
         """
         labels = {
             'heritage': 'deis',
             'app': namespace,
             'version': 'v{}'.format(version)
         }
-        controllers = self._scheduler.get_rcs(namespace, labels=labels).json()
-        for controller in controllers['items']:
-            self._scheduler.cleanup_release(namespace, controller)
+        # RCs go first so they do not bring the pods back
+        removed = 0
+        for delete in [self._scheduler.delete_rcs, self._scheduler.delete_pods]:
+            removed += len(delete(namespace, labels).json().get('items', []))
 
-        # remove secret that contains env vars for the release
+        # remove the secret that contains env vars for releases from before env secrets
+        # were shared, shared ones are removed by cleanup_old once nothing refers to them
         try:
-            secret_name = "{}-{}-env".format(namespace, version)
+            secret_name = "{}-v{}-env".format(namespace, version)
             self._scheduler.delete_secret(namespace, secret_name)
+            removed += 1
         except KubeHTTPException:
             pass
 
+        return removed
+
     def save(self, *args, **kwargs):  # noqa
         if not self.summary:
             self.summary = ''
@@ -355,10 +465,15 @@ class Release(UuidAuditedModel):
 
             # if the config data changed, log the dict diff
             if self.config != old_config:
+                # only parts whose digests differ need a dict diff
+                parts = self.config.changed(old_config)
+
                 # if env vars change, log the dict diff
-                dict1 = self.config.values
-                dict2 = old_config.values if old_config else {}
-                diff = dict_diff(dict1, dict2)
+                diff = {}
+                if 'values' in parts:
+                    dict1 = self.config.values
+                    dict2 = old_config.values if old_config else {}
+                    diff = dict_diff(dict1, dict2)
                 # try to be as succinct as possible
                 added = ', '.join(k for k in diff.get('added', {}))
                 added = 'added ' + added if added else ''
@@ -373,23 +488,16 @@ class Release(UuidAuditedModel):
                     self.summary += "{} {}".format(self.config.owner, changes)
 
                 # if the limits changed (memory or cpu), log the dict diff
-                changes = []
-                old_mem = old_config.memory if old_config else {}
-                diff = dict_diff(self.config.memory, old_mem)
-                if diff.get('added') or diff.get('changed') or diff.get('deleted'):
-                    changes.append('memory')
-                old_cpu = old_config.cpu if old_config else {}
-                diff = dict_diff(self.config.cpu, old_cpu)
-                if diff.get('added') or diff.get('changed') or diff.get('deleted'):
-                    changes.append('cpu')
+                changes = [a for a in ['memory', 'cpu'] if a in parts]
                 if changes:
                     changes = 'changed limits for '+', '.join(changes)
                     self.summary += "{} {}".format(self.config.owner, changes)
 
                 # if the tags changed, log the dict diff
-                changes = []
-                old_tags = old_config.tags if old_config else {}
-                diff = dict_diff(self.config.tags, old_tags)
+                diff = {}
+                if 'tags' in parts:
+                    old_tags = old_config.tags if old_config else {}
+                    diff = dict_diff(self.config.tags, old_tags)
                 # try to be as succinct as possible
                 added = ', '.join(k for k in diff.get('added', {}))
                 added = 'added tag ' + added if added else ''
@@ -404,9 +512,10 @@ class Release(UuidAuditedModel):
                     self.summary += "{} {}".format(self.config.owner, changes)
 
                 # if the registry information changed, log the dict diff
-                changes = []
-                old_registry = old_config.registry if old_config else {}
-                diff = dict_diff(self.config.registry, old_registry)
+                diff = {}
+                if 'registry' in parts:
+                    old_registry = old_config.registry if old_config else {}
+                    diff = dict_diff(self.config.registry, old_registry)
                 # try to be as succinct as possible
                 added = ', '.join(k for k in diff.get('added', {}))
                 added = 'added registry info ' + added if added else ''
@@ -0,0 +1,163 @@
+"""
+Garbage collection of release history.
+
+Every release keeps its own config and build around. Releases are kept while they
+are among the newest ``DEIS_RELEASE_RETENTION_COUNT`` of an application or younger
+than ``DEIS_RELEASE_RETENTION_DAYS``, the current release is always kept. Both can
+be overwritten per application via config. A :class:`PrunedRelease` record is kept
+of every release that is removed.
+"""
+from datetime import timedelta
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api.models import App, Build, Config, ConfigPayload, PrunedRelease, Release
+from scheduler import KubeHTTPException
+
+logger = logging.getLogger(__name__)
+
+# pg_try_advisory_lock key making sure only one controller process collects at a time
+LOCK_ID = 0x64656973
+
+
+def policy(app, keep=None, days=None):
+    """Retention of an application: command line, then app config, then the global setting"""
+    try:
+        values = app.release_set.latest().config.values
+    except Release.DoesNotExist:
+        values = {}
+
+    def limit(value, name):
+        if value is not None:
+            return value
+
+        try:
+            return int(values.get(name, getattr(settings, name)))
+        except (TypeError, ValueError):
+            return getattr(settings, name)
+
+    return (
+        limit(keep, 'DEIS_RELEASE_RETENTION_COUNT'),
+        limit(days, 'DEIS_RELEASE_RETENTION_DAYS')
+    )
+
+
+def expired(app, keep, days):
+    """Releases of an application that fall outside of the retention, oldest first"""
+    if not keep and not days:
+        return []
+
+    # never the current release
+    releases = app.release_set.select_related('owner', 'build', 'config') \
+        .order_by('-version')[max(keep, 1):]
+    if days:
+        cutoff = timezone.now() - timedelta(days=days)
+        releases = [r for r in releases if r.created < cutoff]
+
+    return sorted(releases, key=lambda r: r.version)
+
+
+def collect(app, keep=None, days=None, dry_run=False):
+    """
+    Remove the releases of an application that are past retention together with the
+    configs and builds only they used, keeping a :class:`PrunedRelease` of each, then
+    remove whatever Kubernetes still runs for releases older than the current one
+
+    :return: a report of how many rows and Kubernetes objects were reclaimed
+    """
+    keep, days = policy(app, keep, days)
+    releases = expired(app, keep, days)
+    report = {'releases': len(releases), 'configs': 0, 'payloads': 0, 'builds': 0, 'objects': 0}
+    if not releases:
+        return report
+
+    with transaction.atomic():
+        expired_ids = [r.uuid for r in releases]
+        remaining = Release.objects.filter(app=app).exclude(uuid__in=expired_ids)
+        configs = Config.objects.filter(app=app) \
+            .exclude(uuid__in=remaining.values('config')) \
+            .exclude(uuid=app.config_set.latest().uuid)
+        builds = Build.objects.filter(app=app) \
+            .exclude(uuid__in=remaining.exclude(build=None).values('build'))
+        if app.build_set.exists():
+            builds = builds.exclude(uuid=app.build_set.latest().uuid)
+
+        # config content other apps or newer configs share stays around
+        payloads = ConfigPayload.unused(configs)
+
+        report['configs'] = configs.count()
+        report['payloads'] = len(payloads)
+        report['builds'] = builds.count()
+        if dry_run:
+            return report
+
+        # who released what and when outlives the releases
+        PrunedRelease.objects.bulk_create([PrunedRelease.of(r) for r in releases])
+
+        # in bulk, Release.delete() would talk to Kubernetes once per release
+        Release.objects.filter(uuid__in=expired_ids).delete()
+        configs.delete()
+        ConfigPayload.objects.filter(digest__in=payloads).delete()
+        builds.delete()
+
+    # keep a trace of what went away in the application log
+    app.log('pruned releases v{}..v{} ({} releases, {} configs, {} builds), keeping {} releases or {} days'.format(  # noqa
+        releases[0].version, releases[-1].version, report['releases'],
+        report['configs'], report['builds'], keep or 'all', days or 'all'
+    ))
+    for release in releases:
+        app.log('pruned v{}: {}'.format(release.version, release.summary), logging.DEBUG)
+
+    # stray RCs, pods and secrets of releases that are gone, all in a few requests
+    current = app.release_set.latest()
+    if current.build is not None:
+        try:
+            report['objects'] = current.cleanup_old()
+        except KubeHTTPException as e:
+            logger.warning('could not clean up Kubernetes objects of {}: {}'.format(app, e))
+
+    return report
+
+
+def collect_all(apps=None, keep=None, days=None, dry_run=False):
+    """Garbage collect the release history of all (or the given) applications"""
+    apps = App.objects.all() if apps is None else apps
+    total = {'apps': 0, 'releases': 0, 'configs': 0, 'payloads': 0, 'builds': 0, 'objects': 0}
+    for app in apps:
+        try:
+            report = collect(app, keep, days, dry_run)
+        except Exception as e:
+            # one broken app should not keep the others from being collected
+            logger.error('release garbage collection of {} failed: {}'.format(app, e))
+            continue
+
+        if report['releases']:
+            total['apps'] += 1
+
+        for key, value in report.items():
+            total[key] += value
+
+    return total
+
+
+def collect_exclusively(**kwargs):
+    """
+    Run :func:`collect_all` unless another controller process already is
+
+    Returns None when the lock was taken
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_try_advisory_lock(%s)', [LOCK_ID])
+        if not cursor.fetchone()[0]:
+            return None
+
+    try:
+        report = collect_all(**kwargs)
+        logger.info('release garbage collection reclaimed {}'.format(report))
+        return report
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [LOCK_ID])
@@ -132,6 +132,7 @@ class ConfigSerializer(serializers.ModelSerializer):
     class Meta:
         """Metadata options for a :class:`ConfigSerializer`."""
         model = models.Config
+        exclude = models.Config.related()
 
     def validate_values(self, data):
         for key, value in data.items():
@@ -262,6 +263,23 @@ class ReleaseSerializer(serializers.ModelSerializer):
     class Meta:
         """Metadata options for a :class:`ReleaseSerializer`."""
         model = models.Release
+        # served on their own, see ReleaseViewSet.trace
+        exclude = ['traces']
+
+
+class OperationSerializer(serializers.ModelSerializer):
+    """Serialize a :class:`~api.models.Operation` model."""
+
+    app = serializers.SlugRelatedField(slug_field='id', queryset=models.App.objects.all())
+    owner = serializers.ReadOnlyField(source='owner.username')
+    params = serializers.JSONField(read_only=True)
+    result = serializers.JSONField(read_only=True)
+
+    class Meta:
+        """Metadata options for a :class:`OperationSerializer`."""
+        model = models.Operation
+        exclude = ['worker']
+        read_only_fields = ['type', 'state', 'progress', 'error', 'started', 'finished']
 
 
 class KeySerializer(serializers.ModelSerializer):
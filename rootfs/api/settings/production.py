@@ -259,14 +259,103 @@ DOCKER_BUILDER_IMAGE_PULL_POLICY = os.environ.get('DOCKER_BUILDER_IMAGE_PULL_POL
 # Can also be overwritten on per app basis if desired
 DEIS_DEPLOY_BATCHES = os.environ.get('DEIS_DEPLOY_BATCHES', None)
 
+# How many non-routable process types (worker, clock, ...) get rolled out at the same time
+# once the routable process types are healthy during a deploy
+# Defaults to 1, one process type after another
+# Can also be overwritten on per app basis if desired
+DEIS_DEPLOY_PROCESS_CONCURRENCY = os.environ.get('DEIS_DEPLOY_PROCESS_CONCURRENCY', 1)
+
+# Number of threads per controller process carrying out operations (deploy, scale, restart
+# and run) that clients asked to happen in the background via "Prefer: respond-async"
+# 0 turns the local workers off
+DEIS_OPERATION_WORKERS = int(os.environ.get('DEIS_OPERATION_WORKERS', 2))
+
+# How often idle workers look for operations queued up by other controller processes
+DEIS_OPERATION_POLL_INTERVAL = int(os.environ.get('DEIS_OPERATION_POLL_INTERVAL', 5))
+
+# Running operations that have not been updated for this long are considered abandoned
+DEIS_OPERATION_EXPIRY_SECONDS = int(os.environ.get('DEIS_OPERATION_EXPIRY_SECONDS', 3600))
+
+# How often a worker touches the operation it carries out, well within the expiry above
+DEIS_OPERATION_HEARTBEAT_INTERVAL = int(os.environ.get('DEIS_OPERATION_HEARTBEAT_INTERVAL', 60))  # noqa
+
+# Upper limit for how long a client can long-poll an operation via ?wait=
+DEIS_OPERATION_MAX_WAIT = int(os.environ.get('DEIS_OPERATION_MAX_WAIT', 30))
+
+# How long a one-off command (deis run) may take once its pod is up. Commands run in the
+# background via "Prefer: respond-async" do not hold up an API worker and get longer
+DEIS_RUN_TIMEOUT = int(os.environ.get('DEIS_RUN_TIMEOUT', 1200))
+DEIS_RUN_DETACHED_TIMEOUT = int(os.environ.get('DEIS_RUN_DETACHED_TIMEOUT', 14400))
+
+# Output of a one-off command kept for the response, only the last bytes are kept beyond
+# that. Streamed output (stream=true) is not limited
+DEIS_RUN_OUTPUT_LIMIT = int(os.environ.get('DEIS_RUN_OUTPUT_LIMIT', 1048576))
+
+# Release history kept per app, can also be overwritten on a per app basis. Releases are
+# kept while they are among the newest COUNT or younger than DAYS, the current release
+# always is. 0 turns a limit off, with both off all releases are kept
+DEIS_RELEASE_RETENTION_COUNT = int(os.environ.get('DEIS_RELEASE_RETENTION_COUNT', 0))
+DEIS_RELEASE_RETENTION_DAYS = int(os.environ.get('DEIS_RELEASE_RETENTION_DAYS', 0))
+
+# How often the operation workers garbage collect release history, 0 turns it off
+DEIS_RELEASE_GC_INTERVAL = int(os.environ.get('DEIS_RELEASE_GC_INTERVAL', 3600))
+
+# Roll out releases with Kubernetes Deployments (extensions/v1beta1) and let the cluster
+# do the batching instead of scaling ReplicationControllers from the controller
+# Process types still run by a ReplicationController are moved over on their next deploy
+KUBERNETES_DEPLOYMENTS = os.environ.get('KUBERNETES_DEPLOYMENTS', 'false').lower() == 'true'  # noqa
+
+# How many old releases are torn down at once after a deploy
+KUBERNETES_CLEANUP_CONCURRENCY = int(os.environ.get('KUBERNETES_CLEANUP_CONCURRENCY', 4))  # noqa
+
 # How long k8s waits for a pod to finish work after a SIGTERM before sending SIGKILL
 KUBERNETES_POD_TERMINATION_GRACE_PERIOD_SECONDS = int(os.environ.get('KUBERNETES_POD_TERMINATION_GRACE_PERIOD_SECONDS', 30))  # noqa
 
+# Follow pod and RC changes via the Kubernetes watch API instead of polling once a second
+# Polling is still used when a watch can not be established
+KUBERNETES_WATCH_ENABLED = os.environ.get('KUBERNETES_WATCH_ENABLED', 'true').lower() == 'true'  # noqa
+
+# How long a single watch request is kept open before it is resumed
+KUBERNETES_WATCH_TIMEOUT_SECONDS = int(os.environ.get('KUBERNETES_WATCH_TIMEOUT_SECONDS', 5))  # noqa
+
+# Serve pod, RC, secret and service reads from an in-process cache that is kept up to date
+# via the watch API. Reads go to the API server while the cache is catching up
+KUBERNETES_INFORMERS_ENABLED = os.environ.get('KUBERNETES_INFORMERS_ENABLED', 'false').lower() == 'true'  # noqa
+
+# How long the cache may go without hearing from the API server before reads bypass it
+KUBERNETES_INFORMER_MAX_STALENESS = int(os.environ.get('KUBERNETES_INFORMER_MAX_STALENESS', 30))  # noqa
+
+# Stop following a Namespace when nothing has been read from it for this long
+KUBERNETES_INFORMER_IDLE_SECONDS = int(os.environ.get('KUBERNETES_INFORMER_IDLE_SECONDS', 600))  # noqa
+
+# Size of the connection pool shared by all threads talking to the Kubernetes API server
+KUBERNETES_CLIENT_POOL_CONNECTIONS = int(os.environ.get('KUBERNETES_CLIENT_POOL_CONNECTIONS', 10))  # noqa
+KUBERNETES_CLIENT_POOL_MAXSIZE = int(os.environ.get('KUBERNETES_CLIENT_POOL_MAXSIZE', 20))  # noqa
+
+# Every gunicorn worker writes its metrics here, /metrics adds them all up
+# Empty keeps metrics to the process serving /metrics
+DEIS_METRICS_DIR = os.environ.get('DEIS_METRICS_DIR', '/tmp/deis-metrics')
+# How often a worker writes its metrics at most
+DEIS_METRICS_FLUSH_INTERVAL = int(os.environ.get('DEIS_METRICS_FLUSH_INTERVAL', 5))
+
 # registry settings
 REGISTRY_HOST = os.environ.get('DEIS_REGISTRY_SERVICE_HOST', '127.0.0.1')
 REGISTRY_PORT = os.environ.get('DEIS_REGISTRY_SERVICE_PORT', 5000)
 REGISTRY_URL = '{}:{}'.format(REGISTRY_HOST, REGISTRY_PORT)
 
+# Read image metadata (e.g. exposed ports) and publish images via the Docker Registry HTTP
+# API v2 instead of going through the local Docker daemon, which is still used as a fallback
+REGISTRY_API_ENABLED = os.environ.get('REGISTRY_API_ENABLED', 'true').lower() == 'true'  # noqa
+REGISTRY_API_TIMEOUT = int(os.environ.get('REGISTRY_API_TIMEOUT', 10))
+
+# How many blobs are copied at once when publishing an image via the registry API and how
+# long a single blob transfer may take
+REGISTRY_PUBLISH_CONCURRENCY = int(os.environ.get('REGISTRY_PUBLISH_CONCURRENCY', 4))
+REGISTRY_PUBLISH_TIMEOUT = int(os.environ.get('REGISTRY_PUBLISH_TIMEOUT', 1200))
+
+# How many different images the Docker daemon of the controller pulls at once
+DOCKER_PULL_CONCURRENCY = int(os.environ.get('DOCKER_PULL_CONCURRENCY', 3))
+
 # logger settings
 LOGGER_HOST = os.environ.get('DEIS_LOGGER_SERVICE_HOST', '127.0.0.1')
 LOGGER_PORT = os.environ.get('DEIS_LOGGER_SERVICE_PORT_HTTP', 80)
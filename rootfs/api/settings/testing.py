@@ -34,3 +34,9 @@ CACHES = {
 
 # How long k8s waits for a pod to finish work after a SIGTERM before sending SIGKILL
 KUBERNETES_POD_TERMINATION_GRACE_PERIOD_SECONDS = int(os.environ.get('KUBERNETES_POD_TERMINATION_GRACE_PERIOD_SECONDS', 2))  # noqa
+
+# operations are carried out by the tests themselves
+DEIS_OPERATION_WORKERS = 0
+
+# metrics stay in the test process
+DEIS_METRICS_DIR = ''
@@ -1,11 +1,12 @@
 import logging
 import random
 import requests_mock
-import time
 
 from django.conf import settings
 from django.test.runner import DiscoverRunner
 
+from deis import clock
+
 
 def mock_port(*args, **kwargs):
     return 5000
@@ -29,8 +30,8 @@ def fake_responses(request, context):
 
     context.status_code = response['status_code']
     context.reason = response['text']
-    # Random float x, 1.0 <= x < 4.0 for some sleep jitter
-    time.sleep(random.uniform(1, 4))
+    # Random float x, 1.0 <= x < 4.0 for some sleep jitter, on the virtual clock
+    clock.sleep(random.uniform(1, 4))
     return response['text']
 
 url = 'http://{}:{}'.format(settings.ROUTER_HOST, settings.ROUTER_PORT)
@@ -47,5 +48,9 @@ class SilentDjangoTestSuiteRunner(DiscoverRunner):
         """Run tests with all but critical log messages disabled."""
         # hide any log messages less than critical
         logging.disable(logging.ERROR)
+        # waits on the mock scheduler and router take no time and pods, jitter and
+        # router responses come out the same on every run
+        clock.install(clock.VirtualClock())
+        random.seed(0)
         return super(SilentDjangoTestSuiteRunner, self).run_tests(
             test_labels, extra_tests, **kwargs)
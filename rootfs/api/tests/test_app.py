@@ -3,18 +3,25 @@ Unit tests for the Deis api app.
 
 Run the tests with "./manage.py test api"
 """
+from io import StringIO
+import json
 import logging
+import os
+import tempfile
 from unittest import mock
 import requests
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import override_settings
 from rest_framework.test import APITestCase
 from rest_framework.authtoken.models import Token
 
-from api.models import App
-from scheduler import KubeException
+from api.models import App, Config, Operation
+from scheduler import KubeException, get_scheduler
 
 from . import adapter
 from . import mock_port
@@ -304,6 +311,67 @@ class AppTest(APITestCase):
             response = self.client.post(url, body)
             self.assertEqual(response.status_code, 503, response.data)
 
+    @mock.patch('api.models.App.deploy', mock_none)
+    @mock.patch('api.models.Release.publish', mock_none)
+    def test_run_stream(self, mock_requests):
+        """Output of a one-off command can be streamed while it runs"""
+        app_id = 'autotest'
+        response = self.client.post('/v2/apps', {'id': app_id})
+        url = '/v2/apps/{app_id}/builds'.format(**locals())
+        response = self.client.post(url, {'image': 'autotest/example'})
+        self.assertEqual(response.status_code, 201, response.data)
+
+        url = '/v2/apps/{}/run'.format(app_id)
+        response = self.client.post(url, {'command': 'ls -al', 'stream': 'true'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        output = ''.join(line.get('output', '') for line in lines)
+        self.assertIn('I did stuff today', output)
+        self.assertEqual(lines[-1], {'exit_code': 0})
+
+        # the run pod is cleaned up once the output is consumed
+        pods = get_scheduler().get_pods(app_id, labels={'type': 'run'}).json()['items']
+        self.assertTrue(all('deletionTimestamp' in p['metadata'] for p in pods))
+
+    @mock.patch('api.models.App.deploy', mock_none)
+    @mock.patch('api.models.Release.publish', mock_none)
+    def test_run_detached(self, mock_requests):
+        """A one-off command in the background returns its job id right away"""
+        app_id = 'autotest'
+        response = self.client.post('/v2/apps', {'id': app_id})
+        url = '/v2/apps/{app_id}/builds'.format(**locals())
+        response = self.client.post(url, {'image': 'autotest/example'})
+        self.assertEqual(response.status_code, 201, response.data)
+
+        url = '/v2/apps/{}/run'.format(app_id)
+        with mock.patch('api.models.App.run', return_value=(0, 'mock')) as run:
+            with override_settings(DEIS_OPERATION_WORKERS=1), mock.patch('api.workers.wake'):
+                response = self.client.post(url, {'command': 'ls -al'},
+                                            HTTP_PREFER='respond-async')
+            self.assertEqual(response.status_code, 202, response.data)
+            self.assertTrue(response.data['job'].startswith('autotest-v2-run-'))
+
+            operation = Operation.objects.get(uuid=response.data['uuid'])
+            operation.claim('test')
+            operation.execute()
+            run.assert_called_once_with(mock.ANY, 'ls -al', name=response.data['job'],
+                                        timeout=settings.DEIS_RUN_DETACHED_TIMEOUT)
+
+        operation.refresh_from_db()
+        self.assertEqual(operation.result, {'exit_code': 0, 'output': 'mock'})
+
+    @override_settings(DEIS_RUN_OUTPUT_LIMIT=10)
+    def test_run_output_truncated(self, mock_requests):
+        """Only the end of large outputs is kept"""
+        scheduler = get_scheduler()
+        chunks = iter([('output', b'0123456789'), ('output', b'abcdef'), ('exit_code', 1)])
+        with mock.patch.object(scheduler, 'run_stream', return_value=chunks):
+            exit_code, output = scheduler.run('autotest', 'autotest-run', 'image', 'bash', "'ls'")
+
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(output, '[6 bytes of output truncated]\n6789abcdef')
+
     def test_unauthorized_user_cannot_see_app(self, mock_requests):
         """
         An unauthorized user should not be able to access an app's resources.
@@ -523,6 +591,97 @@ class AppTest(APITestCase):
         self.assertEqual(mr.called, True)
         self.assertEqual(mr.call_count, 10)
 
+    def _query_count_app(self):
+        response = self.client.post('/v2/apps')
+        self.assertEqual(response.status_code, 201, response.data)
+        app_id = response.data['id']
+
+        url = "/v2/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'procfile': {'web': 'node server.js'}}
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        # a fresh instance, like the next request would get
+        return App.objects.get(id=app_id)
+
+    def test_scale_query_count(self, mock_requests):
+        app = self._query_count_app()
+        # the last one stores the trace of the scale with the release
+        with self.assertNumQueries(5):
+            app.scale(self.user, {'web': 2})
+
+    def test_deploy_query_count(self, mock_requests):
+        app = self._query_count_app()
+        release = app.release_set.latest()
+        # the last one stores the trace of the deploy with the release
+        with self.assertNumQueries(6):
+            app.deploy(release)
+
+    def test_list_pods_query_count(self, mock_requests):
+        app = self._query_count_app()
+        with self.assertNumQueries(1):
+            app.list_pods(type='web')
+
+    def test_latest_release_cached(self, mock_requests):
+        app = self._query_count_app()
+        release = app.latest_release()
+        with self.assertNumQueries(0):
+            self.assertEqual(app.latest_release(), release)
+            release.config
+            release.build
+
+        # a new release made through the app is picked up
+        config = Config.objects.create(owner=self.user, app=app, values={'NEW': 'value'})
+        new_release = release.new(self.user, config=config, build=release.build)
+        self.assertEqual(app.latest_release().version, new_release.version)
+        new_release.delete()
+        self.assertEqual(app.latest_release().version, release.version)
+
+    def test_controller_load_benchmark(self, mock_requests):
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'load.json')
+            call_command('benchmark', 'controller-load', apps=2, replicas=2, output=output,
+                         stdout=out)
+            with open(output) as f:
+                saved = json.load(f)
+
+        results = json.loads(out.getvalue())['controller-load']
+        self.assertEqual(saved['controller-load'], results)
+        self.assertEqual(saved['options']['apps'], 2)
+        for operation in ['config', 'deploy', 'scale', 'pods', 'redeploy', 'rollback', 'destroy']:
+            self.assertEqual(results[operation]['calls'], 2)
+            self.assertGreater(results[operation]['sql_queries']['total'], 0)
+            self.assertGreater(results[operation]['peak_rss_kb'], 0)
+            latency = results[operation]['latency']
+            self.assertLessEqual(latency['p50_ms'], latency['max_ms'])
+
+        self.assertGreater(results['deploy']['kubernetes_requests']['total'], 0)
+        self.assertIn('LIST', results['pods']['kubernetes_requests']['by_verb'])
+
+        # the apps and the user driving them are gone afterwards
+        self.assertFalse(App.objects.filter(id__startswith='load-').exists())
+        self.assertFalse(User.objects.filter(username__startswith='benchmark-').exists())
+
+    def test_scheduler_client_benchmark(self, mock_requests):
+        app = self._query_count_app()
+        out = StringIO()
+        call_command('benchmark', 'scheduler-client', app=app.id, iterations=3, stdout=out)
+        results = json.loads(out.getvalue())['scheduler-client']
+
+        per_access, shared = results['per-access'], results['shared']
+        self.assertEqual(per_access['deploys'], 3)
+        self.assertGreater(per_access['clients'], 3)
+        self.assertEqual(shared['clients'], 1)
+        self.assertGreater(shared['kubernetes_requests'], 0)
+        # the shared client keeps its connection across deploys
+        self.assertLessEqual(shared['connections'], 1)
+        self.assertGreater(per_access['handshakes_per_deploy'], shared['handshakes_per_deploy'])
+
+        with self.assertRaises(CommandError):
+            call_command('benchmark', 'scheduler-client', iterations=1, stdout=out)
+
+
 FAKE_LOG_DATA = """
 2013-08-15 12:41:25 [33454] [INFO] Starting gunicorn 17.5
 2013-08-15 12:41:25 [33454] [INFO] Listening at: http://0.0.0.0:5000 (33454)
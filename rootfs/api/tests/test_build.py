@@ -6,6 +6,7 @@ Run the tests with "./manage.py test api"
 
 
 import json
+import threading
 
 from django.contrib.auth.models import User
 from django.core.cache import cache
@@ -447,3 +448,117 @@ class BuildTest(APITransactionTestCase):
             body = {'image': 'autotest/example'}
             response = self.client.post(url, body)
             self.assertEqual(response.status_code, 400, response.data)
+
+    def test_build_deploy_process_concurrency(self, mock_requests):
+        """Non-routable process types are rolled out concurrently after the routable ones"""
+        url = '/v2/apps'
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 201, response.data)
+        app_id = response.data['id']
+
+        # deploy non-routable process types 2 at a time
+        url = "/v2/apps/{app_id}/config".format(**locals())
+        body = {'values': json.dumps({'DEIS_DEPLOY_PROCESS_CONCURRENCY': '2'})}
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        url = "/v2/apps/{app_id}/builds".format(**locals())
+        body = {
+            'image': 'autotest/example',
+            'sha': 'a'*40,
+            'procfile': json.dumps({
+                'web': 'node server.js',
+                'worker': 'node worker.js',
+                'clock': 'node clock.js'
+            })
+        }
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        url = "/v2/apps/{app_id}/scale".format(**locals())
+        response = self.client.post(url, {'web': 1, 'worker': 1, 'clock': 1})
+        self.assertEqual(response.status_code, 204, response.data)
+
+        deploys = []
+
+        def deploy(*args, **kwargs):
+            deploys.append((kwargs['app_type'], threading.current_thread().name))
+
+        with mock.patch('scheduler.KubeHTTPClient.deploy', side_effect=deploy):
+            url = "/v2/apps/{app_id}/builds".format(**locals())
+            response = self.client.post(url, body)
+            self.assertEqual(response.status_code, 201, response.data)
+
+        # web has to be healthy before the rest starts, on the request thread
+        self.assertEqual(deploys[0], ('web', threading.current_thread().name))
+        self.assertEqual(sorted(app_type for app_type, _ in deploys[1:]), ['clock', 'worker'])
+        for _, thread in deploys[1:]:
+            self.assertNotEqual(thread, threading.current_thread().name)
+
+        # every failed process type is reported
+        def deploy_failure(*args, **kwargs):
+            if not kwargs['routable']:
+                raise KubeException('{} went away'.format(kwargs['app_type']))
+
+        with mock.patch('scheduler.KubeHTTPClient.deploy', side_effect=deploy_failure):
+            url = "/v2/apps/{app_id}/builds".format(**locals())
+            response = self.client.post(url, body)
+            self.assertEqual(response.status_code, 400, response.data)
+            self.assertIn('clock went away', str(response.data))
+            self.assertIn('worker went away', str(response.data))
+
+    def test_build_image_metadata_recorded(self, mock_requests):
+        """Scales and rollbacks of a build reuse what is known about its image"""
+        app_id = self.client.post('/v2/apps').data['id']
+
+        published = {'digest': 'sha256:' + 'a' * 64, 'ports': [8080], 'size': 1024}
+        with mock.patch('api.models.release.publish_release') as publish, \
+                mock.patch('api.models.release.docker_get_port') as get_port:
+            publish.return_value = published
+            url = "/v2/apps/{app_id}/builds".format(**locals())
+            response = self.client.post(url, {'image': 'autotest/example'})
+            self.assertEqual(response.status_code, 201, response.data)
+            self.assertEqual(publish.call_count, 1)
+
+            build = Build.objects.get(uuid=response.data['uuid'])
+            self.assertEqual(build.image_digest, published['digest'])
+            self.assertEqual(build.ports, [8080])
+            self.assertEqual(build.image_size, 1024)
+            release = build.app.release_set.latest()
+            self.assertEqual(release.image, '{}/{}@{}'.format(
+                settings.REGISTRY_URL, app_id, published['digest']))
+
+            url = "/v2/apps/{app_id}/scale".format(**locals())
+            response = self.client.post(url, {'cmd': 2})
+            self.assertEqual(response.status_code, 204, response.data)
+
+            url = "/v2/apps/{app_id}/config".format(**locals())
+            response = self.client.post(url, {'values': json.dumps({'FOO': 'bar'})})
+            self.assertEqual(response.status_code, 201, response.data)
+
+            url = "/v2/apps/{app_id}/releases/rollback/".format(**locals())
+            response = self.client.post(url)
+            self.assertEqual(response.status_code, 201, response.data)
+
+            # nothing went back to the registry
+            self.assertEqual(publish.call_count, 1)
+            get_port.assert_not_called()
+
+    def test_build_port_recorded(self, mock_requests):
+        """A port found by inspecting the image is only looked up once"""
+        app_id = self.client.post('/v2/apps').data['id']
+
+        with mock.patch('api.models.release.docker_get_port') as get_port:
+            get_port.return_value = 5000
+            url = "/v2/apps/{app_id}/builds".format(**locals())
+            response = self.client.post(url, {'image': 'autotest/example'})
+            self.assertEqual(response.status_code, 201, response.data)
+
+            url = "/v2/apps/{app_id}/scale".format(**locals())
+            response = self.client.post(url, {'cmd': 2})
+            self.assertEqual(response.status_code, 204, response.data)
+
+            self.assertEqual(get_port.call_count, 1)
+            build = Build.objects.filter(app__id=app_id).latest()
+            self.assertEqual(build.ports, [5000])
+            self.assertEqual(build.image_digest, '')
@@ -0,0 +1,62 @@
+"""
+Unit tests for the virtual clock the scheduler client and the mock scheduler wait on.
+
+Run the tests with "./manage.py test api"
+"""
+from datetime import timedelta
+import time
+import unittest
+from unittest import mock
+
+from django.test import override_settings
+
+from deis import clock
+from scheduler import KubeHTTPClient
+
+URL = 'http://test-scheduler.example.com'
+
+
+class ClockTest(unittest.TestCase):
+    """Test that waits move virtual time instead of taking real time"""
+
+    def setUp(self):
+        self.clock = clock.VirtualClock(start=0)
+        patcher = mock.patch('deis.clock._clock', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sleep_advances(self):
+        start = clock.utcnow()
+        started = time.time()
+        clock.sleep(3600)
+        self.assertEqual(clock.time(), 3600)
+        self.assertEqual(clock.utcnow() - start, timedelta(hours=1))
+        self.assertLess(time.time() - started, 1)
+
+        # time does not go back
+        self.clock.advance(-10)
+        self.assertEqual(clock.time(), 3600)
+
+    def test_install(self):
+        other = clock.VirtualClock(start=100)
+        previous = clock.install(other)
+        try:
+            self.assertIs(previous, self.clock)
+            self.assertIs(clock.get(), other)
+            self.assertEqual(clock.time(), 100)
+        finally:
+            clock.install(previous)
+
+    @override_settings(KUBERNETES_POD_TERMINATION_GRACE_PERIOD_SECONDS=30)
+    def test_scheduler_waits_on_clock(self):
+        client = KubeHTTPClient.__new__(KubeHTTPClient)
+        client.url = URL
+        client.session = mock.Mock()
+        client.session.delete.return_value.status_code = 200
+        # the pod never goes away, so the wait runs for the whole grace period
+        with mock.patch.object(client, 'get_pod') as get_pod, \
+                mock.patch.object(client, 'pod_deleted', return_value=False):
+            client.delete_pod('foo', 'foo-web-1')
+
+        self.assertEqual(get_pod.call_count, 30)
+        self.assertEqual(clock.time(), 30)
@@ -12,7 +12,7 @@ from rest_framework.test import APITransactionTestCase
 from unittest import mock
 from rest_framework.authtoken.models import Token
 
-from api.models import App, Config
+from api.models import App, Config, ConfigPayload
 
 from . import adapter
 from . import mock_port
@@ -273,6 +273,30 @@ class ConfigTest(APITransactionTestCase):
             resp = self.client.post(url, body)
             self.assertEqual(resp.status_code, 400)
 
+    def test_config_free_of_port(self, mock_requests):
+        """The PORT a deploy hands to the containers is not added to the config"""
+        url = '/v2/apps'
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 201, response.data)
+        app_id = response.data['id']
+
+        url = "/v2/apps/{}/builds".format(app_id)
+        response = self.client.post(url, {'image': 'autotest/example'})
+        self.assertEqual(response.status_code, 201, response.data)
+
+        url = '/v2/apps/{app_id}/config'.format(**locals())
+        response = self.client.post(url, {'values': json.dumps({'FOO': 'bar'})})
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['values'], {'FOO': 'bar'})
+
+        # neither is the config the app keeps around for the next deploy
+        app = App.objects.get(id=app_id)
+        release = app.latest_release()
+        app.deploy(release)
+        self.assertEqual(release.config.values, {'FOO': 'bar'})
+        self.assertEqual(app.latest_release().config.values, {'FOO': 'bar'})
+        self.assertEqual(Config.objects.get(uuid=release.config.uuid).values, {'FOO': 'bar'})
+
     def test_invalid_config_keys(self, mock_requests):
         """Test that invalid config keys are rejected.
         """
@@ -849,3 +873,57 @@ class ConfigTest(APITransactionTestCase):
             {'values': json.dumps({'HEALTHCHECK_URL': 'http://someurl.com'})}
         )
         self.assertEqual(resp.status_code, 400, response.data)
+
+    def test_config_queryable(self, mock_requests):
+        """Test that config is stored as JSONB the database can look into"""
+        apps = []
+        for values in [{'DEIS_DEPLOY_BATCHES': '2'}, {'FOO': 'bar'}]:
+            response = self.client.post('/v2/apps')
+            self.assertEqual(response.status_code, 201, response.data)
+            app_id = response.data['id']
+            apps.append(app_id)
+
+            url = '/v2/apps/{app_id}/config'.format(**locals())
+            response = self.client.post(url, {'values': json.dumps(values)})
+            self.assertEqual(response.status_code, 201, response.data)
+
+        configs = Config.objects.filter(values_payload__data__has_key='DEIS_DEPLOY_BATCHES')
+        self.assertEqual({c.app.id for c in configs}, {apps[0]})
+        configs = Config.objects.filter(values_payload__data__contains={'FOO': 'bar'})
+        self.assertEqual({c.app.id for c in configs}, {apps[1]})
+
+        # Procfiles sent as a string are stored as an object
+        url = '/v2/apps/{}/builds'.format(apps[0])
+        body = {'image': 'autotest/example', 'procfile': json.dumps({'web': 'node server.js'})}
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+        app = App.objects.get(id=apps[0])
+        self.assertEqual(app.build_set.latest().procfile, {'web': 'node server.js'})
+        self.assertTrue(App.objects.filter(build__procfile__has_key='web', id=apps[0]).exists())
+
+    def test_config_payloads_deduplicated(self, mock_requests):
+        """Test that config content is stored once and shared between configs"""
+        url = '/v2/apps/{}/config'.format(self.app.id)
+        body = {'values': json.dumps({'FOO': 'bar'})}
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+        first = Config.objects.get(uuid=response.data['uuid'])
+        payloads = ConfigPayload.objects.count()
+
+        # a limit change keeps pointing at the same env vars
+        response = self.client.post(url, {'memory': json.dumps({'web': '1G'})})
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['values'], {'FOO': 'bar'})
+        second = Config.objects.get(uuid=response.data['uuid'])
+        self.assertEqual(second.values_payload_id, first.values_payload_id)
+        self.assertEqual(second.changed(first), {'memory'})
+        self.assertEqual(ConfigPayload.objects.count(), payloads + 1)
+
+        # going back to earlier content stores nothing new
+        response = self.client.post(url, {'memory': json.dumps({'web': None})})
+        self.assertEqual(response.status_code, 201, response.data)
+        third = Config.objects.get(uuid=response.data['uuid'])
+        self.assertEqual(third.digests(), first.digests())
+        self.assertEqual(ConfigPayload.objects.count(), payloads + 1)
+        self.assertEqual(self.app.release_set.latest().summary,
+                         '{} changed limits for memory'.format(self.user.username))
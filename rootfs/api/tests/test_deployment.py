@@ -0,0 +1,149 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+import json
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import override_settings
+from rest_framework.test import APITransactionTestCase
+from unittest import mock
+from rest_framework.authtoken.models import Token
+
+from scheduler import KubeException, KubeHTTPException, get_scheduler
+
+from . import adapter
+from . import mock_port
+import requests_mock
+
+
+@requests_mock.Mocker(real_http=True, adapter=adapter)
+@mock.patch('api.models.release.publish_release', lambda *args: None)
+@mock.patch('api.models.release.docker_get_port', mock_port)
+@override_settings(KUBERNETES_DEPLOYMENTS=True)
+class DeploymentTest(APITransactionTestCase):
+    """Tests releases rolled out with Kubernetes Deployments"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='autotest')
+        self.token = Token.objects.get(user=self.user).key
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+        self.scheduler = get_scheduler()
+
+    def tearDown(self):
+        # make sure every test has a clean slate for k8s mocking
+        cache.clear()
+
+    def create_build(self, app_id):
+        url = "/v2/apps/{app_id}/builds".format(**locals())
+        body = {
+            'image': 'autotest/example',
+            'sha': 'a'*40,
+            'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})
+        }
+        return self.client.post(url, body)
+
+    def pods(self, app_id, app_type):
+        url = "/v2/apps/{app_id}/pods/{app_type}".format(**locals())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['results']
+
+    def test_deploy(self, mock_requests):
+        response = self.client.post('/v2/apps')
+        app_id = response.data['id']
+
+        response = self.create_build(app_id)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        deployment = self.scheduler.get_deployment(app_id, app_id + '-web').json()
+        self.assertEqual(deployment['metadata']['labels']['version'], 'v2')
+        self.assertEqual(deployment['spec']['selector']['matchLabels'],
+                         {'app': app_id, 'type': 'web', 'heritage': 'deis'})
+        self.assertEqual(deployment['spec']['strategy']['rollingUpdate'],
+                         {'maxSurge': 1, 'maxUnavailable': 0})
+        self.assertEqual(deployment['spec']['template']['metadata']['labels']['version'], 'v2')
+        self.assertEqual(self.scheduler.get_rcs(app_id).json()['items'], [])
+        self.assertEqual(len(self.pods(app_id, 'web')), 1)
+
+        # scale up through the Deployment
+        url = "/v2/apps/{app_id}/scale".format(**locals())
+        response = self.client.post(url, {'web': 3})
+        self.assertEqual(response.status_code, 204, response.data)
+        deployment = self.scheduler.get_deployment(app_id, app_id + '-web').json()
+        self.assertEqual(deployment['spec']['replicas'], 3)
+        self.assertEqual(len(self.pods(app_id, 'web')), 3)
+
+        # a new release changes the template of the same Deployment
+        url = "/v2/apps/{app_id}/config".format(**locals())
+        response = self.client.post(url, {'values': json.dumps({'DEIS_DEPLOY_BATCHES': 2})})
+        self.assertEqual(response.status_code, 201, response.data)
+
+        deployment = self.scheduler.get_deployment(app_id, app_id + '-web').json()
+        self.assertEqual(deployment['metadata']['labels']['version'], 'v3')
+        self.assertEqual(deployment['spec']['replicas'], 3)
+        self.assertEqual(deployment['spec']['strategy']['rollingUpdate']['maxSurge'], 2)
+        pods = self.pods(app_id, 'web')
+        self.assertEqual(len(pods), 3)
+        self.assertEqual({pod['release'] for pod in pods}, {'v3'})
+
+        # restarting knows how many pods the Deployment wants
+        url = "/v2/apps/{app_id}/pods/web/restart".format(**locals())
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(len(response.data), 3)
+
+    def test_deploy_failure_rolls_back(self, mock_requests):
+        response = self.client.post('/v2/apps')
+        app_id = response.data['id']
+        response = self.create_build(app_id)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        with mock.patch('scheduler.KubeHTTPClient._wait_for_deployment') as mock_wait:
+            mock_wait.side_effect = KubeException('Boom!')
+            response = self.create_build(app_id)
+            self.assertEqual(response.status_code, 400, response.data)
+
+        # back on the old template
+        deployment = self.scheduler.get_deployment(app_id, app_id + '-web').json()
+        self.assertEqual(deployment['metadata']['labels']['version'], 'v2')
+        self.assertEqual(deployment['spec']['template']['metadata']['labels']['version'], 'v2')
+
+    def test_first_deploy_failure_removes_deployment(self, mock_requests):
+        response = self.client.post('/v2/apps')
+        app_id = response.data['id']
+
+        with mock.patch('scheduler.KubeHTTPClient._wait_for_deployment') as mock_wait:
+            # the rollout fails, scaling down to remove the Deployment works
+            mock_wait.side_effect = [KubeException('Boom!'), None]
+            response = self.create_build(app_id)
+            self.assertEqual(response.status_code, 400, response.data)
+
+        with self.assertRaises(KubeHTTPException):
+            self.scheduler.get_deployment(app_id, app_id + '-web')
+
+    def test_replication_controller_is_taken_over(self, mock_requests):
+        response = self.client.post('/v2/apps')
+        app_id = response.data['id']
+
+        with override_settings(KUBERNETES_DEPLOYMENTS=False):
+            response = self.create_build(app_id)
+            self.assertEqual(response.status_code, 201, response.data)
+            url = "/v2/apps/{app_id}/scale".format(**locals())
+            response = self.client.post(url, {'web': 2})
+            self.assertEqual(response.status_code, 204, response.data)
+
+        self.assertEqual(len(self.scheduler.get_rcs(app_id).json()['items']), 1)
+
+        response = self.create_build(app_id)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        # the Deployment starts out with as many pods as the RC had
+        deployment = self.scheduler.get_deployment(app_id, app_id + '-web').json()
+        self.assertEqual(deployment['spec']['replicas'], 2)
+        self.assertEqual(self.scheduler.get_rcs(app_id).json()['items'], [])
+        self.assertEqual({pod['release'] for pod in self.pods(app_id, 'web')}, {'v3'})
@@ -0,0 +1,126 @@
+"""
+Unit tests for the Kubernetes API and app operation metrics served on /metrics.
+
+Run the tests with "./manage.py test api"
+"""
+import os
+import shutil
+import tempfile
+
+from django.test import override_settings
+import requests
+import requests_mock
+from rest_framework.test import APITestCase
+
+from deis import metrics
+from scheduler import InstrumentedSession, request_labels
+
+URL = 'http://test-scheduler.example.com'
+
+
+class MetricsTest(APITestCase):
+    """Test recording, aggregating and rendering metrics"""
+
+    def setUp(self):
+        metrics.registry.clear()
+        self.addCleanup(metrics.registry.clear)
+
+    def test_request_labels(self):
+        def labels(method, path):
+            return request_labels(requests.Request(method, URL + path).prepare())
+
+        self.assertEqual(labels('GET', '/api/v1/namespaces/foo/pods'),
+                         {'verb': 'LIST', 'resource': 'pods'})
+        self.assertEqual(labels('GET', '/api/v1/namespaces/foo/pods?watch=true'),
+                         {'verb': 'WATCH', 'resource': 'pods'})
+        self.assertEqual(labels('GET', '/api/v1/namespaces/foo/pods/foo-web-1/log'),
+                         {'verb': 'GET', 'resource': 'pods/log'})
+        self.assertEqual(labels('DELETE', '/apis/extensions/v1beta1/namespaces/foo/deployments/web'),  # noqa
+                         {'verb': 'DELETE', 'resource': 'deployments'})
+        self.assertEqual(labels('GET', '/api/v1/namespaces/foo'),
+                         {'verb': 'GET', 'resource': 'namespaces'})
+
+    def test_instrumented_session(self):
+        session = InstrumentedSession()
+        adapter = requests_mock.Adapter()
+        session.mount(URL, adapter)
+        adapter.register_uri('GET', URL + '/api/v1/namespaces/foo/pods', json={'items': []})
+        adapter.register_uri('GET', URL + '/api/v1/namespaces/foo/pods/bar', status_code=404)
+        adapter.register_uri('POST', URL + '/api/v1/namespaces/foo/pods',
+                             exc=requests.exceptions.ConnectTimeout)
+
+        session.get(URL + '/api/v1/namespaces/foo/pods')
+        session.get(URL + '/api/v1/namespaces/foo/pods')
+        session.get(URL + '/api/v1/namespaces/foo/pods/bar')
+        with self.assertRaises(requests.exceptions.ConnectTimeout):
+            session.post(URL + '/api/v1/namespaces/foo/pods')
+
+        output = metrics.render()
+        self.assertIn('deis_kubernetes_requests_total{code="200",resource="pods",verb="LIST"} 2', output)  # noqa
+        self.assertIn('deis_kubernetes_requests_total{code="404",resource="pods",verb="GET"} 1', output)  # noqa
+        self.assertIn('deis_kubernetes_requests_total{code="error",resource="pods",verb="POST"} 1', output)  # noqa
+        self.assertIn('deis_kubernetes_request_duration_seconds_count{resource="pods",verb="LIST"} 2', output)  # noqa
+        self.assertIn('deis_kubernetes_request_duration_seconds_bucket{resource="pods",verb="LIST",le="+Inf"} 2', output)  # noqa
+
+    def test_timed_outcome(self):
+        @metrics.timed('deploy')
+        def deploy(fail):
+            if fail:
+                raise ValueError('boom')
+            return 'done'
+
+        self.assertEqual(deploy(False), 'done')
+        with self.assertRaises(ValueError):
+            deploy(True)
+
+        output = metrics.render()
+        self.assertIn('deis_app_operation_duration_seconds_count{operation="deploy",outcome="success"} 1', output)  # noqa
+        self.assertIn('deis_app_operation_duration_seconds_count{operation="deploy",outcome="failure"} 1', output)  # noqa
+        self.assertIn('# TYPE deis_app_operation_duration_seconds histogram', output)
+
+    def test_workers_aggregated(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        labels = {'verb': 'LIST', 'resource': 'pods', 'code': '200'}
+        with override_settings(DEIS_METRICS_DIR=directory, DEIS_METRICS_FLUSH_INTERVAL=0):
+            # a worker that exited, its pid is the one of this process now
+            other = metrics.Registry()
+            other.path(directory)
+            other.started -= 1
+            other.inc('deis_kubernetes_requests_total', labels, 3)
+            other.observe('deis_app_operation_duration_seconds', {'operation': 'scale', 'outcome': 'success'}, 1.5)  # noqa
+            other.retire()
+
+            # a worker that got killed before it could retire
+            killed = metrics.Registry()
+            killed.path(directory)
+            killed.started -= 2
+            killed.inc('deis_kubernetes_requests_total', labels, 2)
+            os.replace(killed.path(directory), os.path.join(directory, '999999999-1.json'))
+
+            metrics.inc('deis_kubernetes_requests_total', labels)
+            metrics.observe('deis_app_operation_duration_seconds', {'operation': 'scale', 'outcome': 'success'}, 0.5)  # noqa
+            output = metrics.render()
+
+            # snapshots of workers that went away are folded into the retired totals
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['.lock', os.path.basename(metrics.registry.path(directory)),
+                              metrics.RETIRED])
+            self.assertEqual(output, metrics.render())
+
+        self.assertIn('deis_kubernetes_requests_total{code="200",resource="pods",verb="LIST"} 6', output)  # noqa
+        self.assertIn('deis_app_operation_duration_seconds_sum{operation="scale",outcome="success"} 2', output)  # noqa
+        self.assertIn('deis_app_operation_duration_seconds_bucket{operation="scale",outcome="success",le="1"} 1', output)  # noqa
+        self.assertIn('deis_app_operation_duration_seconds_bucket{operation="scale",outcome="success",le="2.5"} 2', output)  # noqa
+
+    def test_metrics_endpoint(self):
+        # no auth required, like the health checks
+        metrics.inc('deis_kubernetes_requests_total', {'verb': 'GET', 'resource': 'pods', 'code': '200'})  # noqa
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'deis_kubernetes_requests_total{code="200",resource="pods",verb="GET"} 1',
+                      response.content)
+
+        response = self.client.post('/metrics')
+        self.assertEqual(response.status_code, 405)
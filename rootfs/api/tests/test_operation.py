@@ -0,0 +1,293 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+from contextlib import contextmanager
+import json
+from datetime import timedelta
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APITransactionTestCase
+from unittest import mock
+from rest_framework.authtoken.models import Token
+
+from api import workers
+from api.models import App, Operation, Release
+from scheduler import KubeException, get_scheduler
+
+from . import adapter
+from . import mock_port
+import requests_mock
+
+
+@contextmanager
+def async_workers():
+    """Workers are configured, the test carries out the operations it queues itself"""
+    with override_settings(DEIS_OPERATION_WORKERS=1), mock.patch('api.workers.wake'):
+        yield
+
+
+@requests_mock.Mocker(real_http=True, adapter=adapter)
+@mock.patch('api.models.release.publish_release', lambda *args: None)
+@mock.patch('api.models.release.docker_get_port', mock_port)
+class OperationTest(APITransactionTestCase):
+    """Tests long running work being carried out in the background"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='autotest')
+        self.token = Token.objects.get(user=self.user).key
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def tearDown(self):
+        # make sure every test has a clean slate for k8s mocking
+        cache.clear()
+
+    def create_app(self):
+        response = self.client.post('/v2/apps')
+        self.assertEqual(response.status_code, 201, response.data)
+        app_id = response.data['id']
+
+        url = "/v2/apps/{app_id}/builds".format(**locals())
+        body = {
+            'image': 'autotest/example',
+            'sha': 'a'*40,
+            'procfile': json.dumps({'web': 'node server.js', 'worker': 'node worker.js'})
+        }
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        return app_id
+
+    def test_scale_async(self, mock_requests):
+        app_id = self.create_app()
+
+        url = "/v2/apps/{app_id}/scale".format(**locals())
+        with async_workers():
+            response = self.client.post(url, {'web': 3}, HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual(response['Preference-Applied'], 'respond-async')
+        self.assertEqual(response.data['state'], 'pending')
+        self.assertEqual(response.data['type'], 'scale')
+        self.assertEqual(response.data['params'], {'structure': {'web': 3}})
+        location = response['Location']
+        self.assertEqual(location, '/v2/apps/{}/operations/{}'.format(app_id, response.data['uuid']))  # noqa
+
+        # nothing happened yet
+        self.assertEqual(App.objects.get(id=app_id).structure, {'web': 1})
+
+        self.assertTrue(workers.process('test'))
+        self.assertFalse(workers.process('test'))
+
+        response = self.client.get(location)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['state'], 'succeeded')
+        self.assertIsNotNone(response.data['started'])
+        self.assertIsNotNone(response.data['finished'])
+        self.assertNotIn('worker', response.data)
+        self.assertEqual(App.objects.get(id=app_id).structure, {'web': 3})
+
+        url = "/v2/apps/{app_id}/pods/web".format(**locals())
+        response = self.client.get(url)
+        self.assertEqual(len(response.data['results']), 3)
+
+        url = "/v2/apps/{app_id}/operations".format(**locals())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['count'], 1)
+
+    def test_scale_sync_without_preference(self, mock_requests):
+        app_id = self.create_app()
+
+        url = "/v2/apps/{app_id}/scale".format(**locals())
+        response = self.client.post(url, {'web': 2}, HTTP_PREFER='return=minimal')
+        self.assertEqual(response.status_code, 204, response.data)
+        self.assertEqual(Operation.objects.count(), 0)
+
+    def test_scale_sync_without_workers(self, mock_requests):
+        app_id = self.create_app()
+
+        # nobody would pick the operation up, so the preference is not applied
+        url = "/v2/apps/{app_id}/scale".format(**locals())
+        response = self.client.post(url, {'web': 2}, HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 204, response.data)
+        self.assertNotIn('Preference-Applied', response)
+        self.assertEqual(Operation.objects.count(), 0)
+        self.assertEqual(App.objects.get(id=app_id).structure, {'web': 2})
+
+    def test_config_async_failure(self, mock_requests):
+        app_id = self.create_app()
+        releases = Release.objects.filter(app__id=app_id).count()
+
+        url = "/v2/apps/{app_id}/config".format(**locals())
+        body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
+        with async_workers():
+            response = self.client.post(url, body, HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual(response.data['config']['values']['NEW_URL1'], 'http://localhost:8080/')
+        location = response['Location']
+
+        # the release exists until the deploy fails
+        self.assertEqual(Release.objects.filter(app__id=app_id).count(), releases + 1)
+        with mock.patch('scheduler.KubeHTTPClient.deploy') as mock_deploy:
+            mock_deploy.side_effect = KubeException('Boom!')
+            self.assertTrue(workers.process('test'))
+
+        response = self.client.get(location)
+        self.assertEqual(response.data['state'], 'failed')
+        self.assertIn('Boom!', response.data['error'])
+        self.assertEqual(Release.objects.filter(app__id=app_id).count(), releases)
+
+    def test_build_hook_async(self, mock_requests):
+        app_id = self.create_app()
+
+        url = '/v2/hooks/build'
+        body = {
+            'receive_user': 'autotest',
+            'receive_repo': app_id,
+            'image': '{app_id}:v2'.format(**locals())
+        }
+        with async_workers():
+            response = self.client.post(url, body, HTTP_X_DEIS_BUILDER_AUTH=settings.BUILDER_KEY,  # noqa
+                                        HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual(response.data['release']['version'], 3)
+        self.assertEqual(response.data['type'], 'deploy')
+
+        self.assertTrue(workers.process('test'))
+        operation = Operation.objects.get(uuid=response.data['uuid'])
+        self.assertEqual(operation.state, Operation.SUCCEEDED, operation.error)
+        self.assertEqual(operation.result, {'release': {'version': 3}})
+
+    def test_run_async(self, mock_requests):
+        app_id = self.create_app()
+
+        url = "/v2/apps/{app_id}/run".format(**locals())
+        with mock.patch('scheduler.KubeHTTPClient.run') as kube_run:
+            kube_run.return_value = (0, 'hello world')
+            with async_workers():
+                response = self.client.post(url, {'command': 'echo hi'},
+                                            HTTP_PREFER='respond-async')
+            self.assertEqual(response.status_code, 202, response.data)
+            kube_run.assert_not_called()
+
+            self.assertTrue(workers.process('test'))
+
+        url = response['Location']
+        response = self.client.get(url, {'wait': 10})
+        self.assertEqual(response.data['state'], 'succeeded')
+        self.assertEqual(response.data['result'], {'exit_code': 0, 'output': 'hello world'})
+
+    def test_restart_async(self, mock_requests):
+        app_id = self.create_app()
+
+        url = "/v2/apps/{app_id}/pods/web/restart".format(**locals())
+        with async_workers():
+            response = self.client.post(url, HTTP_PREFER='respond-async')
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual(response.data['params'], {'type': 'web'})
+
+        self.assertTrue(workers.process('test'))
+        operation = Operation.objects.get(uuid=response.data['uuid'])
+        self.assertEqual(operation.state, Operation.SUCCEEDED, operation.error)
+        self.assertEqual(len(operation.result['pods']), 1)
+
+    def test_operation_claimed_once(self, mock_requests):
+        app_id = self.create_app()
+        operation = Operation.start(self.user, App.objects.get(id=app_id), 'scale',
+                                    {'structure': {'web': 2}})
+
+        self.assertTrue(operation.claim('worker-a'))
+        self.assertFalse(Operation.objects.get(uuid=operation.uuid).claim('worker-b'))
+        self.assertEqual(operation.worker, 'worker-a')
+        self.assertEqual(operation.state, Operation.RUNNING)
+
+    def test_abandoned_operation_expires(self, mock_requests):
+        app_id = self.create_app()
+        operation = Operation.start(self.user, App.objects.get(id=app_id), 'scale',
+                                    {'structure': {'web': 2}})
+        operation.claim('gone')
+        long_ago = timezone.now() - timedelta(days=1)
+        Operation.objects.filter(uuid=operation.uuid).update(updated=long_ago)
+
+        self.assertFalse(workers.process('test'))
+        operation.refresh_from_db()
+        self.assertEqual(operation.state, Operation.FAILED)
+        self.assertIn('went away', operation.error)
+
+    @override_settings(DEIS_OPERATION_HEARTBEAT_INTERVAL=0.01)
+    def test_running_operation_does_not_expire(self, mock_requests):
+        app_id = self.create_app()
+        operation = Operation.start(self.user, App.objects.get(id=app_id), 'scale',
+                                    {'structure': {'web': 2}})
+        operation.claim('test')
+        long_ago = timezone.now() - timedelta(days=1)
+        Operation.objects.filter(uuid=operation.uuid).update(updated=long_ago)
+
+        def scale(structure):
+            # takes longer than the expiry, another worker looks for abandoned ones
+            for _ in range(500):
+                if Operation.objects.get(uuid=operation.uuid).updated > long_ago:
+                    break
+                time.sleep(0.01)
+
+            workers.expire()
+            self.assertEqual(Operation.objects.get(uuid=operation.uuid).state,
+                             Operation.RUNNING)
+
+        with mock.patch.object(operation, '_scale', scale):
+            operation.execute()
+
+        operation.refresh_from_db()
+        self.assertEqual(operation.state, Operation.SUCCEEDED, operation.error)
+
+    def test_long_poll_bad_wait(self, mock_requests):
+        app_id = self.create_app()
+        operation = Operation.start(self.user, App.objects.get(id=app_id), 'scale',
+                                    {'structure': {'web': 2}})
+
+        url = "/v2/apps/{}/operations/{}".format(app_id, operation.uuid)
+        response = self.client.get(url, {'wait': 'forever'})
+        self.assertEqual(response.status_code, 400, response.data)
+        response = self.client.get(url, {'wait': 'nan'})
+        self.assertEqual(response.status_code, 400, response.data)
+
+        # an operation nobody picks up is reported as is once the wait is over
+        response = self.client.get(url, {'wait': 0.5})
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['state'], 'pending')
+
+    def test_cleanup_after_deploy_async(self, mock_requests):
+        app_id = self.create_app()
+
+        # the deploy leaves the old RCs behind for cleanup to find
+        url = "/v2/apps/{app_id}/config".format(**locals())
+        body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
+        with override_settings(DEIS_OPERATION_WORKERS=1), \
+                mock.patch('api.workers.wake'), \
+                mock.patch('scheduler.KubeHTTPClient.cleanup_release'), \
+                mock.patch('api.models.release.Release.cleanup_old') as cleanup_old:
+            response = self.client.post(url, body)
+            self.assertEqual(response.status_code, 201, response.data)
+            # the deploy did not wait for the old release to go away
+            cleanup_old.assert_not_called()
+
+        operation = Operation.objects.get(type='cleanup')
+        release = Release.objects.filter(app__id=app_id).latest()
+        self.assertEqual(operation.params, {'release': str(release.uuid)})
+
+        rcs = get_scheduler().get_rcs(app_id).json()['items']
+        self.assertEqual({rc['metadata']['labels']['version'] for rc in rcs}, {'v2', 'v3'})
+
+        self.assertTrue(workers.process('test'))
+        operation.refresh_from_db()
+        self.assertEqual(operation.state, Operation.SUCCEEDED, operation.error)
+        rcs = get_scheduler().get_rcs(app_id).json()['items']
+        self.assertEqual({rc['metadata']['labels']['version'] for rc in rcs}, {'v3'})
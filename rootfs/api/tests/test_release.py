@@ -5,17 +5,21 @@ Run the tests with "./manage.py test api"
 """
 
 
+from io import StringIO
 import json
 import uuid
 
 from django.contrib.auth.models import User
 from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
 from rest_framework.test import APITransactionTestCase
 from unittest import mock
 from rest_framework.authtoken.models import Token
 
+from deis import clock
 from api.models import Release
-from scheduler import KubeHTTPException
+from scheduler import KubeHTTPException, get_scheduler
 from . import adapter
 from . import mock_port
 import requests_mock
@@ -373,3 +377,239 @@ class ReleaseTest(APITransactionTestCase):
         body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
         response = self.client.post(url, body)
         self.assertEqual(response.status_code, 409, response.data)
+
+    def test_env_secret_shared_between_releases(self, mock_requests):
+        """
+        Test that releases with the same env share one env secret and that
+        secrets nothing refers to anymore are cleaned up
+        """
+        url = '/v2/apps'
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 201, response.data)
+        app_id = response.data['id']
+
+        url = '/v2/apps/{app_id}/builds'.format(**locals())
+        body = {'image': 'autotest/example', 'procfile': {'web': 'node server.js'}}
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        def env_secrets():
+            labels = {'type': 'env'}
+            secrets = get_scheduler().get_secrets(app_id, labels=labels).json()['items']
+            return sorted(secret['metadata']['name'] for secret in secrets)
+
+        def rc_env(version):
+            labels = {'version': version}
+            rc = get_scheduler().get_rcs(app_id, labels=labels).json()['items'][0]
+            env = rc['spec']['template']['spec']['containers'][0]['env']
+            return {e['name']: e.get('value', e.get('valueFrom')) for e in env}
+
+        url = '/v2/apps/{app_id}/config'.format(**locals())
+        body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+        secrets = env_secrets()
+        self.assertEqual(len(secrets), 1)
+        self.assertTrue(secrets[0].startswith(app_id + '-env-'))
+
+        # the release is set as a plain value, config comes from the secret
+        env = rc_env('v3')
+        self.assertEqual(env['WORKFLOW_RELEASE'], 'v3')
+        self.assertEqual(env['NEW_URL1']['secretKeyRef'],
+                         {'name': secrets[0], 'key': 'new-url1'})
+
+        # scaling does not touch the secret
+        with mock.patch('scheduler.KubeHTTPClient.create_secret') as create_secret, \
+                mock.patch('scheduler.KubeHTTPClient.update_secret') as update_secret:
+            url = '/v2/apps/{app_id}/scale'.format(**locals())
+            response = self.client.post(url, {'web': 2})
+            self.assertEqual(response.status_code, 204, response.data)
+            create_secret.assert_not_called()
+            update_secret.assert_not_called()
+
+        # a new env gets a new secret and the old one is cleaned up
+        url = '/v2/apps/{app_id}/config'.format(**locals())
+        body = {'values': json.dumps({'NEW_URL1': 'http://localhost:9090/'})}
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+        changed = env_secrets()
+        self.assertEqual(len(changed), 1)
+        self.assertNotEqual(changed, secrets)
+
+        # rolling back to the same env comes back to the same secret
+        url = '/v2/apps/{app_id}/releases/rollback/'.format(**locals())
+        response = self.client.post(url, {'version': 3})
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(env_secrets(), secrets)
+
+    def test_cleanup_old_deletes_by_label(self, mock_requests):
+        """
+        Test that old releases are torn down with collection deletes and that
+        releases newer than the one cleaning up are left alone
+        """
+        url = '/v2/apps'
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 201, response.data)
+        app_id = response.data['id']
+
+        url = '/v2/apps/{app_id}/builds'.format(**locals())
+        body = {'image': 'autotest/example', 'procfile': {'web': 'node server.js'}}
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        url = '/v2/apps/{app_id}/scale'.format(**locals())
+        response = self.client.post(url, {'web': 3})
+        self.assertEqual(response.status_code, 204, response.data)
+
+        def versions(resource):
+            items = getattr(get_scheduler(), 'get_' + resource)(app_id).json()['items']
+            return sorted(
+                item['metadata']['labels']['version'] for item in items
+                if not get_scheduler().pod_deleted(item)
+            )
+
+        # the deploy leaves the old RC and its pods behind for cleanup to find and
+        # no pod is deleted and waited for one at a time
+        with mock.patch('scheduler.KubeHTTPClient.cleanup_release'), \
+                mock.patch('scheduler.KubeHTTPClient.delete_pod') as delete_pod:
+            url = '/v2/apps/{app_id}/config'.format(**locals())
+            body = {'values': json.dumps({'NEW_URL1': 'http://localhost:8080/'})}
+            response = self.client.post(url, body)
+            self.assertEqual(response.status_code, 201, response.data)
+            delete_pod.assert_not_called()
+
+        self.assertEqual(set(versions('rcs')), {'v3'})
+        pods = versions('pods')
+        self.assertEqual(set(pods), {'v3'})
+
+        # an older release cleaning up late does not touch the newer one
+        Release.objects.get(app__id=app_id, version=2).cleanup_old()
+        self.assertEqual(set(versions('rcs')), {'v3'})
+        self.assertEqual(versions('pods'), pods)
+
+    def test_cleanup_keeps_new_env_secrets(self, mock_requests):
+        """Test that cleanup leaves the env secret of a deploy that has no controllers yet"""
+        url = '/v2/apps'
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 201, response.data)
+        app_id = response.data['id']
+
+        url = '/v2/apps/{app_id}/builds'.format(**locals())
+        response = self.client.post(url, {'image': 'autotest/example'})
+        self.assertEqual(response.status_code, 201, response.data)
+        release = Release.objects.get(app__id=app_id, version=2)
+
+        def env_secrets():
+            labels = {'type': 'env'}
+            secrets = get_scheduler().get_secrets(app_id, labels=labels).json()['items']
+            return [secret['metadata']['name'] for secret in secrets]
+
+        # a concurrent deploy of a newer release created its secret, not its RC yet
+        name = get_scheduler()._set_env_secret(app_id, {'NEW_URL1': 'http://localhost:8080/'})
+        release.cleanup_old()
+        self.assertIn(name, env_secrets())
+
+        # once it is older than the release nothing refers to it anymore
+        clock.sleep(60)
+        release.cleanup_old()
+        self.assertNotIn(name, env_secrets())
+
+    def test_release_trace(self, mock_requests):
+        """Test that deploys, scales and rollbacks record their span tree with the release"""
+        url = '/v2/apps'
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, 201, response.data)
+        app_id = response.data['id']
+
+        url = '/v2/apps/{app_id}/builds'.format(**locals())
+        body = {
+            'image': 'autotest/example',
+            'sha': 'a'*40,
+            'procfile': json.dumps({'web': 'node server.js'})
+        }
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        def names(span):
+            yield span['name']
+            for child in span.get('spans', []):
+                yield from names(child)
+
+        url = '/v2/apps/{app_id}/releases/v2/trace'.format(**locals())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['version'], 2)
+        publish, deploy = response.data['traces']
+        self.assertEqual(publish['name'], 'publish')
+        self.assertEqual(deploy['name'], 'deploy')
+        self.assertEqual(deploy['attributes'], {'version': 2})
+        self.assertEqual(deploy['offset'], 0)
+        for name in ['get_port', 'rollout', 'create_rc', 'set_env_secret', 'scale_rc',
+                     'wait_until_pods_are_ready', 'verify_application_health', 'cleanup_old']:
+            self.assertIn(name, names(deploy))
+
+        rollout = [span for span in deploy['spans'] if span['name'] == 'rollout'][0]
+        self.assertEqual(rollout['attributes'], {'name': app_id + '-v2-web', 'app_type': 'web'})
+        scale = [span for span in rollout['spans'] if span['name'] == 'scale_rc'][0]
+        self.assertEqual(scale['attributes']['desired'], 1)
+        self.assertEqual(scale['spans'][0]['name'], 'wait_until_pods_are_ready')
+        self.assertEqual(scale['spans'][0]['attributes'],
+                         {'desired': 1, 'container': app_id + '-web'})
+        for span in [deploy, rollout, scale]:
+            self.assertGreaterEqual(span['duration'], 0)
+
+        # the release list stays lean
+        response = self.client.get('/v2/apps/{app_id}/releases/v2'.format(**locals()))
+        self.assertNotIn('traces', response.data)
+
+        # scales are recorded with the release they scaled
+        url = '/v2/apps/{app_id}/scale'.format(**locals())
+        response = self.client.post(url, {'web': 2})
+        self.assertEqual(response.status_code, 204, response.data)
+        traces = Release.objects.get(app__id=app_id, version=2).traces
+        self.assertEqual(traces[-1]['name'], 'scale')
+        self.assertEqual(traces[-1]['attributes'], {'structure': {'web': 2}})
+        self.assertIn('scale_rc', names(traces[-1]))
+
+        # a rollback is a single tree with its publish and deploy in it
+        url = '/v2/apps/{app_id}/releases/rollback/'.format(**locals())
+        response = self.client.post(url, {'version': 2})
+        self.assertEqual(response.status_code, 201, response.data)
+        url = '/v2/apps/{app_id}/releases/v3/trace'.format(**locals())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.data)
+        rollback, = response.data['traces']
+        self.assertEqual(rollback['name'], 'rollback')
+        self.assertEqual(rollback['attributes'], {'version': 2})
+        self.assertEqual([span['name'] for span in rollback['spans']], ['publish', 'deploy'])
+
+        # only the most recent traces are kept
+        release = Release.objects.get(app__id=app_id, version=3)
+        with mock.patch('api.models.release.TRACES', 3):
+            for _ in range(5):
+                with release.traced('scale'):
+                    pass
+        release.refresh_from_db()
+        self.assertEqual([t['name'] for t in release.traces], ['scale'] * 3)
+
+        url = '/v2/apps/{app_id}/releases/v9/trace'.format(**locals())
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+
+    def test_latest_lookups_benchmark(self, mock_requests):
+        releases = Release.objects.count()
+
+        out = StringIO()
+        call_command('benchmark', 'latest-lookups', apps=20, releases=5, iterations=5, stdout=out)
+        results = json.loads(out.getvalue())['latest-lookups']
+        for mode in ['indexed', 'unindexed']:
+            self.assertEqual(
+                sorted(results[mode].keys()),
+                ['build-latest', 'config-latest', 'key-fingerprint', 'push-latest', 'release-latest']  # noqa
+            )
+
+        # the generated rows and the dropped indexes are rolled back
+        self.assertEqual(Release.objects.count(), releases)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, 'api_release')
+        self.assertIn(['app_id', 'created'], [c['columns'] for c in constraints.values()])
@@ -0,0 +1,162 @@
+"""
+Unit tests for the Deis api app.
+
+Run the tests with "./manage.py test api"
+"""
+from datetime import timedelta
+from io import StringIO
+import json
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APITransactionTestCase
+from unittest import mock
+from rest_framework.authtoken.models import Token
+
+from api import retention
+from api.models import App, Build, Config, PrunedRelease, Release
+from scheduler import get_scheduler
+
+from . import adapter
+from . import mock_port
+import requests_mock
+
+
+@requests_mock.Mocker(real_http=True, adapter=adapter)
+@mock.patch('api.models.release.publish_release', lambda *args: None)
+@mock.patch('api.models.release.docker_get_port', mock_port)
+class RetentionTest(APITransactionTestCase):
+    """Tests garbage collecting release history"""
+
+    fixtures = ['tests.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='autotest')
+        self.token = Token.objects.get(user=self.user).key
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token)
+
+    def tearDown(self):
+        # make sure every test has a clean slate for k8s mocking
+        cache.clear()
+
+    def create_app(self, releases=5):
+        """An app with a deployed build (v2) and a few releases with new configs on top"""
+        response = self.client.post('/v2/apps')
+        self.assertEqual(response.status_code, 201, response.data)
+        app_id = response.data['id']
+
+        url = "/v2/apps/{app_id}/builds".format(**locals())
+        body = {'image': 'autotest/example', 'procfile': {'web': 'node server.js'}}
+        response = self.client.post(url, body)
+        self.assertEqual(response.status_code, 201, response.data)
+
+        app = App.objects.get(id=app_id)
+        build = app.build_set.latest()
+        for i in range(releases):
+            config = Config.objects.create(owner=self.user, app=app, values={'I': str(i)})
+            app.release_set.latest().new(self.user, config=config, build=build)
+
+        return app
+
+    def versions(self, app):
+        return list(app.release_set.order_by('version').values_list('version', flat=True))
+
+    def test_keep_count(self, mock_requests):
+        app = self.create_app()
+        self.assertEqual(self.versions(app), [1, 2, 3, 4, 5, 6, 7])
+
+        report = retention.collect(app, keep=3)
+        self.assertEqual(self.versions(app), [5, 6, 7])
+        # the first two releases shared the initial config, the build is still in use
+        self.assertEqual(report['releases'], 4)
+        self.assertEqual(report['configs'], 3)
+        # empty limits, tags and registry are shared with the configs that are kept
+        self.assertEqual(report['payloads'], 2)
+        self.assertEqual(report['builds'], 0)
+        self.assertEqual(Config.objects.filter(app=app).count(), 3)
+        self.assertEqual(Build.objects.filter(app=app).count(), 1)
+
+        # v2 was still running in Kubernetes
+        self.assertGreater(report['objects'], 0)
+        self.assertEqual(get_scheduler().get_rcs(app.id).json()['items'], [])
+
+        # nothing left to do
+        self.assertEqual(retention.collect(app, keep=3)['releases'], 0)
+
+    def test_pruned_releases_recorded(self, mock_requests):
+        app = self.create_app()
+        v2 = app.release_set.get(version=2)
+        digests = v2.config.digests()
+
+        retention.collect(app, keep=3, dry_run=True)
+        self.assertFalse(PrunedRelease.objects.filter(app=app).exists())
+
+        retention.collect(app, keep=3)
+        pruned = PrunedRelease.objects.filter(app=app)
+        self.assertEqual([p.version for p in pruned], [4, 3, 2, 1])
+
+        record = pruned.get(version=2)
+        self.assertEqual(record.summary, v2.summary)
+        self.assertEqual(record.owner, self.user.username)
+        self.assertEqual(record.released, v2.created)
+        self.assertEqual(record.image, 'autotest/example')
+        self.assertEqual(record.config, digests)
+        # the first release has no build
+        self.assertEqual(pruned.get(version=1).image, '')
+
+        # they go along with the app
+        app.delete()
+        self.assertFalse(PrunedRelease.objects.exists())
+
+    def test_keep_days(self, mock_requests):
+        app = self.create_app()
+        long_ago = timezone.now() - timedelta(days=30)
+        Release.objects.filter(app=app).update(created=long_ago)
+        Release.objects.filter(app=app, version=6).update(created=timezone.now())
+
+        # the current release is kept no matter how old it is
+        retention.collect(app, days=7)
+        self.assertEqual(self.versions(app), [6, 7])
+
+    def test_keep_count_or_days(self, mock_requests):
+        app = self.create_app()
+        long_ago = timezone.now() - timedelta(days=30)
+        Release.objects.filter(app=app, version__lte=2).update(created=long_ago)
+
+        # v3 and v4 are past the count but young enough
+        retention.collect(app, keep=3, days=7)
+        self.assertEqual(self.versions(app), [3, 4, 5, 6, 7])
+
+    def test_retention_off(self, mock_requests):
+        app = self.create_app(releases=2)
+        self.assertEqual(retention.collect(app)['releases'], 0)
+        self.assertEqual(self.versions(app), [1, 2, 3, 4])
+
+    def test_retention_from_app_config(self, mock_requests):
+        app = self.create_app()
+        config = app.release_set.latest().config
+        config.values['DEIS_RELEASE_RETENTION_COUNT'] = '2'
+        config.save()
+
+        with override_settings(DEIS_RELEASE_RETENTION_COUNT=5):
+            retention.collect(app)
+
+        self.assertEqual(self.versions(app), [6, 7])
+
+    def test_prune_releases_command(self, mock_requests):
+        app = self.create_app()
+
+        out = StringIO()
+        call_command('prune_releases', app.id, '--keep', '2', '--dry-run', stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['apps'], 1)
+        self.assertEqual(report['releases'], 5)
+        self.assertEqual(self.versions(app), [1, 2, 3, 4, 5, 6, 7])
+
+        out = StringIO()
+        call_command('prune_releases', '--keep', '2', stdout=out)
+        self.assertEqual(json.loads(out.getvalue())['releases'], 5)
+        self.assertEqual(self.versions(app), [6, 7])
@@ -0,0 +1,64 @@
+"""
+Unit tests for the process-wide scheduler client.
+
+Run the tests with "./manage.py test api"
+"""
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import override_settings
+
+import scheduler
+from scheduler import KubeTokenAuth, get_scheduler
+
+
+class SchedulerClientTest(unittest.TestCase):
+    """Test that the scheduler client is shared and keeps its connections around"""
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_client_is_shared(self):
+        client = get_scheduler()
+        self.assertIs(client, get_scheduler())
+        self.assertEqual(client.__class__.__name__, 'MockSchedulerClient')
+        self.assertIs(scheduler._clients[(os.getpid(), 'scheduler.mock')], client)
+
+    def test_client_is_seeded_after_cache_clear(self):
+        client = get_scheduler()
+        cache.clear()
+        # data that is assumed to be there comes back on the next request
+        self.assertEqual(client.get_namespace('deis').status_code, 200)
+
+    @override_settings(KUBERNETES_CLIENT_POOL_CONNECTIONS=3, KUBERNETES_CLIENT_POOL_MAXSIZE=7)
+    @mock.patch('scheduler.KubeTokenAuth')
+    def test_connection_pool_size(self, mock_auth):
+        client = scheduler.KubeHTTPClient()
+
+        adapter = client.session.get_adapter(client.url)
+        self.assertIs(adapter, client.session.get_adapter('http://example.com'))
+        self.assertEqual(adapter._pool_connections, 3)
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertNotIn('Authorization', client.session.headers)
+
+    def test_token_is_reloaded_when_rotated(self):
+        with tempfile.NamedTemporaryFile('w') as token:
+            token.write('first\n')
+            token.flush()
+
+            auth = KubeTokenAuth(token.name)
+            request = auth(mock.Mock(headers={}))
+            self.assertEqual(request.headers['Authorization'], 'Bearer first')
+
+            token.seek(0)
+            token.truncate()
+            token.write('second')
+            token.flush()
+            stat = os.stat(token.name)
+            os.utime(token.name, (stat.st_atime, stat.st_mtime + 10))
+
+            request = auth(mock.Mock(headers={}))
+            self.assertEqual(request.headers['Authorization'], 'Bearer second')
@@ -0,0 +1,194 @@
+"""
+Unit tests for serving scheduler reads from in-process informers.
+
+Run the tests with "./manage.py test api"
+"""
+import base64
+import json
+import queue
+import time
+import unittest
+
+from django.test import override_settings
+import requests
+import requests_mock
+
+from scheduler import KubeHTTPClient, KubeHTTPException
+
+URL = 'http://test-scheduler.example.com'
+
+
+def pod(name, version, app_type='web'):
+    return {
+        'metadata': {
+            'name': name,
+            'resourceVersion': version,
+            'labels': {'app': 'foo', 'type': app_type}
+        },
+        'status': {'phase': 'Running'}
+    }
+
+
+def stream(*events):
+    return '\n'.join(json.dumps({'type': kind, 'object': obj}) for kind, obj in events)
+
+
+class SchedulerInformerTest(unittest.TestCase):
+    """Test that reads are served from the informer cache only while it is fresh"""
+
+    def setUp(self):
+        self.adapter = requests_mock.Adapter()
+        self.client = KubeHTTPClient.__new__(KubeHTTPClient)
+        self.client.url = URL
+        self.client.session = requests.Session()
+        self.client.session.mount(URL, self.adapter)
+
+        self.lists = 0
+        self.watches = queue.Queue()
+
+        settings = override_settings(
+            KUBERNETES_INFORMERS_ENABLED=True,
+            KUBERNETES_WATCH_TIMEOUT_SECONDS=1
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def tearDown(self):
+        if '_informers' in self.client.__dict__:
+            for informer in self.client.informers.informers.values():
+                informer.stop()
+
+    def register(self, listing, path='/api/v1/namespaces/foo/pods'):
+        def callback(request, context):
+            if 'watch' not in request.qs:
+                self.lists += 1
+                return json.dumps(listing)
+
+            try:
+                return self.watches.get(timeout=0.05)
+            except queue.Empty:
+                # the API server closing an idle stream
+                return ''
+
+        self.adapter.register_uri('GET', URL + path, text=callback)
+
+    def wait(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+
+            time.sleep(0.01)
+
+        self.fail('condition was not met in time')
+
+    def informer(self, resource='pods'):
+        informer = self.client.informers.get(resource, 'foo')
+        self.wait(informer.fresh)
+        return informer
+
+    def names(self, **kwargs):
+        pods = self.client.get_pods('foo', **kwargs).json()['items']
+        return [p['metadata']['name'] for p in pods]
+
+    def test_reads_served_from_cache(self):
+        self.register({
+            'metadata': {'resourceVersion': '10'},
+            'items': [pod('foo-a', '9'), pod('foo-b', '8', 'worker')]
+        })
+        self.informer()
+        lists = self.lists
+
+        self.assertEqual(self.names(labels={'type': 'web'}), ['foo-a'])
+        self.assertEqual(self.names(labels={'app': 'foo'}), ['foo-a', 'foo-b'])
+        self.assertEqual(self.names(labels={'type': 'cmd'}), [])
+        response = self.client.get_pods('foo')
+        self.assertEqual(response.json()['metadata']['resourceVersion'], '10')
+        self.assertEqual(self.lists, lists)
+
+        # field selectors are not indexed and go to the API server
+        self.client.get_pods('foo', fields={'status.phase': 'Running'})
+        self.assertEqual(self.lists, lists + 1)
+
+    def test_watch_events_are_applied(self):
+        self.register({'metadata': {'resourceVersion': '10'}, 'items': [pod('foo-a', '9')]})
+        informer = self.informer()
+
+        self.watches.put(stream(
+            ('ADDED', pod('foo-b', '11')),
+            ('MODIFIED', pod('foo-a', '12', 'worker')),
+        ))
+        self.wait(lambda: informer.version == '12')
+        self.assertEqual(self.names(labels={'type': 'web'}), ['foo-b'])
+        self.assertEqual(self.names(labels={'type': 'worker'}), ['foo-a'])
+
+        self.watches.put(stream(('DELETED', pod('foo-b', '13'))))
+        self.wait(lambda: informer.version == '13')
+        self.assertEqual(self.names(), ['foo-a'])
+
+    def test_writes_bypass_cache_until_seen(self):
+        self.register({'metadata': {'resourceVersion': '10'}, 'items': [pod('foo-a', '9')]})
+        informer = self.informer()
+
+        self.adapter.register_uri('DELETE', URL + '/api/v1/namespaces/foo/pods/foo-a',
+                                  json=pod('foo-a', '15'))
+        self.adapter.register_uri('GET', URL + '/api/v1/namespaces/foo/pods/foo-a',
+                                  status_code=404, json={'kind': 'Status', 'code': 404})
+        self.client.delete_pod('foo', 'foo-a')
+        self.assertFalse(informer.fresh())
+
+        lists = self.lists
+        self.names()
+        self.assertEqual(self.lists, lists + 1)
+
+        # caught up with the write once the watch delivers it
+        self.watches.put(stream(('DELETED', pod('foo-a', '15'))))
+        self.wait(informer.fresh)
+        self.assertEqual(self.names(), [])
+
+    def test_stale_cache_is_bypassed(self):
+        self.register({'metadata': {'resourceVersion': '10'}, 'items': []})
+        informer = self.informer()
+
+        with override_settings(KUBERNETES_INFORMER_MAX_STALENESS=0):
+            self.assertFalse(informer.fresh())
+
+    def test_secret_from_cache(self):
+        value = base64.b64encode(b'hunter2').decode()
+        self.register({
+            'metadata': {'resourceVersion': '10'},
+            'items': [{'metadata': {'name': 'foo-env', 'resourceVersion': '10'},
+                       'data': {'password': value}}]
+        }, '/api/v1/namespaces/foo/secrets')
+        self.informer('secrets')
+        lists = self.lists
+
+        secret = self.client.get_secret('foo', 'foo-env').json()
+        self.assertEqual(secret['data'], {'password': 'hunter2'})
+        with self.assertRaises(KubeHTTPException) as e:
+            self.client.get_secret('foo', 'foo-gone')
+
+        self.assertEqual(e.exception.response.status_code, 404)
+        self.assertEqual(self.lists, lists)
+
+    def test_no_resource_version_stops_informer(self):
+        self.register({'items': [pod('foo-a', '9')]})
+        informer = self.client.informers.get('pods', 'foo')
+        self.wait(lambda: informer.stopped)
+        self.assertFalse(informer.fresh())
+
+        # reads go to the API server for a while, without starting another informer
+        lists = self.lists
+        self.assertEqual(self.names(), ['foo-a'])
+        self.assertEqual(self.names(), ['foo-a'])
+        self.assertEqual(self.lists, lists + 2)
+        self.assertIs(self.client.informers.get('pods', 'foo'), informer)
+
+        informer.retry = 0
+        self.assertIsNot(self.client.informers.get('pods', 'foo'), informer)
+
+    def test_disabled(self):
+        self.register({'metadata': {'resourceVersion': '10'}, 'items': [pod('foo-a', '9')]})
+        with override_settings(KUBERNETES_INFORMERS_ENABLED=False):
+            self.assertEqual(self.names(), ['foo-a'])
+
+        self.assertNotIn('_informers', self.client.__dict__)
@@ -0,0 +1,126 @@
+"""
+Unit tests for the indexed object store behind the mock scheduler.
+
+Run the tests with "./manage.py test api"
+"""
+import json
+import unittest
+from unittest import mock
+
+from django.core.cache import cache
+
+from deis import clock
+from scheduler import mock as mock_scheduler
+from scheduler.mock import MockSchedulerClient, Store
+
+
+def rc(name, replicas, labels):
+    return {
+        'kind': 'ReplicationController',
+        'metadata': {'name': name, 'labels': labels},
+        'spec': {
+            'replicas': replicas,
+            'selector': labels,
+            'template': {
+                'metadata': {'labels': labels},
+                'spec': {'containers': [{'name': 'foo-' + labels['type']}]}
+            }
+        }
+    }
+
+
+class MockStoreTest(unittest.TestCase):
+    """Test that the mock scheduler serves lists from indexes and keeps a log of watch events"""
+
+    def setUp(self):
+        self.client = MockSchedulerClient()
+        clock_patcher = mock.patch('deis.clock._clock', clock.VirtualClock(start=0))
+        clock_patcher.start()
+        self.addCleanup(clock_patcher.stop)
+        self.addCleanup(cache.clear)
+        cache.clear()
+        self.client.create_namespace('foo')
+
+    def create(self, name, replicas, **labels):
+        url = self.client._api('/namespaces/foo/replicationcontrollers')
+        response = self.client.session.post(url, json=rc(name, replicas, labels))
+        self.assertEqual(response.status_code, 201, response.text)
+
+    def test_label_index(self):
+        self.create('foo-web-v1', 3, app='foo', type='web', version='v1')
+        self.create('foo-worker-v1', 2, app='foo', type='worker', version='v1')
+
+        pods = self.client.get_pods('foo', labels={'type': 'web'}).json()
+        self.assertEqual(len(pods['items']), 3)
+        self.assertTrue(all(p['metadata']['labels']['type'] == 'web' for p in pods['items']))
+        self.assertEqual(len(self.client.get_pods('foo', labels={'app': 'foo'}).json()['items']), 5)  # noqa
+        self.assertEqual(self.client.get_pods('foo', labels={'type': 'cmd'}).json()['items'], [])
+
+        # lists carry the resourceVersion to watch from, writes move it along
+        version = int(pods['metadata']['resourceVersion'])
+        self.assertEqual(version, mock_scheduler.store.version)
+        self.assertTrue(all(int(p['metadata']['resourceVersion']) <= version for p in pods['items']))  # noqa
+
+        # a label change moves the object between index entries
+        data = self.client.get_rc('foo', 'foo-web-v1').json()
+        data['metadata']['labels']['version'] = 'v2'
+        self.client.update_rc('foo', 'foo-web-v1', data)
+        rcs = self.client.get_rcs('foo', labels={'version': 'v2'}).json()['items']
+        self.assertEqual([r['metadata']['name'] for r in rcs], ['foo-web-v1'])
+        self.assertEqual(len(self.client.get_rcs('foo', labels={'version': 'v1'}).json()['items']), 1)  # noqa
+
+    def test_pagination(self):
+        self.create('foo-web-v1', 5, app='foo', type='web')
+        url = self.client._api('/namespaces/foo/pods')
+
+        names, token = [], None
+        while True:
+            params = {'limit': 2}
+            if token:
+                params['continue'] = token
+
+            page = self.client.session.get(url, params=params).json()
+            self.assertLessEqual(len(page['items']), 2)
+            names += [p['metadata']['name'] for p in page['items']]
+            token = page['metadata'].get('continue')
+            if not token:
+                break
+
+        everything = self.client.get_pods('foo').json()['items']
+        self.assertEqual(names, [p['metadata']['name'] for p in everything])
+
+    def test_watch(self):
+        version = self.client.get_pods('foo').json()['metadata']['resourceVersion']
+        self.create('foo-web-v1', 2, app='foo', type='web')
+
+        events = list(self.client._watch('/namespaces/{}/pods', 'foo', resourceVersion=version))
+        self.assertEqual([e['type'] for e in events], ['ADDED', 'MODIFIED'] * 2)
+        self.assertEqual(events[-1]['object']['status']['phase'], 'Pending')
+
+        # nothing happened since, the watch waits a second and pods start running
+        version = events[-1]['object']['metadata']['resourceVersion']
+        events = []
+        while not events:
+            events = list(self.client._watch('/namespaces/{}/pods', 'foo', resourceVersion=version))  # noqa
+
+        self.assertGreaterEqual(clock.time(), 1)
+        self.assertEqual({e['object']['status']['phase'] for e in events}, {'Running'})
+
+        # deletes are events too
+        version = self.client.get_pods('foo').json()['metadata']['resourceVersion']
+        self.client.delete_namespace('foo')
+        events = list(self.client._watch('/namespaces/{}/pods', 'foo', resourceVersion=version))
+        self.assertEqual([e['type'] for e in events], ['DELETED'] * 2)
+        self.assertEqual(self.client.get_pods('foo').json()['items'], [])
+
+    def test_watch_compacted(self):
+        with mock.patch('scheduler.mock.store', Store(events=3)):
+            self.client.create_namespace('foo')
+            self.create('foo-web-v1', 2, app='foo', type='web')
+            response = self.client.session.get(
+                self.client._api('/namespaces/foo/pods'),
+                params={'watch': 'true', 'resourceVersion': 1}
+            )
+            event = json.loads(response.text.splitlines()[0])
+            self.assertEqual(event['type'], 'ERROR')
+            self.assertEqual(event['object']['code'], 410)
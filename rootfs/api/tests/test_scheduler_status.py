@@ -0,0 +1,161 @@
+"""
+Unit tests for evaluating Pod statuses once per resourceVersion and sharing Pod events
+within a poll cycle.
+
+Run the tests with "./manage.py test api"
+"""
+from datetime import timedelta
+import unittest
+from unittest import mock
+
+from django.conf import settings
+import requests
+import requests_mock
+
+from deis import clock
+from scheduler import KubeHTTPClient
+from scheduler.states import PodState
+from scheduler.status import PodEvents, PodStatus, PodStatuses
+
+URL = 'http://test-scheduler.example.com'
+
+
+def pod(version, phase='Running', ready=True, uid='1234', deletion=None):
+    metadata = {
+        'name': 'foo-web-1',
+        'uid': uid,
+        'resourceVersion': version,
+        'labels': {'app': 'foo', 'type': 'web'}
+    }
+    if deletion is not None:
+        metadata['deletionTimestamp'] = deletion.strftime(settings.DEIS_DATETIME_FORMAT)
+
+    return {
+        'metadata': metadata,
+        'status': {
+            'phase': phase,
+            'conditions': [{'type': 'Ready', 'status': 'True' if ready else 'False'}],
+            'containerStatuses': [
+                {'name': 'foo-web', 'ready': ready, 'state': {'running': {}}}
+            ]
+        }
+    }
+
+
+class PodStatusTest(unittest.TestCase):
+    """Test that Pod statuses are evaluated once and reused until the Pod changes"""
+
+    def setUp(self):
+        self.client = KubeHTTPClient.__new__(KubeHTTPClient)
+        statuses = mock.patch('scheduler.pod_statuses', PodStatuses())
+        self.statuses = statuses.start()
+        self.addCleanup(statuses.stop)
+
+    def test_evaluated_once_per_version(self):
+        with mock.patch('scheduler.status.PodStatus', wraps=PodStatus) as evaluate:
+            running = pod('1')
+            for _ in range(3):
+                self.assertEqual(self.client.pod_state(running), PodState.up)
+                self.assertTrue(self.client._pod_ready(running))
+                self.assertFalse(self.client.pod_deleted(running))
+
+            self.assertEqual(evaluate.call_count, 1)
+
+            # a new resourceVersion is a new evaluation
+            starting = pod('2', ready=False)
+            self.assertEqual(self.client.pod_state(starting), PodState.starting)
+            self.assertFalse(self.client._pod_ready(starting))
+            self.assertEqual(evaluate.call_count, 2)
+
+            # without uid there is nothing to key on
+            anonymous = pod('1')
+            del anonymous['metadata']['uid']
+            self.client.pod_state(anonymous)
+            self.client.pod_state(anonymous)
+            self.assertEqual(evaluate.call_count, 4)
+
+    def test_deletion(self):
+        now = clock.VirtualClock()
+        with mock.patch('deis.clock._clock', now):
+            past = pod('3', deletion=now.utcnow() - timedelta(seconds=5))
+            self.assertTrue(self.client.pod_deleted(past))
+            self.assertEqual(self.client.pod_state(past), PodState.terminating)
+
+            # the deadline is compared against the clock on every call
+            future = pod('4', deletion=now.utcnow() + timedelta(seconds=30))
+            self.assertFalse(self.client.pod_deleted(future))
+            now.sleep(60)
+            self.assertTrue(self.client.pod_deleted(future))
+
+    def test_pending_waiting_reason(self):
+        pending = pod('5', phase='Pending')
+        pending['status']['containerStatuses'][0]['state'] = {
+            'waiting': {'reason': 'ErrImagePull', 'message': 'not found'}
+        }
+        self.assertEqual(self.client._pod_pending_status(pending), ('ErrImagePull', 'not found'))
+        self.assertEqual(self.client.pod_state(pending), 'ErrImagePull')
+
+        # container creation is explained by the latest event, which is not cached
+        pending = pod('6', phase='Pending')
+        pending['status']['containerStatuses'][0]['state'] = {
+            'waiting': {'reason': 'ContainerCreating'}
+        }
+        events = [[{'reason': 'Pulling', 'message': 'pulling'}],
+                  [{'reason': 'Pulled', 'message': 'pulled'}]]
+        with mock.patch.object(self.client, '_pod_events', side_effect=events):
+            self.assertEqual(self.client._pod_pending_status(pending), ('Pulling', 'pulling'))
+            self.assertEqual(self.client._pod_pending_status(pending), ('Pulled', 'pulled'))
+
+    def test_least_recently_used_evicted(self):
+        statuses = PodStatuses(size=2)
+        first = statuses.get(pod('1', uid='a'))
+        statuses.get(pod('1', uid='b'))
+        self.assertIs(statuses.get(pod('1', uid='a')), first)
+        statuses.get(pod('1', uid='c'))
+        self.assertEqual(set(statuses.items), {('a', '1'), ('c', '1')})
+
+    def test_slots(self):
+        status = PodStatus(pod('1'))
+        with self.assertRaises(AttributeError):
+            status.extra = True
+
+    def test_events_fetched_once_per_cycle(self):
+        adapter = requests_mock.Adapter()
+        self.client.url = URL
+        self.client.session = requests.Session()
+        self.client.session.mount(URL, adapter)
+
+        now = clock.utcnow()
+        pods = []
+        for uid in ['a', 'b', 'c']:
+            pending = pod('1', phase='Pending', uid=uid)
+            pending['metadata']['namespace'] = 'foo'
+            pending['status']['containerStatuses'][0]['state'] = {
+                'waiting': {'reason': 'ContainerCreating'}
+            }
+            pods.append(pending)
+
+        def event(uid, reason, minutes):
+            timestamp = (now - timedelta(minutes=minutes)).strftime(settings.DEIS_DATETIME_FORMAT)
+            return {
+                'involvedObject': {'kind': 'Pod', 'uid': uid},
+                'reason': reason, 'message': reason.lower(),
+                'firstTimestamp': timestamp, 'lastTimestamp': timestamp
+            }
+
+        events = adapter.register_uri('GET', URL + '/api/v1/namespaces/foo/events', json={
+            'items': [event('a', 'Pulling', 5), event('a', 'Scheduled', 6),
+                      event('b', 'Scheduled', 1), event('c', 'Failed', 1)]
+        })
+        cycle = PodEvents(self.client, 'foo')
+        reasons = [self.client._pod_pending_status(p, cycle)[0] for p in pods]
+        self.assertEqual(reasons, ['Pulling', 'Scheduled', 'Failed'])
+        # pulling for over a minute extends the timeout
+        extension = self.client._handle_pod_long_image_pulling(pods[0], 'Pulling', cycle)
+        self.assertEqual(extension, 600)
+        self.assertEqual(events.call_count, 1)
+        self.assertEqual(events.last_request.qs['fieldselector'], ['involvedobject.kind=pod'])
+
+        # without a cycle every pod is a request of its own
+        self.client._pod_pending_status(pods[1])
+        self.assertEqual(events.call_count, 2)
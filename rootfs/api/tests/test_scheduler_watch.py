@@ -0,0 +1,140 @@
+"""
+Unit tests for following Kubernetes resources via the watch API.
+
+Run the tests with "./manage.py test api"
+"""
+import json
+import unittest
+from unittest import mock
+
+import requests
+import requests_mock
+
+from scheduler import KubeHTTPClient
+
+URL = 'http://test-scheduler.example.com'
+
+
+def pod(name, version, phase='Running'):
+    return {
+        'metadata': {'name': name, 'resourceVersion': version},
+        'status': {'phase': phase}
+    }
+
+
+def stream(*events):
+    return '\n'.join(json.dumps({'type': kind, 'object': obj}) for kind, obj in events)
+
+
+class SchedulerWatchTest(unittest.TestCase):
+    """Test that resources are listed once and followed via watch events"""
+
+    def setUp(self):
+        self.adapter = requests_mock.Adapter()
+        self.client = KubeHTTPClient.__new__(KubeHTTPClient)
+        self.client.url = URL
+        self.client.session = requests.Session()
+        self.client.session.mount(URL, self.adapter)
+
+        self.lists = 0
+        self.watches = []
+
+    def register(self, listing, watches, path='/api/v1/namespaces/foo/pods'):
+        def callback(request, context):
+            if 'watch' not in request.qs:
+                self.lists += 1
+                return json.dumps(listing.pop(0) if len(listing) > 1 else listing[0])
+
+            self.watches.append(request.qs)
+            if not watches:
+                # simulate a dropped connection once all streams are consumed
+                raise requests.exceptions.ConnectionError('stream closed')
+
+            return watches.pop(0)
+
+        self.adapter.register_uri('GET', URL + path, text=callback)
+
+    def test_watch_applies_events(self):
+        listing = [{'metadata': {'resourceVersion': '10'}, 'items': [pod('foo-a', '9')]}]
+        watches = [stream(
+            ('MODIFIED', pod('foo-a', '11', 'Succeeded')),
+            ('ADDED', pod('foo-b', '12')),
+            ('DELETED', pod('foo-a', '13')),
+        )]
+        self.register(listing, watches)
+
+        observed = []
+        for pods in self.client._observe('foo', 'pods', labels={'app': 'foo'}):
+            observed.append(sorted((p['metadata']['name'], p['status']['phase']) for p in pods))
+            if len(observed) == 4:
+                break
+
+        self.assertEqual(observed, [
+            [('foo-a', 'Running')],
+            [('foo-a', 'Succeeded')],
+            [('foo-a', 'Succeeded'), ('foo-b', 'Running')],
+            [('foo-b', 'Running')],
+        ])
+        # listed only once and watched from the listed resourceVersion
+        self.assertEqual(self.lists, 1)
+        self.assertEqual(self.watches[0]['resourceversion'], ['10'])
+        self.assertEqual(self.watches[0]['labelselector'], ['app=foo'])
+
+    def test_watch_resumes_from_last_version(self):
+        listing = [{'metadata': {'resourceVersion': '10'}, 'items': []}]
+        watches = [
+            stream(('ADDED', pod('foo-a', '11'))),
+            stream(('ADDED', pod('foo-b', '12'))),
+        ]
+        self.register(listing, watches)
+
+        names = []
+        for pods in self.client._observe('foo', 'pods'):
+            names = sorted(p['metadata']['name'] for p in pods)
+            if names == ['foo-a', 'foo-b']:
+                break
+
+        self.assertEqual(self.lists, 1)
+        self.assertEqual([w['resourceversion'] for w in self.watches], [['10'], ['11']])
+
+    def test_watch_relists_when_version_is_gone(self):
+        listing = [
+            {'metadata': {'resourceVersion': '10'}, 'items': []},
+            {'metadata': {'resourceVersion': '20'}, 'items': [pod('foo-a', '19')]},
+        ]
+        gone = {'kind': 'Status', 'code': 410, 'message': 'too old resource version'}
+        watches = [stream(('ERROR', gone))]
+        self.register(listing, watches)
+
+        for pods in self.client._observe('foo', 'pods'):
+            if pods:
+                break
+
+        self.assertEqual(self.lists, 2)
+
+    @mock.patch('deis.clock.sleep')
+    def test_polling_fallback(self, mock_sleep):
+        # no resourceVersion means watching is not possible
+        listing = [{'items': []}, {'items': [pod('foo-a', '1')]}]
+        self.register(listing, [])
+
+        for pods in self.client._observe('foo', 'pods'):
+            if pods:
+                break
+
+        self.assertEqual(self.lists, 2)
+        self.assertEqual(self.watches, [])
+        mock_sleep.assert_called_once_with(1)
+
+    def test_watch_deployments(self):
+        listing = [{'metadata': {'resourceVersion': '10'}, 'items': []}]
+        watches = [stream(('ADDED', pod('foo-web', '11')))]
+        path = '/apis/extensions/v1beta1/namespaces/foo/deployments'
+        self.register(listing, watches, path)
+
+        for deployments in self.client._observe('foo', 'deployments'):
+            if deployments:
+                break
+
+        self.assertEqual(self.lists, 1)
+        self.assertEqual(self.watches[0]['resourceversion'], ['10'])
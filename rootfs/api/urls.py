@@ -23,6 +23,9 @@ urlpatterns = [
         views.BuildViewSet.as_view({'get': 'retrieve'})),
     url(r"^apps/(?P<id>{})/builds/?".format(settings.APP_URL_REGEX),
         views.BuildViewSet.as_view({'get': 'list', 'post': 'create'})),
+    url(r"^apps/(?P<id>{})/releases/v(?P<version>[0-9]+)/trace/?".format(
+        settings.APP_URL_REGEX),
+        views.ReleaseViewSet.as_view({'get': 'trace'})),
     url(r"^apps/(?P<id>{})/releases/v(?P<version>[0-9]+)/?".format(settings.APP_URL_REGEX),
         views.ReleaseViewSet.as_view({'get': 'retrieve'})),
     url(r"^apps/(?P<id>{})/releases/rollback/?".format(settings.APP_URL_REGEX),
@@ -50,6 +53,11 @@ urlpatterns = [
         views.DomainViewSet.as_view({'delete': 'destroy'})),
     url(r"^apps/(?P<id>{})/domains/?".format(settings.APP_URL_REGEX),
         views.DomainViewSet.as_view({'post': 'create', 'get': 'list'})),
+    # application operations
+    url(r"^apps/(?P<id>{})/operations/(?P<uuid>[-_\w]+)/?".format(settings.APP_URL_REGEX),
+        views.OperationViewSet.as_view({'get': 'retrieve'})),
+    url(r"^apps/(?P<id>{})/operations/?".format(settings.APP_URL_REGEX),
+        views.OperationViewSet.as_view({'get': 'list'})),
     # application actions
     url(r"^apps/(?P<id>{})/scale/?".format(settings.APP_URL_REGEX),
         views.AppViewSet.as_view({'post': 'scale'})),
@@ -1,7 +1,7 @@
 """
 RESTful view classes for presenting Deis API objects.
 """
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
@@ -17,8 +17,12 @@ from rest_framework.authtoken.models import Token
 
 from api import authentication, models, permissions, serializers, viewsets
 from api.models import AlreadyExists, ServiceUnavailable, DeisException
+from deis import clock, metrics
 
+import codecs
+import json
 import logging
+import math
 
 logger = logging.getLogger(__name__)
 
@@ -51,6 +55,16 @@ class LivenessCheckView(View):
     head = get
 
 
+class MetricsView(View):
+    """
+    Kubernetes API client and app operation metrics of all workers in the
+    Prometheus text format.
+    """
+
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
+
+
 class UserRegistrationViewSet(GenericViewSet,
                               mixins.CreateModelMixin):
     """ViewSet to handle registering new users. The logic is in the serializer."""
@@ -150,6 +164,26 @@ class BaseDeisViewSet(viewsets.OwnerViewSet):
     permission_classes = [IsAuthenticated, permissions.IsAppUser]
     renderer_classes = [renderers.JSONRenderer]
 
+    def prefers_async(self):
+        """Check if the client asked for long running work to happen in the background"""
+        # preferences are advisory, without workers nobody would ever pick the work up
+        if settings.DEIS_OPERATION_WORKERS <= 0:
+            return False
+
+        # https://tools.ietf.org/html/rfc7240#section-4.1
+        preferences = self.request.META.get('HTTP_PREFER', '').split(',')
+        return 'respond-async' in [p.split(';')[0].strip().lower() for p in preferences]
+
+    def accepted(self, operation, **extra):
+        """Point the client at the operation carrying out the work"""
+        data = serializers.OperationSerializer(operation).data
+        data.update(extra)
+        headers = {
+            'Location': '/v2/apps/{}/operations/{}'.format(operation.app.id, operation.uuid),
+            'Preference-Applied': 'respond-async'
+        }
+        return Response(data, status=status.HTTP_202_ACCEPTED, headers=headers)
+
 
 class AppResourceViewSet(BaseDeisViewSet):
     """A viewset for objects which are attached to an application."""
@@ -204,7 +238,13 @@ class AppViewSet(BaseDeisViewSet):
         return Response(serializer.data)
 
     def scale(self, request, **kwargs):
-        self.get_object().scale(request.user, request.data)
+        app = self.get_object()
+        if self.prefers_async():
+            params = {'structure': request.data}
+            operation = models.Operation.start(request.user, app, 'scale', params)
+            return self.accepted(operation)
+
+        app.scale(request.user, request.data)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def logs(self, request, **kwargs):
@@ -222,9 +262,38 @@ class AppViewSet(BaseDeisViewSet):
 
     def run(self, request, **kwargs):
         app = self.get_object()
+        if self.prefers_async():
+            # detached, the pod name is the job id to follow it by
+            params = {'command': request.data['command'], 'name': app.run_name()}
+            operation = models.Operation.start(request.user, app, 'run', params)
+            return self.accepted(operation, job=params['name'])
+
+        if str(request.data.get('stream', '')).lower() in ['1', 'true', 'yes']:
+            run = app.run(self.request.user, request.data['command'], stream=True)
+            return StreamingHttpResponse(self._stream_run(app, run),
+                                         content_type='application/x-ndjson')
+
         rc, output = app.run(self.request.user, request.data['command'])
         return Response({'exit_code': rc, 'output': str(output)})
 
+    def _stream_run(self, app, run):
+        """One JSON document per line: output as it comes in, then the exit code or error"""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        try:
+            for kind, data in run:
+                if kind == 'output':
+                    data = decoder.decode(data)
+                    if not data:
+                        continue
+
+                yield json.dumps({kind: data}) + '\n'
+        except Exception as e:
+            # the response is underway, the status code can not change anymore
+            logger.error('{} (run): {}'.format(app.id, e))
+            yield json.dumps({'error': str(e)}) + '\n'
+        finally:
+            run.close()
+
     def update(self, request, **kwargs):
         app = self.get_object()
 
@@ -242,8 +311,22 @@ class BuildViewSet(ReleasableViewSet):
     model = models.Build
     serializer_class = serializers.BuildSerializer
 
+    def create(self, request, **kwargs):
+        response = super(BuildViewSet, self).create(request, **kwargs)
+        if getattr(self, 'operation', None) is not None:
+            return self.accepted(self.operation, build=response.data)
+
+        return response
+
     def post_save(self, build):
-        self.release = build.create(self.request.user)
+        if self.prefers_async():
+            self.release = build.new_release(self.request.user)
+            self.operation = models.Operation.start(
+                self.request.user, build.app, 'deploy',
+                {'release': str(self.release.uuid), 'build': str(build.uuid)}
+            )
+        else:
+            self.release = build.create(self.request.user)
         super(BuildViewSet, self).post_save(build)
 
 
@@ -252,9 +335,23 @@ class ConfigViewSet(ReleasableViewSet):
     model = models.Config
     serializer_class = serializers.ConfigSerializer
 
+    def create(self, request, **kwargs):
+        response = super(ConfigViewSet, self).create(request, **kwargs)
+        if getattr(self, 'operation', None) is not None:
+            return self.accepted(self.operation, config=response.data)
+
+        return response
+
     def post_save(self, config):
         release = config.app.release_set.latest()
         self.release = release.new(self.request.user, config=config, build=release.build)
+        # It's possible to set config values before a build
+        if self.release.build is not None and self.prefers_async():
+            self.operation = models.Operation.start(
+                self.request.user, config.app, 'deploy', {'release': str(self.release.uuid)}
+            )
+            return
+
         try:
             # It's possible to set config values before a build
             if self.release.build is not None:
@@ -276,7 +373,13 @@ class PodViewSet(AppResourceViewSet):
         return Response(pagination, status=status.HTTP_200_OK)
 
     def restart(self, *args, **kwargs):
-        pods = self.get_app().restart(**kwargs)
+        app = self.get_app()
+        if self.prefers_async():
+            params = {k: v for k, v in kwargs.items() if k != 'id'}
+            operation = models.Operation.start(self.request.user, app, 'restart', params)
+            return self.accepted(operation)
+
+        pods = app.restart(**kwargs)
         data = self.get_serializer(pods, many=True).data
         # fake out pagination for now
         # pagination = {'results': data, 'count': len(data)}
@@ -284,6 +387,31 @@ class PodViewSet(AppResourceViewSet):
         return Response(pagination, status=status.HTTP_200_OK)
 
 
+class OperationViewSet(AppResourceViewSet):
+    """A viewset for following the progress of background work on an application."""
+    model = models.Operation
+    serializer_class = serializers.OperationSerializer
+
+    def get_object(self, **kwargs):
+        operation = get_object_or_404(self.get_queryset(), uuid=self.kwargs['uuid'])
+
+        # long-poll until the operation is done or the client stops waiting
+        try:
+            wait = float(self.request.query_params.get('wait', 0))
+        except ValueError:
+            wait = None
+
+        if wait is None or not math.isfinite(wait):
+            raise DeisException('wait has to be a number of seconds')
+
+        deadline = clock.time() + min(wait, settings.DEIS_OPERATION_MAX_WAIT)
+        while not operation.done and clock.time() < deadline:
+            clock.sleep(0.5)
+            operation.refresh_from_db()
+
+        return operation
+
+
 class DomainViewSet(AppResourceViewSet):
     """A viewset for interacting with Domain objects."""
     model = models.Domain
@@ -350,6 +478,11 @@ class ReleaseViewSet(AppResourceViewSet):
         response = {'version': new_release.version}
         return Response(response, status=status.HTTP_201_CREATED)
 
+    def trace(self, request, **kwargs):
+        """Span trees of the deploys, scales and rollbacks of a release, oldest first"""
+        release = self.get_object()
+        return Response({'version': release.version, 'traces': release.traces})
+
 
 class BaseHookViewSet(BaseDeisViewSet):
     permission_classes = [permissions.HasBuilderAuth]
@@ -459,10 +592,20 @@ class BuildHookViewSet(BaseHookViewSet):
         super(BuildHookViewSet, self).create(request, *args, **kwargs)
         # return the application databag
         response = {'release': {'version': app.release_set.latest().version}}
+        if getattr(self, 'operation', None) is not None:
+            return self.accepted(self.operation, **response)
+
         return Response(response, status=status.HTTP_200_OK)
 
     def post_save(self, build):
-        build.create(self.user)
+        if self.prefers_async():
+            release = build.new_release(self.user)
+            self.operation = models.Operation.start(
+                self.user, build.app, 'deploy',
+                {'release': str(release.uuid), 'build': str(build.uuid)}
+            )
+        else:
+            build.create(self.user)
 
 
 class ConfigHookViewSet(BaseHookViewSet):
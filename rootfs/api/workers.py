@@ -0,0 +1,136 @@
+"""
+Local worker pool that carries out queued :class:`~api.models.Operation` objects.
+
+The operation table in Postgres is the queue. Every controller process runs a few
+worker threads which claim pending operations with a conditional update, so no
+external broker is needed and any process can pick up work queued by another.
+One more thread garbage collects release history, see :mod:`api.retention`.
+"""
+from datetime import timedelta
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from api import retention
+from api.models import Operation
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool(object):
+
+    def __init__(self, size, interval):
+        self.size = size
+        self.interval = interval
+        self.event = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for i in range(self.size):
+            thread = threading.Thread(
+                target=self.work,
+                name='operation-worker-{}'.format(i),
+                daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+        if settings.DEIS_RELEASE_GC_INTERVAL > 0:
+            thread = threading.Thread(target=self.collect, name='release-gc', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        logger.info('started {} operation workers in process {}'.format(self.size, os.getpid()))
+
+    def wake(self):
+        self.event.set()
+
+    def work(self):
+        name = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), threading.current_thread().name)  # noqa
+        while True:
+            # poll every now and then in case work was queued up by a different process
+            self.event.wait(self.interval)
+            self.event.clear()
+            try:
+                while process(name):
+                    pass
+            except Exception as e:
+                logger.error('operation worker {} ran into a problem: {}'.format(name, e))
+            finally:
+                connection.close()
+
+    def collect(self):
+        """Garbage collect release history every now and then"""
+        while True:
+            time.sleep(settings.DEIS_RELEASE_GC_INTERVAL)
+            try:
+                close_old_connections()
+                retention.collect_exclusively()
+            except Exception as e:
+                logger.error('release garbage collection ran into a problem: {}'.format(e))
+            finally:
+                connection.close()
+
+
+def process(worker):
+    """
+    Claim and carry out the oldest pending operation
+
+    Returns False when there was nothing to do
+    """
+    close_old_connections()
+    expire()
+
+    pending = Operation.objects.filter(state=Operation.PENDING).order_by('created')
+    for operation in pending[:10]:
+        if operation.claim(worker):
+            logger.info('{} picked up {}'.format(worker, operation))
+            operation.execute()
+            return True
+
+    return False
+
+
+def expire():
+    """
+    Fail running operations that have not been touched in a long time, their
+    worker went away. Workers touch the operations they carry out every now and
+    then, see :meth:`~api.models.Operation.execute`. They are not retried since
+    deploys etc are not idempotent
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.DEIS_OPERATION_EXPIRY_SECONDS)
+    Operation.objects.filter(state=Operation.RUNNING, updated__lt=cutoff).update(
+        state=Operation.FAILED, progress=Operation.FAILED, finished=timezone.now(),
+        error='the worker carrying out this operation went away'
+    )
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the worker pool of this process, starting it on first use"""
+    pid = os.getpid()
+    if pid in _pools:
+        return _pools[pid]
+
+    with _pools_lock:
+        if pid not in _pools:
+            pool = WorkerPool(settings.DEIS_OPERATION_WORKERS, settings.DEIS_OPERATION_POLL_INTERVAL)  # noqa
+            pool.start()
+            _pools[pid] = pool
+
+        return _pools[pid]
+
+
+def wake():
+    """Let a worker know there is work. Without workers configured this does nothing"""
+    if settings.DEIS_OPERATION_WORKERS > 0:
+        get_pool().wake()
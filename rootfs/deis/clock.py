@@ -0,0 +1,73 @@
+"""
+The time waits on Kubernetes and the router are measured in.
+
+The scheduler client, the mock scheduler and the router health checks read the time
+and sleep through the installed clock, the real one unless :func:`install` swapped
+it. A :class:`VirtualClock` only moves when something sleeps on it, so the test suite
+goes through rollouts and timeouts without waiting and the same way every run.
+"""
+from datetime import datetime
+import threading
+import time as _time
+
+
+class Clock(object):
+    """The wall clock"""
+
+    def time(self):
+        return _time.time()
+
+    def utcnow(self):
+        return datetime.utcnow()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """A clock that sleeping moves forward right away instead of waiting on"""
+
+    def __init__(self, start=None):
+        self.lock = threading.Lock()
+        self.now = _time.time() if start is None else start
+
+    def time(self):
+        return self.now
+
+    def utcnow(self):
+        return datetime.utcfromtimestamp(self.now)
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        # threads of a concurrent rollout sleep on the same clock
+        with self.lock:
+            self.now += max(0, seconds)
+
+
+_clock = Clock()
+
+
+def get():
+    """The installed clock"""
+    return _clock
+
+
+def install(clock):
+    """Make clock the one of the whole process and return the previous one"""
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+
+def time():
+    return _clock.time()
+
+
+def utcnow():
+    return _clock.utcnow()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
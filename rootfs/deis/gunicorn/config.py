@@ -22,6 +22,15 @@ accesslog = '-'
 access_log_format = '%(h)s "%(r)s" %(s)s %(b)s "%(a)s"'
 
 
+def on_starting(server):
+    """Start from zero, metrics written by a previous master do not belong to this one"""
+    # the master does not load Django settings, same default as there
+    directory = os.environ.get('DEIS_METRICS_DIR', '/tmp/deis-metrics')
+    if directory:
+        import shutil
+        shutil.rmtree(directory, ignore_errors=True)
+
+
 def worker_int(worker):
     """Print a stack trace when a worker receives a SIGINT or SIGQUIT signal."""
     worker.log.warning('worker terminated')
@@ -34,3 +43,17 @@ def worker_abort(worker):
     worker.log.warning('worker aborted')
     import traceback
     traceback.print_stack()
+
+
+def worker_exit(server, worker):
+    """Add the metrics of the worker to the retired totals, the last few were not written yet"""
+    from deis import metrics
+    metrics.retire()
+
+
+def post_worker_init(worker):
+    """Start the operation workers of this process, they pick up work queued before it started"""
+    from django.conf import settings
+    if settings.DEIS_OPERATION_WORKERS > 0:
+        from api.workers import get_pool
+        get_pool()
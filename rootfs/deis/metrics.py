@@ -0,0 +1,321 @@
+"""
+Process metrics in the Prometheus text format.
+
+Every process records counters and histograms in memory and writes a snapshot of
+them to DEIS_METRICS_DIR now and then, /metrics adds up the snapshots of all gunicorn
+workers. A snapshot is named after the pid and the start of its process, so a worker that
+gets the pid of an earlier one does not overwrite it. Snapshots of workers that went away
+are added to the retired totals, so counters do not go back and files do not pile up.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import fcntl
+from functools import wraps
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a quick API call up to a rollout
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+METRICS = {
+    'deis_kubernetes_requests_total': (
+        'counter', 'Requests sent to the Kubernetes API server'),
+    'deis_kubernetes_request_duration_seconds': (
+        'histogram', 'Time until the Kubernetes API server responded'),
+    'deis_app_operation_duration_seconds': (
+        'histogram', 'Duration of app deploys, scales and restarts by outcome'),
+}
+
+# totals of the processes that went away
+RETIRED = 'retired.json'
+
+
+class Registry(object):
+    """Counters and histograms of this process, keyed by name and sorted labels"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+        self.histograms = {}
+        self.flushed = 0
+        self.pid = None
+        self.started = None
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+        self.flush()
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            # bucket counts, then sum and count
+            histogram = self.histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+
+            histogram[-2] += value
+            histogram[-1] += 1
+
+        self.flush()
+
+    def snapshot(self, clear=False):
+        with self.lock:
+            data = {
+                'counters': [[name, dict(labels), value]
+                             for (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), list(values)]
+                               for (name, labels), values in self.histograms.items()],
+            }
+            if clear:
+                self.counters.clear()
+                self.histograms.clear()
+
+            return data
+
+    def flush(self, force=False):
+        """Write the snapshot of this process, at most once per DEIS_METRICS_FLUSH_INTERVAL"""
+        directory = settings.DEIS_METRICS_DIR
+        if not directory:
+            return
+
+        now = time.time()
+        if not force and now - self.flushed < settings.DEIS_METRICS_FLUSH_INTERVAL:
+            return
+
+        self.flushed = now
+        path = self.path(directory)
+        try:
+            # retiring does not race a write of what it already counted
+            with _locked(directory, fcntl.LOCK_SH):
+                # readers never see a half written file
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(self.snapshot(), f)
+
+                os.replace(path + '.tmp', path)
+        except OSError as e:
+            logger.warning('could not write metrics to {}: {}'.format(path, e))
+
+    def path(self, directory):
+        """The snapshot file of this process"""
+        pid = os.getpid()
+        if self.pid != pid:
+            # a new process, forked ones included
+            self.pid, self.started = pid, int(time.time() * 1000)
+
+        return os.path.join(directory, '{}-{}.json'.format(self.pid, self.started))
+
+    def retire(self):
+        """Add everything this process recorded to the retired totals, on its way out"""
+        directory = settings.DEIS_METRICS_DIR
+        if not directory:
+            return
+
+        try:
+            with _locked(directory, fcntl.LOCK_EX):
+                # whatever is recorded after this starts over from zero
+                _retire(directory, [os.path.basename(self.path(directory))],
+                        [self.snapshot(clear=True)])
+        except OSError as e:
+            logger.warning('could not retire metrics to {}: {}'.format(directory, e))
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+registry = Registry()
+
+
+def inc(name, labels, value=1):
+    registry.inc(name, labels, value)
+
+
+def observe(name, labels, value):
+    registry.observe(name, labels, value)
+
+
+def retire():
+    registry.retire()
+
+
+def timed(operation):
+    """Record how long a method took and whether it raised"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(operation):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def measure(operation):
+    start = time.time()
+    outcome = 'failure'
+    try:
+        yield
+        outcome = 'success'
+    finally:
+        observe('deis_app_operation_duration_seconds',
+                {'operation': operation, 'outcome': outcome}, time.time() - start)
+
+
+def snapshots():
+    """Snapshots of all processes, or only of this one when they are not shared"""
+    directory = settings.DEIS_METRICS_DIR
+    if not directory:
+        return [registry.snapshot()]
+
+    registry.flush(force=True)
+    # workers that died without retiring, e.g. killed on a timeout
+    gone = [name for name in _processes(directory) if not _alive(int(name.split('-')[0]))]
+    if gone:
+        with _locked(directory, fcntl.LOCK_EX):
+            _retire(directory, gone)
+
+    found = []
+    with _locked(directory, fcntl.LOCK_SH):
+        for name in [RETIRED] + _processes(directory):
+            snapshot = _read(os.path.join(directory, name))
+            if snapshot is not None:
+                found.append(snapshot)
+
+    return found
+
+
+def _processes(directory):
+    """Snapshot files of processes, named <pid>-<start>.json"""
+    return sorted(name for name in os.listdir(directory)
+                  if name.endswith('.json') and name != RETIRED)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning('skipping metrics snapshot {}: {}'.format(path, e))
+        return None
+
+
+@contextmanager
+def _locked(directory, operation):
+    """Retiring and reading snapshots take turns, so nothing is counted twice or missed"""
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, operation)
+        yield
+
+
+def _retire(directory, names, snapshots=()):
+    """
+    Add the snapshots of processes that went away to the retired totals and remove
+    their files, holding the lock
+    """
+    retired = os.path.join(directory, RETIRED)
+    found = [_read(retired)] + list(snapshots)
+    if not snapshots:
+        found += [_read(os.path.join(directory, name)) for name in names]
+
+    counters, histograms = aggregate(snapshot for snapshot in found if snapshot is not None)
+    with open(retired + '.tmp', 'w') as f:
+        json.dump({
+            'counters': [[name, dict(labels), value]
+                         for (name, labels), value in counters.items()],
+            'histograms': [[name, dict(labels), values]
+                           for (name, labels), values in histograms.items()],
+        }, f)
+
+    os.replace(retired + '.tmp', retired)
+    for name in names:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+
+
+def aggregate(found):
+    counters = defaultdict(float)
+    histograms = {}
+    for snapshot in found:
+        for name, labels, value in snapshot['counters']:
+            counters[(name, tuple(sorted(labels.items())))] += value
+
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+
+    return counters, histograms
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+
+    escaped = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))  # noqa
+               for k, v in pairs]
+    return '{' + ','.join(escaped) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render():
+    """All metrics of all processes in the Prometheus text exposition format"""
+    counters, histograms = aggregate(snapshots())
+    lines = []
+    for name, (kind, text) in sorted(METRICS.items()):
+        lines.append('# HELP {} {}'.format(name, text))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        if kind == 'counter':
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+
+            continue
+
+        for (metric, labels), values in sorted(histograms.items()):
+            if metric != name:
+                continue
+
+            # buckets are cumulative already
+            for bound, count in zip(BUCKETS, values):
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels, le=bound), count))
+
+            lines.append('{}_bucket{} {}'.format(name, _labels(labels, le='+Inf'), values[-1]))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(values[-2])))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), values[-1]))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,169 @@
+"""
+Span trees of deploys, scales and rollbacks.
+
+An operation starts a trace with :func:`start` and everything it calls, down to the
+scheduler, records timed steps in it with :func:`span` or :func:`traced`. Outside of
+a trace those do nothing. The current span is kept per thread, :func:`bind` hands it
+to work that runs on a thread pool.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+import inspect
+import threading
+import time
+
+# spans are often shorter than a second
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+_local = threading.local()
+
+
+def _value(value):
+    """Attribute values end up in JSON, anything JSON has no type for as a string"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+
+    if isinstance(value, dict):
+        return {str(k): _value(v) for k, v in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [_value(v) for v in value]
+
+    return str(value)
+
+
+class Span(object):
+    """A timed step of an operation and the steps it took in turn"""
+
+    __slots__ = ('name', 'parent', 'attributes', 'spans', 'started', 'duration', 'error',
+                 '_clock')
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.parent = parent
+        self.attributes = {k: _value(v) for k, v in (attributes or {}).items()}
+        self.spans = []
+        self.started = datetime.utcnow()
+        self.duration = None
+        self.error = None
+        self._clock = time.monotonic()
+        if parent is not None:
+            # appending is atomic, spans of other threads need no lock
+            parent.spans.append(self)
+
+    def finish(self):
+        self.duration = time.monotonic() - self._clock
+
+    def as_dict(self, origin=None):
+        """The span tree with offsets in seconds since the start of the root span"""
+        origin = self.started if origin is None else origin
+        data = {
+            'name': self.name,
+            'start': self.started.strftime(DATETIME_FORMAT),
+            'offset': round((self.started - origin).total_seconds(), 3),
+            # still running when the tree was taken, e.g. an abandoned thread
+            'duration': round(self.duration, 3) if self.duration is not None else None,
+        }
+        if self.attributes:
+            data['attributes'] = self.attributes
+
+        if self.error is not None:
+            data['error'] = self.error
+
+        if self.spans:
+            data['spans'] = [child.as_dict(origin) for child in list(self.spans)]
+
+        return data
+
+
+def current():
+    """The span running on this thread, or None outside of a trace"""
+    return getattr(_local, 'span', None)
+
+
+@contextmanager
+def _enter(span):
+    previous = current()
+    _local.span = span
+    try:
+        yield span
+    except Exception as e:
+        span.error = str(e) or e.__class__.__name__
+        raise
+    finally:
+        span.finish()
+        _local.span = previous
+
+
+def start(name, attributes=None):
+    """
+    Start a trace, or a span of the trace already running on this thread. The
+    caller of a span without a parent is the one that keeps the tree
+    """
+    return _enter(Span(name, current(), attributes))
+
+
+@contextmanager
+def _nothing():
+    yield None
+
+
+def span(name, attributes=None):
+    """A span of the trace running on this thread, nothing outside of a trace"""
+    parent = current()
+    if parent is None:
+        return _nothing()
+
+    return _enter(Span(name, parent, attributes))
+
+
+def traced(name, *arguments):
+    """
+    Run the decorated function in a span, recording the named arguments (including
+    ones passed in **kwargs) as attributes
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        keywords = [p.name for p in signature.parameters.values() if p.kind == p.VAR_KEYWORD]
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if current() is None:
+                return func(*args, **kwargs)
+
+            values = signature.bind_partial(*args, **kwargs).arguments
+            for keyword in keywords:
+                values.update(values.pop(keyword, {}))
+
+            attributes = {arg: values[arg] for arg in arguments if arg in values}
+            with span(name, attributes):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def annotate(**attributes):
+    """Add attributes to the span running on this thread, nothing outside of a trace"""
+    span = current()
+    if span is not None:
+        span.attributes.update({k: _value(v) for k, v in attributes.items()})
+
+
+def bind(func):
+    """Run func in the trace of the calling thread, for work handed to other threads"""
+    parent = current()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = current()
+        _local.span = parent
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.span = previous
+
+    return wrapper
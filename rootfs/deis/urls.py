@@ -8,10 +8,12 @@ installed apps.
 
 from django.conf.urls import include, url
 from api.views import LivenessCheckView
+from api.views import MetricsView
 from api.views import ReadinessCheckView
 
 urlpatterns = [
     url(r'^healthz$', LivenessCheckView.as_view()),
     url(r'^readiness$', ReadinessCheckView.as_view()),
+    url(r'^metrics$', MetricsView.as_view()),
     url(r'^v2/', include('api.urls')),
 ]
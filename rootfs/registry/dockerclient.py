@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 """Support the Deis workflow by manipulating and publishing Docker images."""
 
+import errno
+import fcntl
+import hashlib
 import logging
 import os
+import threading
+import time
 
 import backoff
 from django.conf import settings
@@ -76,11 +81,7 @@ class DockerClient(object):
             self.login(repo, creds)
 
         info = self.inspect_image(target, deis_registry)
-        if 'ExposedPorts' not in info['Config']:
-            return None
-
-        port = int(list(info['Config']['ExposedPorts'].keys())[0].split('/')[0])
-        return port
+        return exposed_port(info['Config'])
 
     def publish_release(self, source, target, deis_registry=False, creds=None):
         """Update a source Docker image with environment config and publish it to deis-registry."""
@@ -118,15 +119,41 @@ class DockerClient(object):
             raise RegistryException(str(e))
 
     def pull(self, repo, tag, insecure_registry=True):
-        """Pull a Docker image into the local storage graph."""
+        """
+        Pull a Docker image into the local storage graph.
+
+        Concurrent pulls of the same image in this process wait on a single pull, other
+        processes are kept out by a lock per image and only DOCKER_PULL_CONCURRENCY
+        different images are pulled at once
+        """
         check_blacklist(repo)
-        logger.info("Pulling Docker image {}:{}".format(repo, tag))
-        with SimpleFlock(self.FLOCKFILE, timeout=1200):
-            stream = self.client.pull(
-                repo, tag=tag, stream=True, decode=True,
-                insecure_registry=insecure_registry
-            )
-            log_output(stream, 'pull', repo, tag)
+        image = '{}:{}'.format(repo, tag)
+        with _pulls_lock:
+            pull = _pulls.get(image, None)
+            leader = pull is None
+            if leader:
+                pull = _pulls[image] = PendingPull()
+
+        if not leader:
+            logger.info("Waiting on the pull of Docker image {} in progress".format(image))
+            return pull.wait()
+
+        try:
+            lockfile = '{}-{}'.format(self.FLOCKFILE, hashlib.sha1(image.encode('utf-8')).hexdigest())  # noqa
+            with SimpleFlock(lockfile, timeout=1200), PullSlot(self.FLOCKFILE, timeout=1200):
+                logger.info("Pulling Docker image {}".format(image))
+                stream = self.client.pull(
+                    repo, tag=tag, stream=True, decode=True,
+                    insecure_registry=insecure_registry
+                )
+                log_output(stream, 'pull', repo, tag)
+        except Exception as e:
+            pull.error = e
+            raise
+        finally:
+            with _pulls_lock:
+                del _pulls[image]
+            pull.done.set()
 
     def push(self, repo, tag):
         """Push a local Docker image to a registry."""
@@ -161,6 +188,73 @@ class DockerClient(object):
         return self.client.inspect_image(target)
 
 
+def exposed_ports(config):
+    """Return the ports exposed by an image config in the order they are listed"""
+    if 'ExposedPorts' not in config or not config['ExposedPorts']:
+        return []
+
+    return [int(port.split('/')[0]) for port in config['ExposedPorts'].keys()]
+
+
+def exposed_port(config):
+    """Return the first port exposed by an image config, if any"""
+    ports = exposed_ports(config)
+    return ports[0] if ports else None
+
+
+class PendingPull(object):
+    """A pull in progress that other threads asking for the same image wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise RegistryException(str(self.error))
+
+
+_pulls = {}
+_pulls_lock = threading.Lock()
+
+
+class PullSlot(object):
+    """
+    Hold one of DOCKER_PULL_CONCURRENCY slots shared by every process using the same
+    Docker daemon, so a few large pulls can not starve everything else
+    """
+
+    def __init__(self, path, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self.fd = None
+
+    def __enter__(self):
+        start = time.time()
+        while True:
+            for slot in range(settings.DOCKER_PULL_CONCURRENCY):
+                fd = os.open('{}-slot-{}'.format(self.path, slot), os.O_CREAT | os.O_RDWR)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.fd = fd
+                    return self
+                except (OSError, IOError) as e:
+                    os.close(fd)
+                    if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                        raise
+
+            if self.timeout is not None and time.time() > start + self.timeout:
+                raise RegistryException('Timed out waiting for other image pulls to finish')
+
+            time.sleep(0.1)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
 def check_blacklist(repo):
     """Check a Docker repository name for collision with deis/* components."""
     blacklisted = [  # NOTE: keep this list up to date!
@@ -194,8 +288,35 @@ def stream_error(chunk, operation, repo, tag):
 
 
 def publish_release(source, target, deis_registry, creds=None):
-    return DockerClient().publish_release(source, target, deis_registry, creds)
+    """
+    Publish an image to deis-registry. Returns the digest, exposed ports and size of the
+    image when they are known, which is not the case when the Docker daemon was used
+    """
+    # avoid a circular import, the registry API client raises RegistryException
+    from .registryclient import copy_image
+
+    if settings.REGISTRY_API_ENABLED:
+        # copy between registries directly instead of pulling and pushing every layer
+        check_blacklist(source)
+        check_blacklist(target)
+        try:
+            return copy_image(source, target, deis_registry, creds)
+        except RegistryException as e:
+            logger.info('Could not copy {} via the registry API, pulling it instead: {}'.format(source, e))  # noqa
+
+    DockerClient().publish_release(source, target, deis_registry, creds)
 
 
 def get_port(target, deis_registry, creds=None):
+    # avoid a circular import, the registry API client raises RegistryException
+    from .registryclient import get_image_config
+
+    if settings.REGISTRY_API_ENABLED:
+        # only the manifest and the image config are needed, no need to pull any layers
+        check_blacklist(target)
+        try:
+            return exposed_port(get_image_config(target, deis_registry, creds))
+        except RegistryException as e:
+            logger.info('Could not inspect {} via the registry API, pulling it instead: {}'.format(target, e))  # noqa
+
     return DockerClient().get_port(target, deis_registry, creds)
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""Read and copy images straight between registries via the Docker Registry HTTP API v2."""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
+import logging
+import re
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.cache import cache
+import requests
+from requests_toolbelt import user_agent
+
+import docker.utils
+from docker.auth import auth
+
+from deis import __version__ as deis_version
+from .dockerclient import RegistryException, exposed_ports
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_V1 = 'application/vnd.docker.distribution.manifest.v1+prettyjws'
+MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+MANIFEST_LIST = 'application/vnd.docker.distribution.manifest.list.v2+json'
+OCI_MANIFEST = 'application/vnd.oci.image.manifest.v1+json'
+OCI_INDEX = 'application/vnd.oci.image.index.v1+json'
+
+
+class RegistryClient(object):
+    """
+    Talk to a single registry over the Docker Registry HTTP API v2, negotiating
+    bearer tokens with the auth server the registry points at when needed.
+
+    https://docs.docker.com/registry/spec/api/
+    https://docs.docker.com/registry/spec/auth/token/
+    """
+
+    def __init__(self, registry, secure=True, creds=None):
+        # Docker Hub images are served from a different host than the index name
+        if registry == auth.INDEX_NAME:
+            registry = 'registry-1.docker.io'
+
+        self.registry = registry
+        self.url = '{}://{}'.format('https' if secure else 'http', registry)
+        self.creds = creds or {}
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent('Deis Controller', deis_version)
+        # scope => token, an auth server hands out tokens per repository and action
+        self.tokens = {}
+
+    @classmethod
+    def for_image(cls, target, deis_registry=False, creds=None):
+        """Return a client for the registry of an image with its repository and reference"""
+        name, reference = docker.utils.parse_repository_tag(target)
+        registry, repository = auth.resolve_repository_name(name)
+        # official Docker Hub images live under library/
+        if registry == auth.INDEX_NAME and '/' not in repository:
+            repository = 'library/' + repository
+
+        # the deis registry is only reachable over plain http inside the cluster
+        secure = not deis_registry and registry not in [settings.REGISTRY_URL, settings.REGISTRY_HOST]  # noqa
+        return cls(registry, secure, creds), repository, reference or 'latest'
+
+    def request(self, method, path, repository, scopes=None, allow=[], **kwargs):
+        """
+        Make a request for a repository, authenticating when the registry asks for it.
+        Pulling from the repository is the default scope, status codes other than 2xx
+        raise a RegistryException unless they are allowed
+        """
+        url = urljoin(self.url, path)
+        kwargs.setdefault('timeout', settings.REGISTRY_API_TIMEOUT)
+        scopes = scopes or ['repository:{}:pull'.format(repository)]
+        scope = ' '.join(scopes)
+        headers = kwargs.pop('headers', {})
+        if scope in self.tokens:
+            headers['Authorization'] = self.tokens[scope]
+
+        try:
+            response = self.session.request(method, url, headers=headers, **kwargs)
+            # no token for the scope yet, or the one kept around expired. Either way
+            # authenticate once more, a second 401 is up to the caller
+            if response.status_code == 401:
+                self.tokens.pop(scope, None)
+                self.tokens[scope] = self._authenticate(response, scopes)
+                headers['Authorization'] = self.tokens[scope]
+                # a streamed body has been consumed already and can not be sent again
+                if hasattr(kwargs.get('data', None), 'read'):
+                    raise RegistryException('Registry {} asked for auth in the middle of an upload'.format(self.registry))  # noqa
+
+                response = self.session.request(method, url, headers=headers, **kwargs)
+        except requests.exceptions.RequestException as e:
+            raise RegistryException('Could not reach registry {}: {}'.format(self.registry, e)) from e  # noqa
+
+        if response.status_code in allow:
+            return response
+
+        if not 200 <= response.status_code <= 299:
+            raise RegistryException('{} {} on registry {} failed: {} {}'.format(
+                method, path, self.registry, response.status_code, response.text[:200]
+            ))
+
+        return response
+
+    def _authenticate(self, response, scopes):
+        """Answer a 401 challenge with either basic auth or a bearer token"""
+        challenge = response.headers.get('WWW-Authenticate', '')
+        kind, _, params = challenge.partition(' ')
+        basic = None
+        if self.creds.get('username') and self.creds.get('password'):
+            basic = (self.creds['username'], self.creds['password'])
+
+        if kind.lower() == 'basic':
+            if basic is None:
+                raise RegistryException('Registry {} requires a username and a password'.format(self.registry))  # noqa
+
+            return requests.auth._basic_auth_str(*basic)
+
+        if kind.lower() != 'bearer':
+            raise RegistryException('Registry {} asked for unsupported auth: {}'.format(self.registry, challenge))  # noqa
+
+        params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        if 'realm' not in params:
+            raise RegistryException('Registry {} did not say where to get a token'.format(self.registry))  # noqa
+
+        # ask for everything needed at once, e.g. pushing to one repository and mounting
+        # blobs from another, the challenge only names the scope of the request at hand
+        query = {'scope': scopes}
+        if 'service' in params:
+            query['service'] = params['service']
+
+        try:
+            token = self.session.get(
+                params['realm'], params=query, auth=basic,
+                timeout=settings.REGISTRY_API_TIMEOUT
+            )
+        except requests.exceptions.RequestException as e:
+            raise RegistryException('Could not reach auth server {}: {}'.format(params['realm'], e)) from e  # noqa
+
+        if token.status_code != 200:
+            raise RegistryException('Could not get a token for {} from {}: {}'.format(' '.join(scopes), params['realm'], token.status_code))  # noqa
+
+        data = token.json()
+        return 'Bearer ' + data.get('token', data.get('access_token', ''))
+
+    def manifest(self, repository, reference):
+        """
+        Return the manifest of an image, its digest and the response it came in (which has
+        the exact bytes the digest is over), picking linux/amd64 out of a manifest list
+        """
+        accept = ', '.join([MANIFEST_V2, MANIFEST_LIST, OCI_MANIFEST, OCI_INDEX, MANIFEST_V1])
+        path = '/v2/{}/manifests/{}'.format(repository, reference)
+        response = self.request('GET', path, repository, headers={'Accept': accept})
+        manifest = response.json()
+        digest = response.headers.get('Docker-Content-Digest', None)
+
+        media_type = manifest.get('mediaType', response.headers.get('Content-Type', ''))
+        if media_type in [MANIFEST_LIST, OCI_INDEX] or 'manifests' in manifest:
+            entries = manifest['manifests']
+            entry = next((m for m in entries if m.get('platform', {}).get('os') == 'linux' and m.get('platform', {}).get('architecture') == 'amd64'), entries[0])  # noqa
+            return self.manifest(repository, entry['digest'])
+
+        return manifest, digest, response
+
+    def image_config(self, repository, reference):
+        """
+        Return the image config (what `docker inspect` shows as Config) without pulling
+        any layers. Configs are immutable so they are cached by digest
+        """
+        manifest, digest, _ = self.manifest(repository, reference)
+        return self.config(repository, manifest, digest)
+
+    def config(self, repository, manifest, digest=None):
+        """Return the image config a manifest refers to"""
+        if 'config' in manifest:
+            # schema 2 and OCI point at a config blob which is addressed by its digest
+            digest = manifest['config']['digest']
+
+        key = 'registry:image-config:{}'.format(digest)
+        if digest is not None:
+            config = cache.get(key)
+            if config is not None:
+                return config
+
+        if 'config' in manifest:
+            path = '/v2/{}/blobs/{}'.format(repository, digest)
+            blob = self.request('GET', path, repository).json()
+            config = blob.get('config', None) or blob.get('container_config', None) or {}
+        elif 'history' in manifest:
+            # schema 1 carries the config of the top layer in the manifest itself
+            blob = json.loads(manifest['history'][0]['v1Compatibility'])
+            config = blob.get('config', None) or blob.get('container_config', None) or {}
+        else:
+            raise RegistryException('Unsupported manifest for {}'.format(repository))
+
+        if digest is not None:
+            cache.set(key, config, None)
+
+        return config
+
+    def blob_exists(self, repository, digest, scopes=None):
+        path = '/v2/{}/blobs/{}'.format(repository, digest)
+        response = self.request('HEAD', path, repository, scopes, allow=[404])
+        return response.status_code != 404
+
+    def mount_blob(self, repository, digest, source, scopes=None):
+        """
+        Mount a blob from another repository of the same registry, nothing is transferred.
+        Returns False if the registry could not mount it and an upload is needed
+        """
+        path = '/v2/{}/blobs/uploads/'.format(repository)
+        params = {'mount': digest, 'from': source}
+        response = self.request('POST', path, repository, scopes, params=params)
+        if response.status_code == 201:
+            return True
+
+        # registry started a regular upload instead, it is not used
+        location = response.headers.get('Location', None)
+        if location:
+            self.request('DELETE', location, repository, scopes, allow=[404])
+
+        return False
+
+    def upload_blob(self, repository, digest, blob, scopes=None):
+        """Stream a blob (a response of a GET on another registry) in a single upload"""
+        path = '/v2/{}/blobs/uploads/'.format(repository)
+        response = self.request('POST', path, repository, scopes)
+        location = response.headers['Location']
+        location += '&' if '?' in location else '?'
+        location += 'digest=' + digest
+
+        headers = {'Content-Type': 'application/octet-stream'}
+        if 'Content-Length' in blob.headers:
+            headers['Content-Length'] = blob.headers['Content-Length']
+
+        self.request('PUT', location, repository, scopes, data=blob.raw, headers=headers,
+                     timeout=settings.REGISTRY_PUBLISH_TIMEOUT)
+
+    def put_manifest(self, repository, reference, content, media_type, scopes=None):
+        path = '/v2/{}/manifests/{}'.format(repository, reference)
+        self.request('PUT', path, repository, scopes, data=content,
+                     headers={'Content-Type': media_type})
+
+
+def copy_image(source, target, deis_registry=False, creds=None):
+    """
+    Publish an image to the deis registry by copying its manifest and blobs over from the
+    source registry. Blobs the target repository has already are skipped, blobs from the
+    same registry are mounted and everything else is streamed in parallel.
+
+    Returns the digest, exposed ports and size of the published image
+    """
+    if deis_registry:
+        source = '{}/{}'.format(settings.REGISTRY_URL, source)
+    src, src_repo, src_ref = RegistryClient.for_image(source, deis_registry, creds)
+
+    # always publish to the deis registry, whatever registry the target names
+    name, dst_ref = docker.utils.parse_repository_tag(target)
+    _, dst_repo = auth.split_repo_name(name)
+    dst = RegistryClient(settings.REGISTRY_URL, secure=False)
+
+    manifest, _, response = src.manifest(src_repo, src_ref)
+    media_type = manifest.get('mediaType', response.headers.get('Content-Type', ''))
+    if media_type not in [MANIFEST_V2, OCI_MANIFEST]:
+        # schema 1 manifests are signed over the repository name and can not be moved
+        raise RegistryException('Can not copy a {} manifest of {}'.format(media_type or 'schema 1', source))  # noqa
+
+    same_registry = src.registry == dst.registry
+    scopes = ['repository:{}:pull,push'.format(dst_repo)]
+    if same_registry and src_repo != dst_repo:
+        scopes.append('repository:{}:pull'.format(src_repo))
+
+    def copy_blob(digest):
+        if dst.blob_exists(dst_repo, digest, scopes):
+            return 'exists'
+
+        if same_registry and dst.mount_blob(dst_repo, digest, src_repo, scopes):
+            return 'mounted'
+
+        path = '/v2/{}/blobs/{}'.format(src_repo, digest)
+        blob = src.request('GET', path, src_repo, stream=True,
+                           timeout=settings.REGISTRY_PUBLISH_TIMEOUT)
+        try:
+            dst.upload_blob(dst_repo, digest, blob, scopes)
+        finally:
+            blob.close()
+
+        return 'uploaded'
+
+    digests = [manifest['config']['digest']] + [layer['digest'] for layer in manifest['layers']]  # noqa
+    copied = {}
+    with ThreadPoolExecutor(max_workers=settings.REGISTRY_PUBLISH_CONCURRENCY) as executor:
+        futures = {executor.submit(copy_blob, digest): digest for digest in digests}
+        for future in as_completed(futures):
+            copied[futures[future]] = future.result()
+
+    # the manifest goes last, the registry checks that every blob it refers to exists
+    dst.put_manifest(dst_repo, dst_ref, response.content, media_type, scopes)
+    logger.info('Copied {} to {}: {}'.format(source, target, ', '.join(
+        '{} {}'.format(list(copied.values()).count(action), action)
+        for action in ['exists', 'mounted', 'uploaded']
+    )))
+
+    try:
+        ports = exposed_ports(src.config(src_repo, manifest))
+    except (RegistryException, ValueError) as e:
+        # the image is published, the ports can still be looked up later on
+        logger.info('Could not read the config of {}: {}'.format(source, e))
+        ports = None
+
+    blobs = [manifest['config']] + manifest['layers']
+    return {
+        # the manifest was pushed as is so the digest is the same as the one of the source
+        'digest': 'sha256:' + hashlib.sha256(response.content).hexdigest(),
+        'ports': ports,
+        'size': sum(blob.get('size', 0) for blob in blobs)
+    }
+
+
+def get_image_config(target, deis_registry=False, creds=None):
+    client, repository, reference = RegistryClient.for_image(target, deis_registry, creds)
+    return client.image_config(repository, reference)
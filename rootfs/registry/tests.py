@@ -4,13 +4,22 @@ Unit tests for the Deis registry app.
 Run the tests with "./manage.py test registry"
 """
 
+import json
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 
 from django.conf import settings
+from django.core.cache import cache
+from django.test import override_settings
 from rest_framework.exceptions import PermissionDenied
+import requests_mock
+
 from registry import publish_release, get_port, RegistryException
-from registry.dockerclient import DockerClient
+from registry.dockerclient import DockerClient, PullSlot
+from registry.registryclient import RegistryClient, MANIFEST_V2, MANIFEST_LIST
 
 
 @mock.patch('docker.Client')
@@ -20,6 +29,7 @@ class DockerClientTest(unittest.TestCase):
     def setUp(self):
         settings.REGISTRY_HOST, settings.REGISTRY_PORT = 'localhost', 5000
 
+    @override_settings(REGISTRY_API_ENABLED=False)
     def test_get_port(self, mock_client):
         self.client = DockerClient()
 
@@ -42,6 +52,7 @@ class DockerClientTest(unittest.TestCase):
         self.assertTrue(self.client.client.pull.called)
         self.assertTrue(self.client.client.inspect_image.called)
 
+    @override_settings(REGISTRY_API_ENABLED=False)
     def test_publish_release(self, mock_client):
         self.client = DockerClient()
 
@@ -206,3 +217,333 @@ class DockerClientTest(unittest.TestCase):
 
         with self.assertRaises(PermissionDenied):
             self.client.tag('localhost:5000/deis/controller:v1.11.1', 'deis/controller', 'v1.11.1')
+
+
+REGISTRY = 'https://quay.io'
+CONFIG_DIGEST = 'sha256:' + 'c' * 64
+
+
+def manifest_v2():
+    return {
+        'schemaVersion': 2,
+        'mediaType': MANIFEST_V2,
+        'config': {'digest': CONFIG_DIGEST},
+        'layers': [{'digest': 'sha256:' + 'a' * 64}],
+    }
+
+
+class RegistryClientTest(unittest.TestCase):
+    """Test that image metadata is read via the registry API without pulling layers."""
+
+    def setUp(self):
+        self.mocker = requests_mock.Mocker()
+        self.mocker.start()
+        self.addCleanup(self.mocker.stop)
+        self.tokens = []
+
+    def tearDown(self):
+        cache.clear()
+
+    def register(self, manifest=None, config=None, challenge=True):
+        manifest = manifest or manifest_v2()
+
+        def authorized(request, context):
+            if challenge and request.headers.get('Authorization') != 'Bearer s3cret':
+                context.status_code = 401
+                context.headers['WWW-Authenticate'] = (
+                    'Bearer realm="https://auth.quay.io/token",'
+                    'service="quay.io",scope="repository:ozzy/embryo:pull"'
+                )
+                return False
+
+            return True
+
+        def token(request, context):
+            self.tokens.append(request)
+            return {'token': 's3cret'}
+
+        def get_manifest(request, context):
+            if not authorized(request, context):
+                return {}
+
+            context.headers['Docker-Content-Digest'] = 'sha256:' + 'd' * 64
+            return manifest
+
+        def get_config(request, context):
+            if not authorized(request, context):
+                return {}
+
+            return {'config': config or {'ExposedPorts': {'8080/tcp': {}}}}
+
+        self.mocker.get('https://auth.quay.io/token', json=token)
+        self.mocker.get(REGISTRY + '/v2/ozzy/embryo/manifests/v4', json=get_manifest)
+        self.mocker.get(REGISTRY + '/v2/ozzy/embryo/blobs/' + CONFIG_DIGEST, json=get_config)
+
+    @mock.patch('docker.Client')
+    def test_get_port(self, mock_client):
+        self.register()
+        creds = {'username': 'fake', 'password': 'fake', 'email': 'fake'}
+        self.assertEqual(get_port('quay.io/ozzy/embryo:v4', False, creds), 8080)
+        self.assertFalse(mock_client.called)
+
+        # the token was requested for the scope and service from the challenge
+        self.assertEqual(len(self.tokens), 1)
+        self.assertEqual(self.tokens[0].qs, {'scope': ['repository:ozzy/embryo:pull'],
+                                             'service': ['quay.io']})
+        self.assertTrue(self.tokens[0].headers['Authorization'].startswith('Basic '))
+
+        # the config is cached by digest, only the manifest is asked for again
+        history = len(self.mocker.request_history)
+        self.assertEqual(get_port('quay.io/ozzy/embryo:v4', False, creds), 8080)
+        self.assertEqual(len(self.mocker.request_history), history + 3)
+        self.assertTrue(self.mocker.request_history[-1].url.endswith('/manifests/v4'))
+
+    def test_expired_token(self):
+        self.register()
+        client, repository, reference = RegistryClient.for_image('quay.io/ozzy/embryo:v4')
+        client.image_config(repository, reference)
+        self.assertEqual(len(self.tokens), 1)
+
+        # the auth server handed out a token that has run out since
+        scope = 'repository:ozzy/embryo:pull'
+        client.tokens[scope] = 'Bearer expired'
+        self.assertEqual(client.image_config(repository, reference),
+                         {'ExposedPorts': {'8080/tcp': {}}})
+        self.assertEqual(len(self.tokens), 2)
+        self.assertEqual(client.tokens[scope], 'Bearer s3cret')
+
+    @mock.patch('docker.Client')
+    def test_get_port_no_exposed_ports(self, mock_client):
+        self.register(config={'Env': []}, challenge=False)
+        self.assertIsNone(get_port('quay.io/ozzy/embryo:v4', False))
+
+    def test_manifest_list(self):
+        self.register(manifest={
+            'schemaVersion': 2,
+            'mediaType': MANIFEST_LIST,
+            'manifests': [
+                {'digest': 'sha256:arm', 'platform': {'os': 'linux', 'architecture': 'arm'}},
+                {'digest': 'sha256:amd64', 'platform': {'os': 'linux', 'architecture': 'amd64'}},  # noqa
+            ]
+        }, challenge=False)
+        self.mocker.get(REGISTRY + '/v2/ozzy/embryo/manifests/sha256:amd64', json=manifest_v2())
+
+        client, repository, reference = RegistryClient.for_image('quay.io/ozzy/embryo:v4')
+        config = client.image_config(repository, reference)
+        self.assertEqual(config, {'ExposedPorts': {'8080/tcp': {}}})
+
+    def test_schema1_manifest(self):
+        self.register(manifest={
+            'schemaVersion': 1,
+            'history': [
+                {'v1Compatibility': json.dumps({'config': {'ExposedPorts': {'5000/tcp': {}}}})},
+            ]
+        }, challenge=False)
+
+        client, repository, reference = RegistryClient.for_image('quay.io/ozzy/embryo:v4')
+        self.assertEqual(client.image_config(repository, reference),
+                         {'ExposedPorts': {'5000/tcp': {}}})
+
+    def test_for_image(self):
+        client, repository, reference = RegistryClient.for_image('nginx')
+        self.assertEqual(client.url, 'https://registry-1.docker.io')
+        self.assertEqual((repository, reference), ('library/nginx', 'latest'))
+
+        client, repository, reference = RegistryClient.for_image(
+            '{}/ozzy/embryo:v4'.format(settings.REGISTRY_URL), True)
+        self.assertEqual(client.url, 'http://{}'.format(settings.REGISTRY_URL))
+        self.assertEqual((repository, reference), ('ozzy/embryo', 'v4'))
+
+    @mock.patch('docker.Client')
+    def test_get_port_falls_back_to_docker(self, mock_client):
+        self.mocker.get(REGISTRY + '/v2/ozzy/embryo/manifests/v4', status_code=404)
+        mock_client.return_value.inspect_image.return_value = {
+            'Config': {'ExposedPorts': {'9000/tcp': {}}}
+        }
+
+        self.assertEqual(get_port('quay.io/ozzy/embryo:v4', False), 9000)
+        self.assertTrue(mock_client.return_value.pull.called)
+
+    def test_get_port_blacklisted(self):
+        with self.assertRaises(PermissionDenied):
+            get_port('deis/controller:v1.11.1', False)
+
+
+class RegistryCopyTest(unittest.TestCase):
+    """Test that images are published by copying blobs between registries."""
+
+    def setUp(self):
+        self.mocker = requests_mock.Mocker()
+        self.mocker.start()
+        self.addCleanup(self.mocker.stop)
+        self.deis = 'http://{}'.format(settings.REGISTRY_URL)
+        self.layers = ['sha256:' + c * 64 for c in 'ab']
+        self.manifest = manifest_v2()
+        self.manifest['config']['size'] = 100
+        self.manifest['layers'] = [{'digest': digest, 'size': 1000} for digest in self.layers]
+        self.uploads = []
+
+    def register(self, source, existing=[]):
+        self.mocker.get(source + '/v2/ozzy/embryo/manifests/v4', json=self.manifest,
+                        headers={'Content-Type': MANIFEST_V2})
+        for digest in [CONFIG_DIGEST] + self.layers:
+            content = digest.encode()
+            if digest == CONFIG_DIGEST:
+                content = json.dumps({'config': {'ExposedPorts': {'8080/tcp': {}}}}).encode()
+
+            self.mocker.get(source + '/v2/ozzy/embryo/blobs/' + digest, content=content)
+            status = 200 if digest in existing else 404
+            self.mocker.head(self.deis + '/v2/foo/blobs/' + digest, status_code=status)
+
+        def upload(request, context):
+            self.uploads.append((request.qs['digest'][0], request.body.read()))
+            context.status_code = 201
+            return ''
+
+        self.mocker.post(self.deis + '/v2/foo/blobs/uploads/', status_code=202,
+                         headers={'Location': '/v2/foo/blobs/uploads/1234?_state=abc'})
+        self.mocker.put(self.deis + '/v2/foo/blobs/uploads/1234', text=upload)
+        self.mocker.put(self.deis + '/v2/foo/manifests/v1', status_code=201)
+
+    @mock.patch('docker.Client')
+    def test_publish_release_between_registries(self, mock_client):
+        self.register(REGISTRY, existing=[CONFIG_DIGEST])
+        image = publish_release('quay.io/ozzy/embryo:v4', 'quay.io/foo:v1', False)
+        self.assertFalse(mock_client.called)
+        self.assertEqual(image['ports'], [8080])
+        self.assertEqual(image['size'], 2100)
+        self.assertTrue(image['digest'].startswith('sha256:'))
+
+        # the config was there already, both layers were streamed over
+        self.assertEqual(sorted(self.uploads), [(d, d.encode()) for d in self.layers])
+
+        # the manifest is pushed as is, after the blobs
+        puts = [r for r in self.mocker.request_history if r.method == 'PUT']
+        put = puts[-1]
+        self.assertTrue(put.url.endswith('/v2/foo/manifests/v1'))
+        self.assertEqual(put.headers['Content-Type'], MANIFEST_V2)
+        self.assertEqual(json.loads(put.body.decode()), self.manifest)
+
+    @mock.patch('docker.Client')
+    def test_publish_release_mounts_within_registry(self, mock_client):
+        self.register(self.deis)
+
+        def mount(request, context):
+            context.status_code = 201 if 'mount' in request.qs else 202
+            return ''
+
+        self.mocker.post(self.deis + '/v2/foo/blobs/uploads/', text=mount)
+
+        publish_release('{}/ozzy/embryo:v4'.format(settings.REGISTRY_URL), 'foo:v1', False)
+        self.assertFalse(mock_client.called)
+        self.assertEqual(self.uploads, [])
+        mounts = [r.qs for r in self.mocker.request_history if r.method == 'POST']
+        self.assertEqual(len(mounts), 3)
+        self.assertEqual({m['from'][0] for m in mounts}, {'ozzy/embryo'})
+
+    @mock.patch('docker.Client')
+    def test_publish_release_falls_back_to_docker(self, mock_client):
+        self.mocker.get(REGISTRY + '/v2/ozzy/embryo/manifests/v4', json={
+            'schemaVersion': 1, 'history': []
+        })
+
+        self.assertIsNone(publish_release('quay.io/ozzy/embryo:v4', 'foo:v1', False))
+        docker = mock_client.return_value
+        self.assertTrue(docker.pull.called)
+        self.assertTrue(docker.push.called)
+
+
+@mock.patch('docker.Client')
+class PullTest(unittest.TestCase):
+    """Test that pulls are coalesced per image and bounded across images."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch.object(DockerClient, 'FLOCKFILE', self.tmp.name + '/pull')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.release = threading.Event()
+        self.started = []
+
+    def blocking_pull(self, error=None):
+        def pull(repo, **kwargs):
+            self.started.append(repo)
+            self.release.wait(5)
+            if error:
+                return [{'error': error, 'errorDetail': {}}]
+
+            return []
+
+        return pull
+
+    def run_pulls(self, *images):
+        errors = []
+
+        def target(repo):
+            try:
+                DockerClient().pull(repo, 'v1')
+            except RegistryException as e:
+                errors.append(str(e))
+
+        threads = [threading.Thread(target=target, args=(repo,)) for repo in images]
+        for thread in threads:
+            thread.start()
+
+        return threads, errors
+
+    def wait_started(self, count):
+        for _ in range(500):
+            if len(self.started) >= count:
+                return
+            time.sleep(0.01)
+
+        self.fail('pulls did not start')
+
+    def test_same_image_is_pulled_once(self, mock_client):
+        mock_client.return_value.pull.side_effect = self.blocking_pull()
+        threads, errors = self.run_pulls('ozzy/embryo', 'ozzy/embryo', 'ozzy/embryo')
+        self.wait_started(1)
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(self.started, ['ozzy/embryo'])
+        self.assertEqual(errors, [])
+
+    def test_failed_pull_is_shared(self, mock_client):
+        mock_client.return_value.pull.side_effect = self.blocking_pull('not found')
+        threads, errors = self.run_pulls('ozzy/embryo', 'ozzy/embryo')
+        self.wait_started(1)
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(errors, ['not found', 'not found'])
+
+    @override_settings(DOCKER_PULL_CONCURRENCY=2)
+    def test_different_images_are_pulled_in_parallel(self, mock_client):
+        mock_client.return_value.pull.side_effect = self.blocking_pull()
+        threads, errors = self.run_pulls('ozzy/embryo', 'ozzy/larva', 'ozzy/pupa')
+
+        # two pulls at once, the third one waits for a free slot
+        self.wait_started(2)
+        time.sleep(0.2)
+        self.assertEqual(len(self.started), 2)
+
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(sorted(self.started), ['ozzy/embryo', 'ozzy/larva', 'ozzy/pupa'])
+
+    @override_settings(DOCKER_PULL_CONCURRENCY=1)
+    def test_pull_slot_timeout(self, mock_client):
+        path = self.tmp.name + '/pull'
+        with PullSlot(path):
+            with self.assertRaises(RegistryException):
+                with PullSlot(path, timeout=0):
+                    pass
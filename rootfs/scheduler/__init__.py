@@ -1,25 +1,35 @@
+from collections import OrderedDict
+import copy
 from datetime import datetime, timedelta
+import hashlib
+import importlib
 import json
 import logging
 import os
 import string
+import threading
 import time
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
 import base64
 
 from django.conf import settings
 from docker.auth import auth as docker_auth
+from .informer import Informers
 from .states import PodState
+from .status import PodEvents, statuses as pod_statuses
 import ruamel.yaml
 import requests
 from requests_toolbelt import user_agent
 from .utils import dict_merge
 
 from deis import __version__ as deis_version
+from deis import clock, metrics, trace
 
 
 logger = logging.getLogger(__name__)
 
+_informers_lock = threading.Lock()
+
 # Ports and app type will be overwritten as required
 SERVICE_TEMPLATE = """\
 kind: Service
@@ -81,26 +91,101 @@ def unhealthy(status_code):
     return False
 
 
+def request_labels(request):
+    """verb and resource of a Kubernetes API request, e.g. LIST pods or GET pods/log"""
+    url = urlparse(request.url)
+    parts = [p for p in url.path.split('/') if p]
+    # /api/v1/... or /apis/<group>/<version>/...
+    parts = parts[2:] if parts[:1] == ['api'] else parts[3:]
+    if parts[:1] == ['namespaces'] and len(parts) > 2:
+        parts = parts[2:]
+
+    resource = '/'.join(parts[0:1] + parts[2:3]) or 'unknown'
+    verb = request.method
+    if verb == 'GET' and len(parts) == 1:
+        verb = 'WATCH' if 'watch=' in url.query else 'LIST'
+
+    return {'verb': verb, 'resource': resource}
+
+
+class InstrumentedSession(requests.Session):
+    """Records verb, resource, status code and latency of every Kubernetes API request"""
+
+    def send(self, request, **kwargs):
+        labels = request_labels(request)
+        start = time.time()
+        code = 'error'  # no response at all
+        try:
+            response = super(InstrumentedSession, self).send(request, **kwargs)
+            code = str(response.status_code)
+            return response
+        finally:
+            # streamed responses (watches, followed logs) count until the headers arrived
+            metrics.observe('deis_kubernetes_request_duration_seconds', labels, time.time() - start)  # noqa
+            metrics.inc('deis_kubernetes_requests_total', dict(labels, code=code))
+
+
+class KubeTokenAuth(requests.auth.AuthBase):
+    """
+    Attach the service account token to every request. The token file is read
+    again whenever it changes on disk so rotated tokens get picked up.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.token = None
+        self._load()
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.mtime:
+            return
+
+        with self.lock:
+            if mtime == self.mtime:
+                return
+
+            with open(self.path) as token_file:
+                self.token = token_file.read().strip()
+            self.mtime = mtime
+
+    def __call__(self, request):
+        self._load()
+        request.headers['Authorization'] = 'Bearer ' + self.token
+        return request
+
+
 class KubeHTTPClient(object):
     apiversion = "v1"
 
     def __init__(self):
         self.url = settings.SCHEDULER_URL
 
-        with open('/var/run/secrets/kubernetes.io/serviceaccount/token') as token_file:
-            token = token_file.read()
-
-        session = requests.Session()
+        session = InstrumentedSession()
         session.headers = {
-            'Authorization': 'Bearer ' + token,
             'Content-Type': 'application/json',
             'User-Agent': user_agent('Deis Controller', deis_version)
         }
+        session.auth = KubeTokenAuth('/var/run/secrets/kubernetes.io/serviceaccount/token')
         session.verify = '/var/run/secrets/kubernetes.io/serviceaccount/ca.crt'
+
+        # keep connections to the API server around so they can be reused by all threads
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=settings.KUBERNETES_CLIENT_POOL_CONNECTIONS,
+            pool_maxsize=settings.KUBERNETES_CLIENT_POOL_MAXSIZE
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
         self.session = session
 
+    @trace.traced('rollout', 'name', 'app_type')  # noqa
     def deploy(self, namespace, name, image, command, **kwargs):  # noqa
         logger.info('deploy {}, img {}, cmd "{}"'.format(name, image, command))
+        if settings.KUBERNETES_DEPLOYMENTS:
+            return self._deploy_deployment(namespace, name, image, command, **kwargs)
+
         app_type = kwargs.get('app_type')
         routable = kwargs.get('routable', False)
         envs = kwargs.get('envs', {})
@@ -127,13 +212,7 @@ class KubeHTTPClient(object):
             desired = kwargs['replicas']
             logger.info('No prior RC could be found for {}-{}'.format(namespace, app_type))
 
-        # see if application or global deploy batches are defined
-        if not kwargs.get('batches', None):
-            # figure out how many nodes the application can go on
-            tags = kwargs.get('tags', {})
-            steps = len(self.get_nodes(labels=tags).json()['items'])
-        else:
-            steps = int(kwargs.get('batches'))
+        steps = self._deploy_steps(**kwargs)
 
         # figure out what kind of batches the deploy is done in - 1 in, 1 out or higher
         if desired < steps:
@@ -187,6 +266,16 @@ class KubeHTTPClient(object):
         # traffic to the application
         self._update_application_service(namespace, name, app_type, port, routable)
 
+    def _deploy_steps(self, **kwargs):
+        """How many pods are brought up (and old ones taken down) at a time during a deploy"""
+        # see if application or global deploy batches are defined
+        if not kwargs.get('batches', None):
+            # figure out how many nodes the application can go on
+            tags = kwargs.get('tags', {})
+            return len(self.get_nodes(labels=tags).json()['items'])
+
+        return int(kwargs.get('batches'))
+
     def cleanup_release(self, namespace, controller):
         """
         Cleans up resources related to an application deployment
@@ -196,12 +285,7 @@ class KubeHTTPClient(object):
         self.delete_rc(namespace, controller['metadata']['name'])
 
         # Remove stray pods that the scale down will have missed (this can occassionally happen)
-        pods = self.get_pods(namespace, labels=controller['metadata']['labels']).json()
-        for pod in pods['items']:
-            if self.pod_deleted(pod):
-                continue
-
-            self.delete_pod(namespace, pod['metadata']['name'])
+        self.delete_pods(namespace, controller['metadata']['labels'])
 
     def _update_application_service(self, namespace, name, app_type, port, routable=False):
         """Update application service with all the various required information"""
@@ -232,6 +316,10 @@ class KubeHTTPClient(object):
 
     def scale(self, namespace, name, image, command, **kwargs):
         logger.info('scale {}, img {}, cmd "{}"'.format(name, image, command))
+        # process types that have not been deployed since Deployments got enabled still have a RC
+        if settings.KUBERNETES_DEPLOYMENTS and unhealthy(self.get_rc_status(namespace, name)):
+            return self._scale_deployment(namespace, name, image, command, **kwargs)
+
         replicas = kwargs.pop('replicas')
         if unhealthy(self.get_rc_status(namespace, name)):
             # add RC if it is missing for the namespace
@@ -329,9 +417,7 @@ class KubeHTTPClient(object):
             # slugrunner pull policy
             kwargs['image_pull_policy'] = settings.SLUG_BUILDER_IMAGE_PULL_POLICY
 
-        envs = kwargs.get('envs', {})
-        default_env.update(envs)
-        kwargs['envs'] = default_env
+        kwargs['default_envs'] = default_env
 
         # create the base container
         container = {}
@@ -354,7 +440,45 @@ class KubeHTTPClient(object):
         return manifest
 
     def run(self, namespace, name, image, entrypoint, command, **kwargs):
-        """Run a one-off command."""
+        """
+        Run a one-off command and return its exit code and output. Only the last
+        DEIS_RUN_OUTPUT_LIMIT bytes of output are kept, the rest is dropped
+        """
+        limit = settings.DEIS_RUN_OUTPUT_LIMIT
+        output = bytearray()
+        truncated = 0
+        for kind, data in self.run_stream(namespace, name, image, entrypoint, command, **kwargs):  # noqa
+            if kind == 'exit_code':
+                exit_code = data
+                continue
+
+            output += data
+            if len(output) > limit:
+                truncated += len(output) - limit
+                del output[:len(output) - limit]
+
+        output = output.decode('utf-8', errors='replace')
+        if truncated:
+            output = '[{} bytes of output truncated]\n{}'.format(truncated, output)
+
+        return exit_code, output
+
+    def run_stream(self, namespace, name, image, entrypoint, command, timeout=None, **kwargs):
+        """
+        Start a one-off command and wait for it to be running. Returns a generator of
+        ('output', bytes) while the command runs, followed by ('exit_code', int).
+        The Pod is deleted once the generator is exhausted or closed
+        """
+        timeout = timeout or settings.DEIS_RUN_TIMEOUT
+        try:
+            self._start_run(namespace, name, image, entrypoint, command, **kwargs)
+        except Exception:
+            self.delete_pod(namespace, name)
+            raise
+
+        return self._follow_run(namespace, name, clock.time() + timeout, timeout)
+
+    def _start_run(self, namespace, name, image, entrypoint, command, **kwargs):
         logger.info('run {}, img {}, entrypoint {}, cmd "{}"'.format(
             name, image, entrypoint, command)
         )
@@ -381,6 +505,8 @@ class KubeHTTPClient(object):
         if unhealthy(response.status_code):
             raise KubeHTTPException(response, 'create Pod in Namespace "{}"', namespace)
 
+        self._wrote('pods', namespace, response)
+
         labels = {
             'app': namespace,
             'type': kwargs.get('app_type'),
@@ -392,40 +518,42 @@ class KubeHTTPClient(object):
         container = self._find_container(container_name, manifest['spec']['containers'])
         self._wait_until_pods_are_ready(namespace, container, labels, desired=1)
 
+    def _follow_run(self, namespace, name, deadline, timeout):
+        log = None
         try:
-            # give pod 20 minutes to execute (after it got into ready state)
-            # this is a fairly arbitrary limit but the gunicorn worker / LBs
-            # will make this timeout around 20 anyway.
-            # TODO: Revisit in the future so it can run longer
-            state = 'up'  # pod is still running
-            waited = 0
-            timeout = 1200  # 20 minutes
-            while (state == 'up' and waited < timeout):
-                response = self.get_pod(namespace, name)
-                pod = response.json()
+            # output is passed on as the container writes it, the stream ends with the container.
+            # Chunks are read up to a size so an empty read ends the stream, an unsized read
+            # waits on the body to report itself closed which not every body does
+            log = self._pod_log(namespace, name, follow=True, timeout=timeout)
+            for chunk in log.iter_content(chunk_size=1024):
+                yield 'output', chunk
+                if clock.time() > deadline:
+                    break
+
+            # the container is gone, give the Pod a moment to report how it went
+            state = 'up'
+            while True:
+                pod = self.get_pod(namespace, name).json()
                 state = str(self.pod_state(pod))
-                # default data
-                exit_code = 0
+                if state != 'up' or clock.time() > deadline:
+                    break
 
-                waited += 1
-                time.sleep(1)
+                clock.sleep(1)
 
-            if state == 'down':  # run finished successfully
-                exit_code = 0  # successful run
-            elif state == 'crashed':  # run failed
+            if state == 'up':
+                raise KubeException('Timed out ({} mins) while running'.format(timeout // 60))
+
+            exit_code = 0  # successful run
+            if state == 'crashed':  # run failed
                 pod_state = pod['status']['containerStatuses'][0]['state']
                 exit_code = pod_state['terminated']['exitCode']
 
-            # timed out!
-            if waited == timeout:
-                raise KubeException('Timed out (20 mins) while running')
-
-            # grab log information
-            log = self._pod_log(namespace, name)
-            log.encoding = 'utf-8'  # defaults to "ISO-8859-1" otherwise...
-
-            return exit_code, log.text
+            yield 'exit_code', exit_code
         finally:
+            # give the connection back to the pool, also when the deadline cut the stream short
+            if log is not None:
+                log.close()
+
             # cleanup
             self.delete_pod(namespace, name)
 
@@ -449,24 +577,22 @@ class KubeHTTPClient(object):
         if 'env' not in data:
             data['env'] = []
 
+        # what deis sets itself is not sensitive and differs per release (WORKFLOW_RELEASE),
+        # keep it out of the env secret so the secret can be shared between releases
+        for key, value in kwargs.get('default_envs', {}).items():
+            if key in env:
+                continue
+
+            item = {"name": key, "value": str(value)}
+            match = next((k for k, e in enumerate(data["env"]) if e['name'] == key), None)
+            if match is not None:
+                data["env"][match] = item
+            else:
+                data["env"].append(item)
+
         if env:
             # env vars are stored in secrets and mapped to env in k8s
-            try:
-                # secrets use dns labels for keys, map those properly here
-                secrets_env = {}
-                for key, value in env.items():
-                    secrets_env[key.lower().replace('_', '-')] = str(value)
-
-                secret_name = "{}-{}-env".format(namespace, kwargs.get('version'))
-                self.get_secret(namespace, secret_name)
-            except KubeHTTPException:
-                labels = {
-                    'version': kwargs.get('version'),
-                    'type': 'env'
-                }
-                self.create_secret(namespace, secret_name, secrets_env, labels=labels)
-            else:
-                self.update_secret(namespace, secret_name, secrets_env)
+            secret_name = self._set_env_secret(namespace, env)
 
             for key in env.keys():
                 item = {
@@ -513,6 +639,40 @@ class KubeHTTPClient(object):
         else:
             self._default_readiness_probe(data, kwargs.get('build_type'), env.get('PORT', None))
 
+    @trace.traced('set_env_secret')
+    def _set_env_secret(self, namespace, env):
+        """
+        Store env vars in a Secret named after a hash of its contents and return the name.
+        The Secret is never changed once created, releases with the same env share it
+        """
+        # secrets use dns labels for keys, map those properly here
+        secrets_env = {}
+        for key, value in env.items():
+            secrets_env[key.lower().replace('_', '-')] = str(value)
+
+        digest = json.dumps(secrets_env, sort_keys=True).encode('utf-8')
+        digest = hashlib.sha256(digest).hexdigest()[:16]
+        secret_name = "{}-env-{}".format(namespace, digest)
+        try:
+            self.get_secret(namespace, secret_name)
+        except KubeHTTPException as e:
+            if e.response.status_code != 404:
+                raise
+
+            labels = {
+                'type': 'env',
+                'hash': digest
+            }
+            try:
+                self.create_secret(namespace, secret_name, secrets_env, labels=labels)
+            except KubeHTTPException as e:
+                # created by a concurrent deploy or scale
+                if e.response.status_code != 409:
+                    raise
+
+        return secret_name
+
+    @trace.traced('set_image_secret')
     def _set_image_secret(self, data, namespace, **kwargs):
         """
         Take registry information and set as an imagePullSecret for an RC
@@ -572,21 +732,22 @@ class KubeHTTPClient(object):
             'Unknown': PodState.error,
         }
 
+        status = pod_statuses.get(pod)
         # being in a Pending state can mean different things, introspecting app container first
-        if pod['status']['phase'] == 'Pending':
+        if status.phase == 'Pending':
             pod_state, _ = self._pod_pending_status(pod)
         # being in a running state can mean a pod is starting, actually running or terminating
-        elif pod['status']['phase'] == 'Running':
+        elif status.phase == 'Running':
             # is the readiness probe passing?
-            pod_state = self._pod_readiness_status(pod)
+            pod_state = status.readiness
             if pod_state in ['Starting', 'Terminating']:
                 return states[pod_state]
-            elif pod_state == 'Running' and self._pod_liveness_status(pod):
+            elif pod_state == 'Running' and status.live:
                 # is the pod ready to serve requests?
                 return states[pod_state]
         else:
             # if no match was found for deis mapping then passthrough the real state
-            pod_state = pod['status']['phase']
+            pod_state = status.phase
 
         return states.get(pod_state, pod_state)
 
@@ -622,6 +783,42 @@ class KubeHTTPClient(object):
 
         return query
 
+    def _delete_collection(self, resource, namespace, labels):
+        """
+        Delete every object of a resource type in a Namespace that matches the labels
+        with a single request. API servers without collection deletes get one DELETE
+        per object instead
+        """
+        if not labels:
+            # an empty selector matches everything in the Namespace
+            raise KubeException('refusing to delete all {} in Namespace "{}"'.format(resource, namespace))  # noqa
+
+        url = self._api('/namespaces/{}/' + resource, namespace)
+        params = self._selectors(labels=labels)
+        response = self.session.delete(url, params=params)
+        if response.status_code == 405:
+            response = self.session.get(url, params=params)
+            if unhealthy(response.status_code):
+                raise KubeHTTPException(response, 'get {} in Namespace "{}"', resource, namespace)  # noqa
+
+            for item in response.json()['items']:
+                name = item['metadata']['name']
+                resp = self.session.delete(url + '/' + name)
+                # already gone is what we wanted
+                if unhealthy(resp.status_code) and resp.status_code != 404:
+                    raise KubeHTTPException(resp, 'delete {} "{}" in Namespace "{}"', resource, name, namespace)  # noqa
+
+                self._wrote(resource, namespace, resp)
+
+            return response
+
+        if unhealthy(response.status_code):
+            raise KubeHTTPException(response, 'delete {} in Namespace "{}"', resource, namespace)
+
+        self._wrote(resource, namespace, response)
+
+        return response
+
     # NAMESPACE #
 
     def get_namespace_events(self, namespace, **kwargs):
@@ -667,6 +864,9 @@ class KubeHTTPClient(object):
     def delete_namespace(self, namespace):
         url = self._api("/namespaces/{}", namespace)
         response = self.session.delete(url)
+        if settings.KUBERNETES_INFORMERS_ENABLED:
+            self.informers.forget(namespace)
+
         if response.status_code == 404:
             logger.warn('delete Namespace "{}": not found'.format(namespace))
         elif response.status_code != 200:
@@ -674,6 +874,261 @@ class KubeHTTPClient(object):
 
         return response
 
+    # DEPLOYMENTS #
+
+    def _api_extensions(self, tmpl, *args):
+        """Return a fully-qualified Kubernetes extensions API URL from a string template"""
+        url = "/apis/extensions/v1beta1" + tmpl.format(*args)
+        return urljoin(self.url, url)
+
+    def _deployment_name(self, namespace, app_type):
+        """Deployments live on across releases, unlike RCs there is one per process type"""
+        return '{}-{}'.format(namespace, app_type)
+
+    def _deploy_deployment(self, namespace, name, image, command, **kwargs):
+        """
+        Hand the rollout over to Kubernetes by creating or updating the Deployment of
+        a process type and follow its status until the new pods are available
+        """
+        app_type = kwargs.get('app_type')
+        routable = kwargs.get('routable', False)
+        port = kwargs.get('envs', {}).get('PORT', None)
+        deployment_name = self._deployment_name(namespace, app_type)
+
+        # process types deployed before Deployments were used are still run by a RC
+        old_rc = self.get_old_rc(namespace, app_type)
+
+        try:
+            deployment = self.get_deployment(namespace, deployment_name).json()
+            old = copy.deepcopy(deployment)
+            if deployment['spec']['template']['metadata']['labels']['version'] == kwargs.get('version'):  # noqa
+                logger.info('Deployment {} already runs {} under Namespace {}. Stopping deploy'.format(deployment_name, kwargs.get('version'), namespace))  # noqa
+                return
+
+            kwargs['replicas'] = deployment['spec']['replicas']
+        except KubeHTTPException:
+            deployment = old = None
+            if old_rc:
+                kwargs['replicas'] = int(old_rc['spec']['replicas'])
+            else:
+                logger.info('No prior RC or Deployment could be found for {}-{}'.format(namespace, app_type))  # noqa
+
+        manifest = self._build_deployment(namespace, deployment_name, name, image, command, **kwargs)  # noqa
+        try:
+            if deployment is None:
+                self.create_deployment(namespace, deployment_name, manifest)
+            else:
+                # only the pod template and the rollout strategy change on a new release
+                for field in ['template', 'strategy']:
+                    deployment['spec'][field] = manifest['spec'][field]
+                deployment['metadata']['labels'] = manifest['metadata']['labels']
+                self.update_deployment(namespace, deployment_name, deployment)
+
+            self._wait_for_deployment(namespace, deployment_name)
+        except Exception as e:
+            # New release is broken. Have Kubernetes go back to the old one
+            if old is None:
+                self.cleanup_deployment(namespace, deployment_name)
+            else:
+                current = self.get_deployment(namespace, deployment_name).json()
+                current['metadata']['labels'] = old['metadata']['labels']
+                current['spec']['template'] = old['spec']['template']
+                current['spec']['strategy'] = old['spec']['strategy']
+                self.update_deployment(namespace, deployment_name, current)
+
+            raise KubeException(
+                'Could not roll out {} to {}. '
+                'Going back to old release'.format(deployment_name, kwargs.get('version'))
+            ) from e
+
+        # New release is live and kicking. Clean up the RC it took over from
+        if old_rc:
+            self.cleanup_release(namespace, old_rc)
+
+        # Make sure the application is routable and uses the correct port
+        self._update_application_service(namespace, name, app_type, port, routable)
+
+    def _scale_deployment(self, namespace, name, image, command, **kwargs):
+        deployment_name = self._deployment_name(namespace, kwargs.get('app_type'))
+        replicas = kwargs.pop('replicas')
+        try:
+            deployment = self.get_deployment(namespace, deployment_name).json()
+        except KubeHTTPException:
+            # add Deployment if it is missing for the process type
+            manifest = self._build_deployment(
+                namespace, deployment_name, name, image, command, replicas=replicas, **kwargs
+            )
+            self.create_deployment(namespace, deployment_name, manifest)
+            self._wait_for_deployment(namespace, deployment_name)
+            return
+
+        current = deployment['spec']['replicas']
+        if current == replicas:
+            logger.info("Not scaling Deployment {} in Namespace {} to {} replicas. Already at desired replicas".format(deployment_name, namespace, replicas))  # noqa
+            return
+
+        logger.info("scaling Deployment {} in Namespace {} from {} to {} replicas".format(deployment_name, namespace, current, replicas))  # noqa
+        deployment['spec']['replicas'] = replicas
+        self.update_deployment(namespace, deployment_name, deployment)
+        try:
+            self._wait_for_deployment(namespace, deployment_name)
+        except KubeException:
+            logger.exception("Scaling failed for {}".format(deployment_name))
+            deployment = self.get_deployment(namespace, deployment_name).json()
+            deployment['spec']['replicas'] = current
+            self.update_deployment(namespace, deployment_name, deployment)
+            raise
+
+    def _build_deployment(self, namespace, name, pod_name, image, command, **kwargs):
+        # pods of every release are selected, the version tells the releases apart
+        labels = {
+            'app': namespace,
+            'type': kwargs.get('app_type'),
+            'heritage': 'deis',
+        }
+
+        # bring up as many new pods at a time as the RC based deploy would per batch
+        # and never go below the desired amount of pods in service
+        steps = self._deploy_steps(**kwargs)
+        manifest = {
+            'kind': 'Deployment',
+            'apiVersion': 'extensions/v1beta1',
+            'metadata': {
+                'name': name,
+                'labels': dict(labels, version=kwargs.get('version'))
+            },
+            'spec': {
+                'replicas': kwargs.get('replicas', 0),
+                'selector': {'matchLabels': labels},
+                'strategy': {
+                    'type': 'RollingUpdate',
+                    'rollingUpdate': {
+                        'maxSurge': max(1, steps),
+                        'maxUnavailable': 0
+                    }
+                }
+            }
+        }
+
+        # tell pod how to execute the process
+        kwargs['args'] = command.split()
+
+        # pod manifest spec
+        manifest['spec']['template'] = self._build_pod_manifest(namespace, pod_name, image, **kwargs)  # noqa
+
+        return manifest
+
+    @trace.traced('wait_for_deployment', 'name')
+    def _wait_for_deployment(self, namespace, name):
+        """
+        Follow the status of a Deployment until Kubernetes reports all of the desired
+        pods of the current template as updated and available, and no old ones remain
+        """
+        deployment = self.get_deployment(namespace, name).json()
+        desired = deployment['spec']['replicas']
+        surge = deployment['spec']['strategy']['rollingUpdate']['maxSurge']
+
+        # every batch gets as long as a batch of the RC based rollout would
+        timeout = 120
+        container = self._find_container(name, deployment['spec']['template']['spec']['containers'])  # noqa
+        if container is not None and 'readinessProbe' in container:
+            timeout += int(container['readinessProbe']['initialDelaySeconds'])
+        timeout *= max(1, -(-desired // surge))
+
+        logger.info("waiting for Deployment {} in Namespace {} to roll out {} pods ({}s timeout)".format(name, namespace, desired, timeout))  # noqa
+        start = clock.time()
+        logged = 0
+        fields = {'metadata.name': name}
+        for deployments in self._observe(namespace, 'deployments', fields=fields):
+            # field selectors are not guaranteed to be honoured, find the Deployment by name
+            deployment = self._find_object(name, deployments)
+            if deployment is not None and self._deployment_done(deployment):
+                logger.info("Deployment {} in Namespace {} rolled out".format(name, namespace))
+                return
+
+            waited = int(clock.time() - start)
+            if waited >= timeout:
+                raise KubeException('timed out ({}s) waiting for Deployment {} in Namespace {} to roll out'.format(timeout, name, namespace))  # noqa
+
+            if waited - logged >= 10:
+                logged = waited
+                status = deployment.get('status', {}) if deployment else {}
+                logger.info("waited {}s and {} out of {} pods of Deployment {} are updated and available".format(waited, min(status.get('updatedReplicas', 0), status.get('availableReplicas', 0)), desired, name))  # noqa
+
+    def _deployment_done(self, deployment):
+        # fields with a value of 0 are left out by the API server
+        status = deployment.get('status', {})
+        desired = deployment['spec']['replicas']
+        return (
+            status.get('observedGeneration', 0) >= deployment['metadata'].get('generation', 0) and
+            status.get('updatedReplicas', 0) == desired and
+            status.get('replicas', 0) == desired and
+            status.get('availableReplicas', 0) >= desired
+        )
+
+    def cleanup_deployment(self, namespace, name):
+        """Scale down the pods of a Deployment and remove it"""
+        deployment = self.get_deployment(namespace, name).json()
+        if deployment['spec']['replicas']:
+            deployment['spec']['replicas'] = 0
+            self.update_deployment(namespace, name, deployment)
+            self._wait_for_deployment(namespace, name)
+
+        self.delete_deployment(namespace, name)
+
+    def get_deployment(self, namespace, name):
+        url = self._api_extensions("/namespaces/{}/deployments/{}", namespace, name)
+        response = self.session.get(url)
+        if unhealthy(response.status_code):
+            raise KubeHTTPException(
+                response,
+                'get Deployment "{}" in Namespace "{}"', name, namespace
+            )
+
+        return response
+
+    def get_deployments(self, namespace, **kwargs):
+        url = self._api_extensions("/namespaces/{}/deployments", namespace)
+        response = self.session.get(url, params=self._selectors(**kwargs))
+        if unhealthy(response.status_code):
+            raise KubeHTTPException(response, 'get Deployments in Namespace "{}"', namespace)
+
+        return response
+
+    def create_deployment(self, namespace, name, manifest):
+        url = self._api_extensions("/namespaces/{}/deployments", namespace)
+        response = self.session.post(url, json=manifest)
+        if unhealthy(response.status_code):
+            logger.debug('manifest used: {}'.format(ruamel.yaml.dump(manifest)))
+            raise KubeHTTPException(
+                response,
+                'create Deployment "{}" in Namespace "{}"', name, namespace
+            )
+
+        return response
+
+    def update_deployment(self, namespace, name, data):
+        url = self._api_extensions("/namespaces/{}/deployments/{}", namespace, name)
+        response = self.session.put(url, json=data)
+        if unhealthy(response.status_code):
+            raise KubeHTTPException(
+                response,
+                'update Deployment "{}" in Namespace "{}"', name, namespace
+            )
+
+        return response
+
+    def delete_deployment(self, namespace, name):
+        url = self._api_extensions("/namespaces/{}/deployments/{}", namespace, name)
+        response = self.session.delete(url)
+        if unhealthy(response.status_code):
+            raise KubeHTTPException(
+                response,
+                'delete Deployment "{}" in Namespace "{}"', name, namespace
+            )
+
+        return response
+
     # REPLICATION CONTROLLER #
 
     def get_old_rc(self, namespace, app_type):
@@ -704,8 +1159,10 @@ class KubeHTTPClient(object):
         return response
 
     def get_rcs(self, namespace, **kwargs):
-        url = self._api("/namespaces/{}/replicationcontrollers", namespace)
-        response = self.session.get(url, params=self._selectors(**kwargs))
+        response = self._cached('replicationcontrollers', namespace, **kwargs)
+        if response is None:
+            url = self._api("/namespaces/{}/replicationcontrollers", namespace)
+            response = self.session.get(url, params=self._selectors(**kwargs))
         if unhealthy(response.status_code):
             raise KubeHTTPException(
                 response,
@@ -714,6 +1171,7 @@ class KubeHTTPClient(object):
 
         return response
 
+    @trace.traced('wait_until_pods_terminate', 'current', 'desired')
     def _wait_until_pods_terminate(self, namespace, labels, current, desired):
         """Wait until all the desired pods are terminated"""
         # http://kubernetes.io/docs/api-reference/v1/definitions/#_v1_podspec
@@ -723,15 +1181,16 @@ class KubeHTTPClient(object):
         timeout = settings.KUBERNETES_POD_TERMINATION_GRACE_PERIOD_SECONDS
         delta = current - desired
         logger.info("waiting for {} pods in {} namespace to be terminated ({}s timeout)".format(delta, namespace, timeout))  # noqa
-        for waited in range(timeout):
-            pods = self.get_pods(namespace, labels=labels).json()
-            count = len(pods['items'])
+        start = clock.time()
+        logged = 0
+        for pods in self._observe(namespace, 'pods', labels=labels):
+            count = len(pods)
 
             # see if any pods are past their terminationGracePeriodsSeconds (as in stuck)
             # seems to be a problem in k8s around that:
             # https://github.com/kubernetes/kubernetes/search?q=terminating&type=Issues
             # these will be eventually GC'ed by k8s, ignoring them for now
-            for pod in pods['items']:
+            for pod in pods:
                 # remove pod if it is passed the graceful termination period
                 if self.pod_deleted(pod):
                     count -= 1
@@ -740,19 +1199,24 @@ class KubeHTTPClient(object):
             if count == desired:
                 break
 
-            if waited > 0 and (waited % 10) == 0:
-                logger.info("waited {}s and {} pods out of {} are fully terminated".format(waited, (delta - count), delta))  # noqa
+            waited = int(clock.time() - start)
+            if waited >= timeout:
+                break
 
-            time.sleep(1)
+            if waited - logged >= 10:
+                logged = waited
+                logger.info("waited {}s and {} pods out of {} are fully terminated".format(waited, (delta - count), delta))  # noqa
 
         logger.info("{} pods in namespace {} are terminated".format(delta, namespace))
 
+    @trace.traced('wait_until_pods_are_ready', 'desired')  # noqa
     def _wait_until_pods_are_ready(self, namespace, container, labels, desired):  # noqa
+        # the name is enough, the spec carries the env and secret references
+        trace.annotate(container=container['name'])
         # If desired is 0 then there is no ready state to check on
         if desired == 0:
             return
 
-        waited = 0
         timeout = 120  # 2 minutes
         # If there is initial delay on the readiness check then timeout needs to be higher
         # this is to account for kubernetes having readiness check report as failure until
@@ -767,18 +1231,25 @@ class KubeHTTPClient(object):
         logger.info("waiting for {} pods in {} namespace to be in services ({} timeout)".format(desired, namespace, timeout))  # noqa
 
         # Ensure the minimum desired number of pods are available
-        while waited < timeout:
+        start = clock.time()
+        waited = logged = 0
+        extended = False  # timeout is only extended once for slow image pulls
+        for pods in self._observe(namespace, 'pods', labels=labels):
             count = 0  # ready pods
-            pods = self.get_pods(namespace, labels=labels).json()
-            for pod in pods['items']:
+            # at most one events request per cycle, shared by all pending pods
+            events = PodEvents(self, namespace)
+            for pod in pods:
                 # Get more information on why a pod is pending
                 if pod['status']['phase'] == 'Pending':
-                    reason, message = self._pod_pending_status(pod)
+                    reason, message = self._pod_pending_status(pod, events)
                     # If pulling an image is taking long then increase the timeout
-                    timeout += self._handle_pod_long_image_pulling(pod, reason)
+                    if not extended:
+                        extension = self._handle_pod_long_image_pulling(pod, reason, events)
+                        extended = extension > 0
+                        timeout += extension
 
                     # handle errors and bubble up if need be
-                    self._handle_pod_image_errors(pod, reason, message)
+                    self._handle_pod_image_errors(pod, reason, message, events)
 
                 # now that state is running time to see if probes are passing
                 if self._pod_ready(pod):
@@ -794,19 +1265,21 @@ class KubeHTTPClient(object):
             if count == desired:
                 break
 
-            if waited > 0 and (waited % 10) == 0:
-                logger.info("waited {}s and {} pods are in service".format(waited, count))
+            waited = int(clock.time() - start)
+            if waited >= timeout:
+                break
 
-            # increase wait time without dealing with jitters from above code
-            waited += 1
-            time.sleep(1)
+            if waited - logged >= 10:
+                logged = waited
+                logger.info("waited {}s and {} pods are in service".format(waited, count))
 
         # timed out
-        if waited > timeout:
+        if waited >= timeout:
             logger.info('timed out ({}s) waiting for pods to come up in namespace {}'.format(timeout, namespace))  # noqa
 
         logger.info("{} out of {} pods in namespace {} are in service".format(count, desired, namespace))  # noqa
 
+    @trace.traced('scale_rc', 'name', 'desired')
     def _scale_rc(self, namespace, name, desired):
         rc = self.get_rc(namespace, name).json()
 
@@ -856,6 +1329,17 @@ class KubeHTTPClient(object):
 
         return None
 
+    def _find_object(self, name, items):
+        """
+        Locate a Kubernetes object by name in a list of objects
+        """
+        for item in items:
+            if item['metadata']['name'] == name:
+                return item
+
+        return None
+
+    @trace.traced('create_rc', 'name')
     def create_rc(self, namespace, name, image, command, **kwargs):
         manifest = {
             'kind': 'ReplicationController',
@@ -889,6 +1373,8 @@ class KubeHTTPClient(object):
             )
             logger.debug('manifest used: {}'.format(ruamel.yaml.dump(manifest)))
 
+        self._wrote('replicationcontrollers', namespace, resp)
+
         self._wait_for_rc_ready(namespace, name)
 
         return resp
@@ -902,20 +1388,22 @@ class KubeHTTPClient(object):
         https://github.com/kubernetes/kubernetes/blob/master/docs/devel/api-conventions.md#metadata
         """
         logger.debug("waiting for ReplicationController {} to get a newer generation (30s timeout)".format(name))  # noqa
-        for _ in range(30):
-            try:
-                rc = self.get_rc(namespace, name).json()
-                if (
-                    "observedGeneration" in rc["status"] and
-                    rc["status"]["observedGeneration"] >= rc["metadata"]["generation"]
-                ):
-                    logger.debug("ReplicationController {} got a newer generation (30s timeout)".format(name))  # noqa
-                    break
+        timeout = 30
+        start = clock.time()
+        fields = {'metadata.name': name}
+        for controllers in self._observe(namespace, 'replicationcontrollers', fields=fields):
+            # field selectors are not guaranteed to be honoured, find the RC by name
+            rc = self._find_object(name, controllers)
+            if (
+                rc is not None and
+                "observedGeneration" in rc["status"] and
+                rc["status"]["observedGeneration"] >= rc["metadata"]["generation"]
+            ):
+                logger.debug("ReplicationController {} got a newer generation (30s timeout)".format(name))  # noqa
+                break
 
-                time.sleep(1)
-            except KubeHTTPException as e:
-                if e.response.status_code == 404:
-                    time.sleep(1)
+            if (clock.time() - start) >= timeout:
+                break
 
     def update_rc(self, namespace, name, data):
         url = self._api("/namespaces/{}/replicationcontrollers/{}", namespace, name)
@@ -923,6 +1411,8 @@ class KubeHTTPClient(object):
         if unhealthy(response.status_code):
             raise KubeHTTPException(response, 'scale ReplicationController "{}"', name)
 
+        self._wrote('replicationcontrollers', namespace, response)
+
         return response
 
     def delete_rc(self, namespace, name):
@@ -934,8 +1424,14 @@ class KubeHTTPClient(object):
                 'delete ReplicationController "{}" in Namespace "{}"', name, namespace
             )
 
+        self._wrote('replicationcontrollers', namespace, response)
+
         return response
 
+    def delete_rcs(self, namespace, labels):
+        """Delete all ReplicationControllers matching the labels, their pods are left behind"""
+        return self._delete_collection('replicationcontrollers', namespace, labels)
+
     def _healthcheck(self, namespace, container, routable=False, path='/', port=5000,
                      delay=30, timeout=5, period_seconds=1, success_threshold=1,
                      failure_threshold=3):  # noqa
@@ -1062,8 +1558,10 @@ class KubeHTTPClient(object):
     # SECRETS #
     # http://kubernetes.io/v1.1/docs/api-reference/v1/definitions.html#_v1_secret
     def get_secret(self, namespace, name):
-        url = self._api("/namespaces/{}/secrets/{}", namespace, name)
-        response = self.session.get(url)
+        response = self._cached('secrets', namespace, name=name)
+        if response is None:
+            url = self._api("/namespaces/{}/secrets/{}", namespace, name)
+            response = self.session.get(url)
         if unhealthy(response.status_code):
             raise KubeHTTPException(
                 response,
@@ -1117,6 +1615,8 @@ class KubeHTTPClient(object):
                 'failed to create Secret "{}" in Namespace "{}"', name, namespace
             )
 
+        self._wrote('secrets', namespace, response)
+
         return response
 
     def update_secret(self, namespace, name, data):
@@ -1137,6 +1637,8 @@ class KubeHTTPClient(object):
                 name, namespace
             )
 
+        self._wrote('secrets', namespace, response)
+
         return response
 
     def delete_secret(self, namespace, name):
@@ -1148,13 +1650,20 @@ class KubeHTTPClient(object):
                 'delete Secret "{}" in Namespace "{}"', name, namespace
             )
 
+        self._wrote('secrets', namespace, response)
+
         return response
 
+    def delete_secrets(self, namespace, labels):
+        return self._delete_collection('secrets', namespace, labels)
+
     # SERVICES #
 
     def get_service(self, namespace, name):
-        url = self._api("/namespaces/{}/services/{}", namespace, name)
-        response = self.session.get(url)
+        response = self._cached('services', namespace, name=name)
+        if response is None:
+            url = self._api("/namespaces/{}/services/{}", namespace, name)
+            response = self.session.get(url)
         if unhealthy(response.status_code):
             raise KubeHTTPException(
                 response,
@@ -1185,6 +1694,8 @@ class KubeHTTPClient(object):
                 'create Service "{}" in Namespace "{}"', namespace, namespace
             )
 
+        self._wrote('services', namespace, response)
+
         return response
 
     def update_service(self, namespace, name, data):
@@ -1196,6 +1707,8 @@ class KubeHTTPClient(object):
                 'update Service "{}" in Namespace "{}"', namespace, name
             )
 
+        self._wrote('services', namespace, response)
+
         return response
 
     def delete_service(self, namespace, name):
@@ -1207,6 +1720,8 @@ class KubeHTTPClient(object):
                 'delete Service "{}" in Namespace "{}"', name, namespace
             )
 
+        self._wrote('services', namespace, response)
+
         return response
 
     # PODS #
@@ -1220,8 +1735,10 @@ class KubeHTTPClient(object):
         return response
 
     def get_pods(self, namespace, **kwargs):
-        url = self._api('/namespaces/{}/pods', namespace)
-        response = self.session.get(url, params=self._selectors(**kwargs))
+        response = self._cached('pods', namespace, **kwargs)
+        if response is None:
+            url = self._api('/namespaces/{}/pods', namespace)
+            response = self.session.get(url, params=self._selectors(**kwargs))
         if unhealthy(response.status_code):
             raise KubeHTTPException(response, 'get Pods in Namespace "{}"', namespace)
 
@@ -1233,6 +1750,8 @@ class KubeHTTPClient(object):
         if unhealthy(resp.status_code):
             raise KubeHTTPException(resp, 'delete Pod "{}" in Namespace "{}"', name, namespace)
 
+        self._wrote('pods', namespace, resp)
+
         # Verify the pod has been deleted
         # Only wait as long as the grace period is - k8s will eventually GC
         for _ in range(settings.KUBERNETES_POD_TERMINATION_GRACE_PERIOD_SECONDS):
@@ -1245,11 +1764,23 @@ class KubeHTTPClient(object):
                 if e.response.status_code == 404:
                     break
 
-            time.sleep(1)
+            clock.sleep(1)
+
+    def delete_pods(self, namespace, labels):
+        """
+        Delete all pods matching the labels without waiting for them to go away,
+        k8s takes care of the graceful termination
+        """
+        return self._delete_collection('pods', namespace, labels)
 
-    def _pod_log(self, namespace, name):
+    def _pod_log(self, namespace, name, follow=False, timeout=None):
         url = self._api("/namespaces/{}/pods/{}/log", namespace, name)
-        response = self.session.get(url)
+        if follow:
+            # read timeout is how long the container may be quiet
+            response = self.session.get(url, params={'follow': 'true'}, stream=True,
+                                        timeout=(10, timeout))
+        else:
+            response = self.session.get(url)
         if unhealthy(response.status_code):
             raise KubeHTTPException(
                 response,
@@ -1258,37 +1789,28 @@ class KubeHTTPClient(object):
 
         return response
 
-    def _pod_pending_status(self, pod):
+    def _pod_pending_status(self, pod, events=None):
         """Introspect the pod containers when pod is in Pending state"""
-        if 'containerStatuses' not in pod['status']:
-            return 'Pending', ''
-
-        name = '{}-{}'.format(pod['metadata']['labels']['app'], pod['metadata']['labels']['type'])
-        # find the right container in case there are many on the pod
-        container = self._find_container(name, pod['status']['containerStatuses'])
-        if container is None:
+        waiting = pod_statuses.get(pod).waiting
+        if waiting is None:
             # Return Pending if nothing else can be found
             return 'Pending', ''
 
-        if 'waiting' in container['state']:
-            reason = container['state']['waiting']['reason']
-            message = ''
-            # message is not always available
-            if 'message' in container['state']['waiting']:
-                message = container['state']['waiting']['message']
-
-            if reason == 'ContainerCreating':
-                # get the last event
-                event = self._pod_events(pod).pop()
-                return event['reason'], event['message']
+        if waiting[0] == 'ContainerCreating':
+            # get the last event, events change without the pod changing
+            event = self._pod_events(pod, events).pop()
+            return event['reason'], event['message']
 
-            return reason, message
+        return waiting
 
-        # Return Pending if nothing else can be found
-        return 'Pending', ''
+    def _pod_events(self, pod, events=None):
+        """
+        Process events for a given Pod to find if Pulling is happening, among other events.
+        Looked up in the events of the whole Namespace when a PodEvents is passed
+        """
+        if events is not None:
+            return events.get(pod)
 
-    def _pod_events(self, pod):
-        """Process events for a given Pod to find if Pulling is happening, among other events"""
         # fetch all events for this pod
         fields = {
             'involvedObject.name': pod['metadata']['name'],
@@ -1302,68 +1824,32 @@ class KubeHTTPClient(object):
 
     def _pod_readiness_status(self, pod):
         """Check if the pod container have passed the readiness probes"""
-        name = '{}-{}'.format(pod['metadata']['labels']['app'], pod['metadata']['labels']['type'])
-        # find the right container in case there are many on the pod
-        container = self._find_container(name, pod['status']['containerStatuses'])
-        if container is None:
-            # Seems like the most sensible default
-            return 'Unknown'
-
-        if not container['ready']:
-            if 'running' in container['state'].keys():
-                return 'Starting'
-
-            if (
-                'terminated' in container['state'].keys() or
-                'deletionTimestamp' in pod['metadata']
-            ):
-                return 'Terminating'
-        else:
-            # See if k8s is in Terminating state
-            if 'deletionTimestamp' in pod['metadata']:
-                return 'Terminating'
-
-            return 'Running'
-
-        # Seems like the most sensible default
-        return 'Unknown'
+        return pod_statuses.get(pod).readiness
 
     def _pod_liveness_status(self, pod):
         """Check if the pods liveness probe status has passed all checks"""
-        for condition in pod['status']['conditions']:
-            # type = Ready is the only binary type right now
-            if condition['type'] == 'Ready' and condition['status'] != 'True':
-                return False
-
-        return True
+        return pod_statuses.get(pod).live
 
     def _pod_ready(self, pod):
         """Combines various checks to see if the pod is considered up or not by checking probes"""
+        status = pod_statuses.get(pod)
         return (
-            pod['status']['phase'] == 'Running' and
+            status.phase == 'Running' and
             # is the readiness probe passing?
-            self._pod_readiness_status(pod) == 'Running' and
+            status.readiness == 'Running' and
             # is the pod ready to serve requests?
-            self._pod_liveness_status(pod)
+            status.live
         )
 
     def pod_deleted(self, pod):
         """Checks if a pod is deleted and past its graceful termination period"""
         # https://github.com/kubernetes/kubernetes/blob/release-1.2/docs/devel/api-conventions.md#metadata
         # http://kubernetes.io/docs/user-guide/pods/#termination-of-pods
-        if 'deletionTimestamp' in pod['metadata']:
-            deletion = datetime.strptime(
-                pod['metadata']['deletionTimestamp'],
-                settings.DEIS_DATETIME_FORMAT
-            )
-
-            # past the graceful deletion period
-            if deletion < datetime.utcnow():
-                return True
+        deletion = pod_statuses.get(pod).deletion
+        # past the graceful deletion period
+        return deletion is not None and deletion < clock.utcnow()
 
-        return False
-
-    def _handle_pod_image_errors(self, pod, reason, message):
+    def _handle_pod_image_errors(self, pod, reason, message, events=None):
         """
         Handle potential pod image errors based on the Pending
         reason passed into the function
@@ -1391,29 +1877,25 @@ class KubeHTTPClient(object):
 
             # collect all error messages relevant to images
             messages = []
-            for event in self._pod_events(pod):
+            for event in self._pod_events(pod, events):
                 if event['reason'] in image_event_errors.keys():
                     # remove new lines and any extra white space
                     message = ' '.join(event['message'].split())
                     messages.append(message)
             raise KubeException("\n".join(messages))
 
-    def _handle_pod_long_image_pulling(self, reason, pod):
+    def _handle_pod_long_image_pulling(self, pod, reason, events=None):
         """
         If pulling an image is taking long (1 minute) then return how many seconds
         the pod ready state timeout should be extended by
 
         Return value is an int that represents seconds
         """
-        # only apply once
-        if getattr(self, '_handle_pod_long_image_pulling_applied', False):
-            return 0
-
-        if reason is not 'Pulling':
+        if reason != 'Pulling':
             return 0
 
         # last event should be Pulling in this case
-        event = self._pod_events(pod).pop()
+        event = self._pod_events(pod, events).pop()
         # see if pull operation has been happening for over 1 minute
         start = datetime.strptime(
             event['firstTimestamp'],
@@ -1421,17 +1903,165 @@ class KubeHTTPClient(object):
         )
 
         seconds = 60  # time threshold before padding timeout
-        if (start + timedelta(seconds=seconds)) < datetime.utcnow():
+        if (start + timedelta(seconds=seconds)) < clock.utcnow():
             # add 10 minutes to timeout to allow a pull image operation to finish
             logger.info('Kubernetes has been pulling the image for {} seconds'.format(seconds))  # noqa
-            logger.info('Increasing timeout by 10 minutes to allow a pull image operation to finish for pods in namespace {}'.format(namespace))  # noqa
-
-            # make it so function doesn't do processing again
-            setattr(self, '_handle_pod_long_image_pulling_applied', True)
+            logger.info('Increasing timeout by 10 minutes to allow a pull image operation to finish for pods in namespace {}'.format(pod['metadata']['namespace']))  # noqa
             return 600
 
         return 0
 
+    # INFORMERS #
+
+    @property
+    def informers(self):
+        # created on first use as not every client goes through __init__ (e.g. the mock)
+        if '_informers' not in self.__dict__:
+            with _informers_lock:
+                if '_informers' not in self.__dict__:
+                    self._informers = Informers(self)
+
+        return self._informers
+
+    def _cached(self, resource, namespace, name=None, **kwargs):
+        """
+        Serve a read from the informer of a resource type in a Namespace, starting one
+        if needed. Returns None when the read has to go to the API server instead
+        """
+        if not settings.KUBERNETES_INFORMERS_ENABLED or kwargs.get('fields', {}):
+            return None
+
+        informer = self.informers.get(resource, namespace)
+        if not informer.fresh():
+            return None
+
+        if name is not None:
+            return informer.get(name)
+
+        return informer.list(kwargs.get('labels', {}))
+
+    def _wrote(self, resource, namespace, response):
+        """Make sure a running informer does not serve reads from before a write"""
+        if not settings.KUBERNETES_INFORMERS_ENABLED:
+            return
+
+        informer = self.informers.peek(resource, namespace)
+        if informer is None:
+            return
+
+        try:
+            version = response.json().get('metadata', {}).get('resourceVersion', None)
+        except ValueError:
+            version = None
+
+        informer.wrote(version)
+
+    # WATCH #
+
+    def _watch(self, tmpl, *args, **kwargs):
+        """
+        Stream the watch events of a collection of resources, starting at the given
+        resourceVersion. Each event has a type (ADDED, MODIFIED, DELETED or ERROR) and
+        the object it applies to.
+
+        http://kubernetes.io/docs/api-reference/v1/definitions/#_json_watchevent
+        """
+        url = kwargs.pop('api', self._api)(tmpl, *args)
+        timeout = kwargs.pop('timeout', settings.KUBERNETES_WATCH_TIMEOUT_SECONDS)
+        params = self._selectors(**kwargs)
+        params['watch'] = 'true'
+        # have the API server close the stream so the caller gets a chance to re-evaluate
+        params['timeoutSeconds'] = timeout
+
+        # read timeout gives the API server some slack to close the stream on its own
+        response = self.session.get(url, params=params, stream=True, timeout=timeout + 5)
+        if unhealthy(response.status_code):
+            raise KubeHTTPException(response, 'watch {}', url)
+
+        try:
+            for line in response.iter_lines():
+                # skip keep-alive new lines
+                if not line:
+                    continue
+
+                event = json.loads(line.decode('utf-8'))
+                if 'type' not in event or 'object' not in event:
+                    raise KubeException('{} does not support watching'.format(url))
+
+                yield event
+        finally:
+            response.close()
+
+    def _follow(self, tmpl, namespace, version, items, **kwargs):
+        """
+        Apply watch events on to items (name => object) and yield the current objects
+        after each change. Resumes from the last seen resourceVersion when a stream
+        ends or drops, returns when the resourceVersion is too old and a new list is needed
+        """
+        failures = 0
+        while True:
+            try:
+                for event in self._watch(tmpl, namespace, resourceVersion=version, **kwargs):
+                    failures = 0
+                    obj = event['object']
+                    if event['type'] == 'ERROR':
+                        # most likely 410 Gone - the resourceVersion is too old to resume from
+                        logger.debug('watch error in Namespace {}: {}'.format(namespace, obj.get('message')))  # noqa
+                        return
+
+                    version = obj['metadata']['resourceVersion']
+                    if event['type'] == 'DELETED':
+                        items.pop(obj['metadata']['name'], None)
+                    else:
+                        items[obj['metadata']['name']] = obj
+
+                    yield list(items.values())
+            except KubeHTTPException as e:
+                if e.response.status_code == 410:
+                    return
+
+                raise
+            except requests.exceptions.RequestException:
+                # connection dropped, try to resume a couple of times before giving up
+                failures += 1
+                if failures > 3:
+                    raise
+
+            # the stream ended without an error, let the caller look at the current state
+            yield list(items.values())
+
+    def _observe(self, namespace, resource, **kwargs):
+        """
+        Yield the current list of objects of a given resource type in a Namespace every
+        time it changes, as well as every time a watch times out so time based conditions
+        can be evaluated.
+
+        Lists once and follows the changes via the watch API, falls back to
+        polling once a second when watching is disabled or not possible.
+        """
+        fetch, api = {
+            'pods': (self.get_pods, self._api),
+            'replicationcontrollers': (self.get_rcs, self._api),
+            'deployments': (self.get_deployments, self._api_extensions),
+        }[resource]
+        tmpl = '/namespaces/{}/' + resource
+        watch = settings.KUBERNETES_WATCH_ENABLED
+        while True:
+            data = fetch(namespace, **kwargs).json()
+            items = OrderedDict((item['metadata']['name'], item) for item in data['items'])
+            yield list(items.values())
+
+            version = data.get('metadata', {}).get('resourceVersion', None)
+            if not watch or not version:
+                clock.sleep(1)
+                continue
+
+            try:
+                yield from self._follow(tmpl, namespace, version, items, api=api, **kwargs)
+            except (KubeException, requests.exceptions.RequestException, ValueError) as e:
+                logger.info('could not watch {} in Namespace {}, polling instead: {}'.format(resource, namespace, e))  # noqa
+                watch = False
+
     # NODES #
 
     def get_nodes(self, **kwargs):
@@ -1452,3 +2082,24 @@ class KubeHTTPClient(object):
 
 
 SchedulerClient = KubeHTTPClient
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_scheduler():
+    """
+    Return the scheduler client of settings.SCHEDULER_MODULE shared by all threads of
+    this process, so connections (and their TLS sessions) to the API server get reused
+    """
+    key = (os.getpid(), settings.SCHEDULER_MODULE)
+    client = _clients.get(key, None)
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        if key not in _clients:
+            module = importlib.import_module(settings.SCHEDULER_MODULE)
+            _clients[key] = module.SchedulerClient()
+
+        return _clients[key]
@@ -0,0 +1,279 @@
+"""
+In-process informers: a local copy of a resource type in a Namespace that is listed
+once and then kept up to date via the watch API, so reads do not need a round trip
+to the Kubernetes API server.
+"""
+from collections import defaultdict
+from http.client import responses
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+import requests
+
+logger = logging.getLogger(__name__)
+
+# how long reads of a resource that can not be watched go to the API server before an
+# informer tries again
+UNWATCHABLE_BACKOFF = 300
+
+KINDS = {
+    'pods': 'Pod',
+    'replicationcontrollers': 'ReplicationController',
+    'secrets': 'Secret',
+    'services': 'Service',
+}
+
+
+def response(status_code, data):
+    """Wrap data in a python-requests response so callers can not tell it apart from a GET"""
+    resp = requests.models.Response()
+    resp.status_code = status_code
+    resp.reason = responses[status_code]
+    resp.headers['Content-Type'] = 'application/json'
+    resp.encoding = 'utf-8'
+    resp._content = bytes(json.dumps(data), 'UTF-8')
+    return resp
+
+
+def status(error):
+    """HTTP status code of a failed request, if there was a response at all"""
+    return getattr(getattr(error, 'response', None), 'status_code', None)
+
+
+def version(value):
+    """resourceVersions are opaque strings but etcd hands out increasing integers"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Informer(object):
+    """
+    Local cache of one resource type in a Namespace, indexed by name and labels.
+
+    A background thread lists the resources once and applies watch events after that,
+    relisting when the watch can not be resumed. Reads should only be served when
+    the informer is fresh: synced, heard from the API server recently and caught up
+    with the writes this process made.
+    """
+
+    def __init__(self, client, resource, namespace):
+        self.client = client
+        self.resource = resource
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.items = {}
+        self.index = defaultdict(set)
+        self.version = None
+        # resourceVersion that has to be seen before the cache can be used again
+        self.required = 0
+        self.synced = False
+        self.stopped = False
+        # no informer is started again for the resource and Namespace before then
+        self.retry = 0
+        self.contact = 0
+        self.used = time.time()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='informer-{}-{}'.format(namespace, resource),
+            daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.synced = False
+
+    def fresh(self):
+        if not self.synced or self.stopped:
+            return False
+
+        if time.time() - self.contact > settings.KUBERNETES_INFORMER_MAX_STALENESS:
+            return False
+
+        with self.lock:
+            current = version(self.version)
+            return current is not None and current >= self.required
+
+    def wrote(self, resource_version):
+        """
+        Record a write so reads are not served before the watch caught up with it.
+        Without a resourceVersion (e.g. a Status object) at least one more event is needed
+        """
+        with self.lock:
+            required = version(resource_version)
+            if required is None:
+                required = (version(self.version) or 0) + 1
+
+            self.required = max(self.required, required)
+
+    def get(self, name):
+        with self.lock:
+            item = self.items.get(name)
+            if item is None:
+                return response(404, {
+                    'kind': 'Status',
+                    'status': 'Failure',
+                    'message': '{} "{}" not found'.format(self.resource, name),
+                    'reason': 'NotFound',
+                    'code': 404
+                })
+
+            return response(200, item)
+
+    def list(self, labels={}):
+        with self.lock:
+            names = set(self.items.keys())
+            for pair in labels.items():
+                names &= self.index.get(pair, set())
+
+            return response(200, {
+                'kind': '{}List'.format(KINDS[self.resource]),
+                'metadata': {'resourceVersion': self.version},
+                'items': [self.items[name] for name in sorted(names)]
+            })
+
+    def run(self):
+        failures = 0
+        while not self.stopped:
+            if time.time() - self.used > settings.KUBERNETES_INFORMER_IDLE_SECONDS:
+                logger.debug('informer for {} in Namespace {} is idle, stopping'.format(self.resource, self.namespace))  # noqa
+                break
+
+            try:
+                if not self._list():
+                    logger.info('{} in Namespace {} can not be watched, stopping informer'.format(self.resource, self.namespace))  # noqa
+                    self.retry = time.time() + UNWATCHABLE_BACKOFF
+                    break
+
+                self._watch()
+                failures = 0
+            except Exception as e:
+                if status(e) == 404:
+                    # the Namespace is gone
+                    break
+
+                logger.info('informer for {} in Namespace {} failed: {}'.format(self.resource, self.namespace, e))  # noqa
+                failures += 1
+
+            if failures:
+                self.synced = False
+                time.sleep(min(2 ** failures, 30))
+
+        self.stop()
+
+    def _list(self):
+        url = self.client._api('/namespaces/{}/' + self.resource, self.namespace)
+        resp = self.client.session.get(url)
+        resp.raise_for_status()
+        data = resp.json()
+
+        resource_version = data.get('metadata', {}).get('resourceVersion', None)
+        if version(resource_version) is None:
+            # no way to watch from here, the informer can not be kept up to date
+            return False
+
+        with self.lock:
+            self.items = {}
+            self.index = defaultdict(set)
+            for item in data['items']:
+                self._add(item)
+
+            self.version = resource_version
+
+        self.contact = time.time()
+        self.synced = True
+        return True
+
+    def _watch(self):
+        """Apply watch events until a relist is needed, stopping when the informer is idle"""
+        tmpl = '/namespaces/{}/' + self.resource
+        while not self.stopped:
+            if time.time() - self.used > settings.KUBERNETES_INFORMER_IDLE_SECONDS:
+                return
+
+            try:
+                for event in self.client._watch(tmpl, self.namespace, resourceVersion=self.version):  # noqa
+                    obj = event['object']
+                    if event['type'] == 'ERROR':
+                        # resourceVersion is too old to resume from
+                        return
+
+                    with self.lock:
+                        self._remove(obj['metadata']['name'])
+                        if event['type'] != 'DELETED':
+                            self._add(obj)
+
+                        self.version = obj['metadata']['resourceVersion']
+
+                    self.contact = time.time()
+            except Exception as e:
+                if status(e) == 410:
+                    return
+
+                raise
+
+            # the stream was closed by the API server, everything up until now has been seen
+            self.contact = time.time()
+
+    def _add(self, item):
+        name = item['metadata']['name']
+        self.items[name] = item
+        for pair in item['metadata'].get('labels', {}).items():
+            self.index[pair].add(name)
+
+    def _remove(self, name):
+        item = self.items.pop(name, None)
+        if item is None:
+            return
+
+        for pair in item['metadata'].get('labels', {}).items():
+            self.index[pair].discard(name)
+            if not self.index[pair]:
+                del self.index[pair]
+
+
+class Informers(object):
+    """Informers of a scheduler client, started on first read of a resource in a Namespace"""
+
+    def __init__(self, client):
+        self.client = client
+        self.informers = {}
+        self.lock = threading.Lock()
+
+    def get(self, resource, namespace):
+        """
+        The informer of a resource in a Namespace, started when there is none. One that
+        stopped because the resource can not be watched is handed out until it may retry,
+        it is never fresh so reads go to the API server without a list and a thread each
+        """
+        key = (resource, namespace)
+        informer = self.informers.get(key, None)
+        if informer is None or self._restart(informer):
+            with self.lock:
+                informer = self.informers.get(key, None)
+                if informer is None or self._restart(informer):
+                    informer = Informer(self.client, resource, namespace)
+                    informer.start()
+                    self.informers[key] = informer
+
+        informer.used = time.time()
+        return informer
+
+    def _restart(self, informer):
+        return informer.stopped and time.time() >= informer.retry
+
+    def peek(self, resource, namespace):
+        """Return the informer if one is running, without starting one"""
+        return self.informers.get((resource, namespace), None)
+
+    def forget(self, namespace):
+        with self.lock:
+            for key in [key for key in self.informers if key[1] == namespace]:
+                self.informers.pop(key).stop()
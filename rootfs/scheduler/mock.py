@@ -1,24 +1,29 @@
-from datetime import datetime, timedelta
-import requests
+from collections import defaultdict, deque, OrderedDict
+import copy
+from datetime import timedelta
+import heapq
+import itertools
+import json
 import requests_mock
 from urllib.parse import urlparse, parse_qs
 import string
 import random
-import time
+import threading
+import uuid
 
-from . import KubeHTTPClient, KubeHTTPException
+from . import InstrumentedSession, KubeHTTPClient, KubeHTTPException
 
 from django.conf import settings
 from django.core.cache import cache
 
+from deis import clock
+
 import logging
 logger = logging.getLogger(__name__)
 
 
-resources = [
-    'namespaces', 'nodes', 'pods', 'replicationcontrollers',
-    'secrets', 'services', 'events'
-]
+# watch events kept to resume watches from, older resourceVersions are gone (410)
+WATCH_EVENTS = 10000
 
 
 def jit():
@@ -28,127 +33,303 @@ def jit():
 
 def jitter():
     """Introduce random jitter (sleep)"""
-    time.sleep(jit())
+    clock.sleep(jit())
 
 
 def pod_name(size=5, chars=string.ascii_lowercase + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))
 
 
-def cache_key(key):
-    """Unify the way keys are stored"""
-    key = key.replace(settings.SCHEDULER_URL, '').replace('/', '_').replace('-', '_').strip('_')
-    return key
+def has_labels(item, labels):
+    """Does the item carry all of the labels"""
+    own = item['metadata'].get('labels', {})
+    return all(own.get(label) == value for label, value in labels.items())
+
+
+class Store(object):
+    """
+    Objects of the mock API server by resource type, namespace and name. Nodes and
+    Namespaces live in the namespace None.
+
+    Objects are indexed by label, every write gets the next resourceVersion and is
+    kept in a log of watch events. Stored objects are never changed in place, so lists
+    and watch events can hand them out as they are; edit() returns a copy to put back.
+    """
+
+    def __init__(self, events=WATCH_EVENTS):
+        self.lock = threading.RLock()
+        self.size = events
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.version = 0
+            # (resource, namespace) => name => object, in order of creation
+            self.objects = defaultdict(OrderedDict)
+            # (resource, namespace, label, value) => names
+            self.labels = defaultdict(set)
+            # (resource, namespace, name) => creation sequence, to list in order
+            self.order = {}
+            self.sequence = itertools.count()
+            # (resourceVersion, resource, namespace, type, object)
+            self.events = deque(maxlen=self.size)
+            # watches need to start after this resourceVersion
+            self.compacted = 0
+            # pod (namespace, name) => log
+            self.logs = {}
+            # pods due for a look at their phase and for removal after their grace period,
+            # heaps of (time, sequence, namespace, name)
+            self.transitions = []
+            self.removals = []
+
+    def get(self, resource, namespace, name):
+        """The stored object, not to be changed, or None"""
+        with self.lock:
+            return self.objects.get((resource, namespace), {}).get(name)
+
+    def edit(self, resource, namespace, name):
+        """A copy of the stored object to change and put() back, or None"""
+        item = self.get(resource, namespace, name)
+        # objects are plain JSON, which copies a lot faster than deepcopy
+        return json.loads(json.dumps(item)) if item is not None else None
+
+    def list(self, resource, namespace, labels=None, fields=None):
+        """Objects that carry all of the labels and fields, in order of creation"""
+        with self.lock:
+            objects = self.objects.get((resource, namespace), {})
+            if labels:
+                names = set.intersection(*[
+                    self.labels.get((resource, namespace, label, value), set())
+                    for label, value in labels.items()
+                ])
+                names = sorted(names, key=lambda name: self.order[(resource, namespace, name)])
+                items = [objects[name] for name in names]
+            else:
+                items = list(objects.values())
+
+        # field selectors are limited to what the client uses
+        for field, value in (fields or {}).items():
+            if field in ('metadata.name', 'metadata.namespace'):
+                key = field.split('.')[1]
+                items = [item for item in items if item['metadata'].get(key) == value]
+
+        return items
+
+    def put(self, resource, namespace, item):
+        """Store item, which is not to be changed afterwards, under the next resourceVersion"""
+        name = item['metadata']['name']
+        with self.lock:
+            objects = self.objects[(resource, namespace)]
+            previous = objects.get(name)
+            if previous is None:
+                self.order[(resource, namespace, name)] = next(self.sequence)
+            else:
+                self._index(resource, namespace, previous, remove=True)
+
+            self.version += 1
+            item['metadata']['resourceVersion'] = self.version
+            objects[name] = item
+            self._index(resource, namespace, item)
+            self._log('ADDED' if previous is None else 'MODIFIED', resource, namespace, item)
+
+        return item
+
+    def delete(self, resource, namespace, name):
+        """Remove an object, returns it as it was deleted or None when there was none"""
+        with self.lock:
+            item = self.objects.get((resource, namespace), {}).pop(name, None)
+            if item is None:
+                return None
+
+            self._index(resource, namespace, item, remove=True)
+            del self.order[(resource, namespace, name)]
+            self.version += 1
+            metadata = dict(item['metadata'], resourceVersion=self.version)
+            item = dict(item, metadata=metadata)
+            self._log('DELETED', resource, namespace, item)
+            if resource == 'pods':
+                self.logs.pop((namespace, name), None)
+
+        return item
+
+    def delete_namespace(self, namespace):
+        """Remove a Namespace and everything in it"""
+        with self.lock:
+            for resource, scope in list(self.objects):
+                if scope != namespace:
+                    continue
+
+                for name in list(self.objects[(resource, scope)]):
+                    self.delete(resource, scope, name)
+
+            self.delete('namespaces', None, namespace)
+
+    def changes(self, resource, namespace, version, labels=None):
+        """
+        Watch events after version of objects that carry all of the labels, None when
+        the log no longer goes back that far
+        """
+        with self.lock:
+            if version < self.compacted:
+                return None
+
+            events = []
+            for seen, kind, scope, event, item in reversed(self.events):
+                if seen <= version:
+                    break
+
+                if kind == resource and scope == namespace and has_labels(item, labels or {}):
+                    events.append({'type': event, 'object': item})
+
+        events.reverse()
+        return events
+
+    def schedule(self, heap, when, namespace, name):
+        with self.lock:
+            heapq.heappush(heap, (when, next(self.sequence), namespace, name))
+
+    def due(self, heap):
+        """Pop the pods of a heap whose time has come"""
+        now = clock.utcnow()
+        items = []
+        with self.lock:
+            while heap and heap[0][0] <= now:
+                _, _, namespace, name = heapq.heappop(heap)
+                items.append((namespace, name))
+
+        return items
+
+    def _index(self, resource, namespace, item, remove=False):
+        name = item['metadata']['name']
+        for label, value in item['metadata'].get('labels', {}).items():
+            key = (resource, namespace, label, value)
+            if not remove:
+                self.labels[key].add(name)
+                continue
+
+            self.labels[key].discard(name)
+            if not self.labels[key]:
+                del self.labels[key]
+
+    def _log(self, event, resource, namespace, item):
+        if len(self.events) == self.events.maxlen:
+            # the oldest event drops out, a watch has to start at its version or later
+            self.compacted = self.events[0][0]
+
+        self.events.append((self.version, resource, namespace, event, item))
+
+
+store = Store()
+
+
+def parse(path):
+    """
+    Split an API path into resource type, namespace, name and subresource, e.g.
+    /api/v1/namespaces/foo/pods/foo-web-1/log is ('pods', 'foo', 'foo-web-1', 'log')
+    """
+    parts = path.strip('/').split('/')
+    # drop /api/v1 or /apis/extensions/v1beta1
+    parts = parts[2:] if parts[0] == 'api' else parts[3:]
+    namespace = None
+    if parts[0] == 'namespaces' and len(parts) > 2:
+        namespace, parts = parts[1], parts[2:]
 
+    name = parts[1] if len(parts) > 1 else None
+    subresource = parts[2] if len(parts) > 2 else None
+    return parts[0], namespace, name, subresource
 
-def get_type(key, pos=-1):
-    key = key.strip('/').split('/')
-    if key[pos] in resources:
-        return key[pos]
 
-    # bad if it gets there
-    return 'unknown'
+def controllers_of(pod):
+    """ReplicationControllers and Deployments that the pod belongs to"""
+    namespace = pod['metadata']['namespace']
+    labels = pod['metadata'].get('labels', {})
+    return (
+        store.list('replicationcontrollers', namespace, labels) +
+        store.list('deployments', namespace, labels)
+    )
 
 
-def pod_state_transitions(pod_url=None):
+def pod_state_transitions(namespace=None, name=None):
     """
     Move pods through the various states while maintaining
     how long a pod should stay in a certain state as well
 
     http://kubernetes.io/docs/user-guide/pod-states/
     """
-    pods = cache.get('pods_states', {})
     # Is there a new pod?
-    if pod_url:
-        state_time = datetime.utcnow() + timedelta(seconds=jit())
-        pods[pod_url] = state_time
-
+    if name is not None:
         # Initial state is Pending
-        new_phase = 'Pending'
-        pod = cache.get(pod_url)
-        pod['status']['phase'] = new_phase
-        cache.set(pod_url, pod)
-
-    # Loops through all the pods to see if next phase needs to be done
-    for pod_url, state_time in pods.items():
-        if datetime.utcnow() < state_time:
-            # it is now time yet!
-            continue
-
-        # Look at the current phase
-        pod = cache.get(pod_url, None)
+        pod = store.edit('pods', namespace, name)
+        pod['status']['phase'] = 'Pending'
+        store.put('pods', namespace, pod)
+        store.schedule(store.transitions, clock.utcnow() + timedelta(seconds=jit()), namespace, name)  # noqa
+
+    # Loops through the pods whose time has come to see if next phase needs to be done
+    for namespace, name in store.due(store.transitions):
+        pod = store.edit('pods', namespace, name)
         if pod is None:
             continue
 
         # this needs to be done from "most advanced phase" to "earliest phase"
+        phase = pod['status']['phase']
 
         # Is this Pod part of an RC or not
         if pod['status']['phase'] == 'Running':
-            # Try to determine the connected RC to readjust pod count
-            # One way is to look at annotations:kubernetes.io/created-by and read
-            # the serialized reference but that looks clunky right now
-            controllers = filter_data({'labels': pod['metadata']['labels']}, 'replicationcontrollers')  # noqa
-            # If Pod is in an RC then do nothing
-            if not controllers:
+            # If Pod is in an RC or Deployment then do nothing, until that goes away
+            if not controllers_of(pod):
                 # If Pod is not in an RC then it needs to move forward
                 pod['status']['phase'] = 'Succeeded'
 
         # Transition from Pending to Running
         if pod['status']['phase'] == 'Pending':
             pod['status']['phase'] = 'Running'
+            # a Pod without RC moves on to Succeeded the next time around
+            store.schedule(store.transitions, clock.utcnow(), namespace, name)
 
-        cache.set(pod_url, pod)
-
-    cache.set('pods_states', pods)
+        if pod['status']['phase'] != phase:
+            store.put('pods', namespace, pod)
 
 
 def cleanup_pods():
     """Can be called during any sort of access, it will cleanup pods as needed"""
-    pods = cache.get('cleanup_pods', {})
-    for pod, timestamp in pods.copy().items():
-        if timestamp > datetime.utcnow():
-            continue
-
-        del pods[pod]
-        remove_cache_item(pod, 'pods')
-        cache.delete(pod + '_log')
-    cache.set('cleanup_pods', pods)
+    for namespace, name in store.due(store.removals):
+        store.delete('pods', namespace, name)
 
 
-def add_cleanup_pod(url):
+def add_cleanup_pod(namespace, name):
     """populate the cleanup pod list"""
     # variance allows a pod to stay alive past grace period
     variance = random.uniform(0.1, 1.5)
     grace = round(settings.KUBERNETES_POD_TERMINATION_GRACE_PERIOD_SECONDS * variance)
 
     # save
-    pods = cache.get('cleanup_pods', {})
-    pods[url] = (datetime.utcnow() + timedelta(seconds=grace))
-    cache.set('cleanup_pods', pods)
+    store.schedule(store.removals, clock.utcnow() + timedelta(seconds=grace), namespace, name)
 
     # add grace period timestamp
-    pod = cache.get(url)
+    pod = store.edit('pods', namespace, name)
     grace = settings.KUBERNETES_POD_TERMINATION_GRACE_PERIOD_SECONDS
-    pd = datetime.utcnow() + timedelta(seconds=grace)
+    pd = clock.utcnow() + timedelta(seconds=grace)
     timestamp = str(pd.strftime(settings.DEIS_DATETIME_FORMAT))
     pod['metadata']['deletionTimestamp'] = timestamp
-    cache.set(url, pod)
+    store.put('pods', namespace, pod)
 
 
-def delete_pod(url, data, request):
+def delete_pod(namespace, name, data):
     # Try to determine the connected RC to readjust pod count
     # One way is to look at annotations:kubernetes.io/created-by and read
     # the serialized reference but that looks clunky right now
-    controllers = filter_data({'labels': data['metadata']['labels']}, 'replicationcontrollers')
+    controllers = store.list('replicationcontrollers', namespace, data['metadata']['labels'])
+    deployments = store.list('deployments', namespace, data['metadata']['labels'])
     if controllers:
-        controller = controllers.pop()
-        upsert_pods(controller, cache_key(request.path))
+        upsert_pods(controllers[-1])
+    elif deployments:
+        upsert_deployment(copy.deepcopy(deployments[-1]))
     else:
         # delete individual item
-        delete_pods([url], 1, 0)
+        delete_pods(namespace, [name], 1, 0)
 
 
-def delete_pods(pods, current, desired):
+def delete_pods(namespace, pods, current, desired):
     if not pods:
         return
 
@@ -163,30 +344,32 @@ def delete_pods(pods, current, desired):
             break
 
         item = pods.pop()
-        pod = cache.get(item)
+        pod = store.get('pods', namespace, item)
         if 'deletionTimestamp' in pod['metadata']:
             continue
 
         removed.append(item)
 
     for item in removed:
-        add_cleanup_pod(item)
+        add_cleanup_pod(namespace, item)
 
 
-def create_pods(url, labels, base, new_pods):
+def create_pods(namespace, labels, base, new_pods):
     # Start by fetching available pods in the Namespace that fit the profile
     # and prune down if needed, Otherwise go into the addition logic here
+    pods = []
     for _ in range(new_pods):
-        data = base.copy()
+        data = copy.deepcopy(base)
         # creation time
-        timestamp = str(datetime.utcnow().strftime(settings.DEIS_DATETIME_FORMAT))
+        timestamp = str(clock.utcnow().strftime(settings.DEIS_DATETIME_FORMAT))
         data['metadata']['creationTimestamp'] = timestamp
+        data['metadata']['uid'] = str(uuid.uuid4())
 
         # generate the pod name and combine with RC name
         if 'generateName' in data['metadata']:
             data['metadata']['name'] = data['metadata']['generateName'] + pod_name()
 
-        timestamp = str(datetime.utcnow().strftime(settings.DEIS_DATETIME_FORMAT))
+        timestamp = str(clock.utcnow().strftime(settings.DEIS_DATETIME_FORMAT))
         data['status'] = {
             'startTime': timestamp,
             'conditions': [
@@ -209,54 +392,35 @@ def create_pods(url, labels, base, new_pods):
         }
 
         # Create the single resource with all its information
-        pod_key = url
-        if cache_key(data['metadata']['name']) not in url:
-            pod_key = cache_key(url + '_' + data['metadata']['name'])
-        cache.set(pod_key, data, None)
-
-        # Keep track of what resources are in a given resource type
-        items = cache.get('pods', [])  # global scope
-        if pod_key not in items:
-            items.append(pod_key)
-            cache.set('pods', items, None)
-
-        # make sure url only has up to "_pods"
-        namespaced_url = url[0:(url.find("_pods") + 5)]
-        items = cache.get(namespaced_url, [])  # pods within the namespace
-        if pod_key not in items:
-            items.append(pod_key)
-            cache.set(namespaced_url, items, None)
+        name = data['metadata']['name']
+        store.put('pods', namespace, data)
 
         # set up a fake log for the pod
-        log = "I did stuff today"
-        pod_log_key = pod_key + '_log'
-        cache.set(pod_log_key, log, None)
+        store.logs[(namespace, name)] = "I did stuff today"
 
         # Add it to the transition loop
-        pod_state_transitions(pod_key)
+        pod_state_transitions(namespace, name)
+        pods.append(store.get('pods', namespace, name))
 
+    return pods
 
-def upsert_pods(controller, url):
-    # turn RC url into pods one
-    url = url.replace(cache_key(controller['metadata']['name']), '')
-    url = url.replace('_replicationcontrollers_', '_pods')
-    # make sure url only has up to "_pods"
-    url = url[0:(url.find("_pods") + 5)]
+
+def upsert_pods(controller):
+    namespace = controller['metadata']['namespace']
 
     # pod is not part of the POST loop
-    data = controller['spec']['template'].copy()
-    data['metadata']['namespace'] = controller['metadata']['namespace']
+    data = copy.deepcopy(controller['spec']['template'])
+    data['metadata']['namespace'] = namespace
     data['metadata']['generateName'] = controller['metadata']['name'] + '-'
 
     # fetch a list of all the pods given the labels
     items = []
-    for item in filter_data({'labels': data['metadata']['labels']}, url):
+    for item in store.list('pods', namespace, data['metadata']['labels']):
         # skip pods being deleted
         if 'deletionTimestamp' in data['metadata']:
             continue
 
-        # Translate to a cache key since a full object gets passed
-        items.append(cache_key(url + '_' + item['metadata']['name']))
+        items.append(item['metadata']['name'])
 
     current = len(items)
     desired = controller['spec']['replicas']
@@ -268,42 +432,64 @@ def upsert_pods(controller, url):
 
     # If operation is scale down then pods needs to be removed
     if current > desired:
-        return delete_pods(items, current, desired)
+        return delete_pods(namespace, items, current, desired)
 
-    create_pods(url, data['metadata']['labels'], data, delta)
+    create_pods(namespace, data['metadata']['labels'], data, delta)
 
 
-def filter_data(filters, path):
-    data = []
-    for item in cache.get(path, []):
-        item = cache.get(item)
-        if not item:
-            # item is broken
-            continue
+def upsert_deployment(deployment):
+    """Roll out a Deployment in one go and report it as done"""
+    namespace = deployment['metadata']['namespace']
+    template = deployment['spec']['template']
 
-        # check if item has labels
-        if 'labels' not in item['metadata']:
+    # pods of an older template go away
+    old = []
+    for pod in store.list('pods', namespace, deployment['spec']['selector']['matchLabels']):
+        if (
+            pod['metadata']['labels'] == template['metadata']['labels'] or
+            'deletionTimestamp' in pod['metadata']
+        ):
             continue
 
-        # Do extra filtering based on labelSelector
-        add = True
-        for label, value in filters['labels'].items():
-            if (
-                label not in item['metadata']['labels'] or
-                item['metadata']['labels'][label] != value
-            ):
-                add = False
-                continue
+        old.append(pod['metadata']['name'])
+    delete_pods(namespace, old, len(old), 0)
+
+    # pods of the current template are handled like the ones of a RC
+    controller = {
+        'metadata': {'name': deployment['metadata']['name'], 'namespace': namespace},
+        'spec': {
+            'replicas': deployment['spec']['replicas'],
+            'template': template
+        }
+    }
+    upsert_pods(controller)
 
-        if add:
-            data.append(item)
+    replicas = deployment['spec']['replicas']
+    deployment['status'] = {
+        'observedGeneration': deployment['metadata']['generation'],
+        'replicas': replicas,
+        'updatedReplicas': replicas,
+        'availableReplicas': replicas
+    }
 
-    return data
 
+def remove(resource, namespace, name):
+    store.delete(resource, namespace, name)
+
+    # pods left behind by their RC or Deployment move on
+    if resource in ('replicationcontrollers', 'deployments'):
+        for pod in store.list('pods', namespace):
+            if pod['status'].get('phase') == 'Running':
+                store.schedule(store.transitions, clock.utcnow(), namespace, pod['metadata']['name'])  # noqa
+
+
+def fetch_single(request, context, resource, namespace, name, subresource):
+    # e.g. ?follow=true on logs
+    if subresource == 'log':
+        data = store.logs.get((namespace, name))
+    else:
+        data = store.get(resource, namespace, name)
 
-def fetch_single(request, context):
-    url = cache_key(request.url)
-    data = cache.get(url)
     if data is None:
         context.status_code = 404
         context.reason = 'Not Found'
@@ -312,159 +498,165 @@ def fetch_single(request, context):
     return data
 
 
-def fetch_all(request, context):
-    # Figure out if there are any labels to filter on
-    url = urlparse(request.url)
-    filters = prepare_query_filters(url.query)
-    cache_path = cache_key(request.path)
+def fetch_all(request, context, resource, namespace, query):
+    """List the matching objects, a page at a time when a limit is given"""
+    filters = prepare_query_filters(query)
+    with store.lock:
+        data = store.list(resource, namespace, filters['labels'], filters['fields'])
+        metadata = {'resourceVersion': str(store.version)}
 
-    data = filter_data(filters, cache_path)
-    return {'items': data}
+    limit = int(query.get('limit', [0])[0])
+    if limit:
+        start = int(query.get('continue', [0])[0])
+        if start + limit < len(data):
+            metadata['continue'] = str(start + limit)
+
+        data = data[start:start + limit]
+
+    return {'metadata': metadata, 'items': data}
 
 
 def prepare_query_filters(query):
     filters = {'labels': {}, 'fields': {}}
-    if query:
-        queries = parse_qs(query)
-        if 'labelSelector' in queries:
-            for items in queries['labelSelector']:
-                for item in items.split(','):
-                    key, value = item.split('=')
-                    filters['labels'][key] = value
-
-        if 'fieldSelector' in queries:
-            for items in queries['fieldSelector']:
-                for item in items.split(','):
-                    key, value = item.split('=')
-                    filters['fields'][key] = value
+    if 'labelSelector' in query:
+        for items in query['labelSelector']:
+            for item in items.split(','):
+                key, value = item.split('=')
+                filters['labels'][key] = value
+
+    if 'fieldSelector' in query:
+        for items in query['fieldSelector']:
+            for item in items.split(','):
+                key, value = item.split('=')
+                filters['fields'][key] = value
 
     return filters
 
 
-def get(request, context):
+def watch(request, context, resource, namespace, query):
+    """
+    Stream the watch events after the requested resourceVersion as JSON lines. When
+    nothing happened yet the watch stays open for a second and pods move along
+    """
+    filters = prepare_query_filters(query)
+    version = int(query.get('resourceVersion', [0])[0])
+    with store.lock:
+        cleanup_pods()
+        pod_state_transitions()
+        events = store.changes(resource, namespace, version, filters['labels'])
+
+    if events == []:
+        clock.sleep(1)
+        with store.lock:
+            cleanup_pods()
+            pod_state_transitions()
+            events = store.changes(resource, namespace, version, filters['labels'])
+
+    if events is None:
+        message = 'too old resource version: {} ({})'.format(version, store.compacted)
+        events = [{'type': 'ERROR', 'object': {'kind': 'Status', 'code': 410, 'message': message}}]  # noqa
+
+    return ''.join(json.dumps(event) + '\n' for event in events)
+
+
+def get(request, context, resource, namespace, name, subresource, query):
     """Process a GET request to the kubernetes API"""
     # Figure out if it is a GET operation for a single element or a list
-    url = urlparse(request.url)
-    if get_type(url.path) in resources:
-        return fetch_all(request, context)
+    if name is None:
+        return fetch_all(request, context, resource, namespace, query)
 
     # fetch singular item
-    return fetch_single(request, context)
+    return fetch_single(request, context, resource, namespace, name, subresource)
 
 
-def post(request, context):
+def post(request, context, resource, namespace):
     """Process a POST request to the kubernetes API"""
     data = request.json()
-    url = cache_key(request.url + '/' + data['metadata']['name'] + '/')
-    if cache.get(url) is not None:
+    if store.get(resource, namespace, data['metadata']['name']) is not None:
         context.status_code = 409
         context.reason = 'Conflict'
         return {}
 
-    resource_type = get_type(request.url)
-
     # fill in generic data
-    timestamp = str(datetime.utcnow().strftime(settings.DEIS_DATETIME_FORMAT))
+    timestamp = str(clock.utcnow().strftime(settings.DEIS_DATETIME_FORMAT))
     data['metadata']['creationTimestamp'] = timestamp
-    data['metadata']['resourceVersion'] = 1
 
     # don't bother adding it to those two resources since they live outside namespace
-    if resource_type not in ['nodes', 'namespaces']:
-        namespace = request.url.replace(settings.SCHEDULER_URL + '/api/v1/namespaces/',  '')
-        namespace = namespace.split('/')[0]
+    if resource not in ['nodes', 'namespaces']:
         data['metadata']['namespace'] = namespace
 
-    if resource_type == 'replicationcontrollers':
+    if resource == 'replicationcontrollers':
         data['status'] = {
             'observedGeneration': 1
         }
         data['metadata']['generation'] = 1
 
-        upsert_pods(data, url)
+        upsert_pods(data)
+
+    if resource == 'deployments':
+        data['metadata']['generation'] = 1
+        upsert_deployment(data)
 
     # deis run is the only thing that creates pods directly
-    if resource_type == 'pods':
-        create_pods(url, data['metadata']['labels'], data, 1)
+    if resource == 'pods':
+        data = create_pods(namespace, data['metadata']['labels'], data, 1)[0]
     else:
-        cache.set(url, data, None)
-
-        # Keep track of what resources are in a given resource
-        items = cache.get(resource_type, [])
-        if url not in items:
-            items.append(url)
-            cache.set(resource_type, items, None)
-
-        # Keep track of what resources exist under other resources (mostly namespace)
-        other = cache_key(request.url)
-        items = cache.get(other, [])
-        if url not in items:
-            items.append(url)
-            cache.set(other, items, None)
+        store.put(resource, namespace, data)
 
     context.status_code = 201
     context.reason = 'Created'
     return data
 
 
-def put(request, context):
+def put(request, context, resource, namespace, name):
     """Process a PUT request to the kubernetes API"""
-    url = cache_key(request.url)
-    data = cache.get(url)
-    if data is None:
+    if store.get(resource, namespace, name) is None:
         context.status_code = 404
         context.reason = 'Not Found'
         return {}
 
     data = request.json()
 
-    # type is the second last element
-    resource_type = get_type(request.url, -2)
-
-    if resource_type == 'replicationcontrollers':
-        data['metadata']['resourceVersion'] += 1
+    if resource == 'replicationcontrollers':
         data['metadata']['generation'] += 1
         data['status']['observedGeneration'] += 1
-        upsert_pods(data, url)
+        upsert_pods(data)
+
+    if resource == 'deployments':
+        data['metadata']['generation'] += 1
+        upsert_deployment(data)
 
     # Update the individual resource
-    cache.set(url, data, None)
+    store.put(resource, namespace, data)
 
     context.status_code = 200
     context.reason = 'OK'
 
-    return request.json()
+    return data
 
 
-def delete(request, context):
+def delete(request, context, resource, namespace, name, query):
     """Process a DELETE request to the kubernetes API"""
-    url = cache_key(request.url)
-    data = cache.get(url)
+    # Figure out if it is a DELETE operation for a single element or a list
+    if name is None:
+        return delete_all(request, context, resource, namespace, query)
+
+    data = store.get(resource, namespace, name)
     if data is None:
         context.status_code = 404
         context.reason = 'Not Found'
         return {}
 
-    resource_type = get_type(request.url, -2)
     # clean everything from a namespace
-    if resource_type == 'namespaces':
-        for resource in resources:
-            items = cache.get(resource, [])
-            for item in items:
-                if item.startswith(url):
-                    # remove individual item
-                    cache.delete(item)
-
-                    # remove from the resource collection
-                    if item in items:
-                        items.remove(item)
-                        cache.set(resource, items, None)
+    if resource == 'namespaces':
+        store.delete_namespace(name)
     # If a pod belongs to an RC and DELETE operation makes it fall below the
     # minimum replicas count then a new pod comes into service
-    elif resource_type == 'pods':
+    elif resource == 'pods':
         # pods have a graceful termination period, handle pods different
-        delete_pod(url, data, request)
+        delete_pod(namespace, name, data)
     else:
-        remove_cache_item(url, resource_type)
+        remove(resource, namespace, name)
 
     # k8s API uses 200 instead of 204
     context.status_code = 200
@@ -472,41 +664,50 @@ def delete(request, context):
     return {}
 
 
-def remove_cache_item(url, resource_type):
-    # remove data object from individual cache
-    cache.delete(url)
-
-    # remove from namespace specific scope
-    namespace, item = url.split('_{}_'.format(resource_type))
-    cache_url = '{}_{}'.format(namespace, resource_type)
-    items = cache.get(cache_url, [])
-    if url in items:
-        items.remove(url)
-
-    cache.set(cache_url, items, None)
-
-    # remove from the resource type global scope
-    items = cache.get(resource_type, [])
-    if url in items:
-        items.remove(url)
-        cache.set(resource_type, items, None)
+def delete_all(request, context, resource, namespace, query):
+    """Delete every item of a collection that matches the labelSelector"""
+    filters = prepare_query_filters(query)
+    data = store.list(resource, namespace, filters['labels'], filters['fields'])
+    for item in data:
+        name = item['metadata']['name']
+        if resource == 'pods':
+            # pods have a graceful termination period, nothing brings them back
+            if 'deletionTimestamp' not in item['metadata']:
+                add_cleanup_pod(namespace, name)
+        else:
+            remove(resource, namespace, name)
+
+    # k8s API returns the deleted items
+    context.status_code = 200
+    context.reason = 'OK'
+    return {'items': data}
 
 
 def mock(request, context):
-    # always cleanup pods
-    cleanup_pods()
-    # always transition pods
-    pod_state_transitions()
-
-    # What to do about context
-    if request.method == 'POST':
-        return post(request, context)
-    elif request.method == 'GET':
-        return get(request, context)
-    elif request.method == 'PUT':
-        return put(request, context)
-    elif request.method == 'DELETE':
-        return delete(request, context)
+    # requests_mock lowercases request.path and request.qs, names and labels keep their case
+    url = urlparse(request.url)
+    resource, namespace, name, subresource = parse(url.path)
+    query = parse_qs(url.query)
+
+    # watches wait for changes and must not hold up other requests meanwhile
+    if request.method == 'GET' and query.get('watch') == ['true']:
+        return watch(request, context, resource, namespace, query)
+
+    with store.lock:
+        # always cleanup pods
+        cleanup_pods()
+        # always transition pods
+        pod_state_transitions()
+
+        # What to do about context
+        if request.method == 'POST':
+            return post(request, context, resource, namespace)
+        elif request.method == 'GET':
+            return get(request, context, resource, namespace, name, subresource, query)
+        elif request.method == 'PUT':
+            return put(request, context, resource, namespace, name)
+        elif request.method == 'DELETE':
+            return delete(request, context, resource, namespace, name, query)
 
     # Log if any operation slips through that hasn't been accounted for
     logger.critical('COULD NOT FIND WHAT I AM')
@@ -520,16 +721,27 @@ class MockSchedulerClient(KubeHTTPClient):
         self.registry = settings.REGISTRY_URL
 
         adapter = requests_mock.Adapter()
-        self.session = requests.Session()
+        self.session = InstrumentedSession()
         self.session.mount(self.url, adapter)
 
         # Lets just listen to everything and sort it out ourselves
         adapter.register_uri(
             requests_mock.ANY, requests_mock.ANY,
-            json=mock
+            text=self._mock
         )
 
-        # Pre-seed data that is assumed to otherwise be there
+    def _mock(self, request, context):
+        # the client is shared by the whole process so start over after the cache was cleared
+        if cache.add('mock_seeded', True, None):
+            store.reset()
+            self._seed()
+
+        data = mock(request, context)
+        # pod logs and watch streams are plain text
+        return data if isinstance(data, str) else json.dumps(data)
+
+    def _seed(self):
+        """Pre-seed data that is assumed to otherwise be there"""
         try:
             self.get_namespace('deis')
         except KubeHTTPException:
@@ -626,9 +838,7 @@ class MockSchedulerClient(KubeHTTPClient):
                 }
             }
 
-            name = 'api_v1_nodes_172.17.8.100'
-            cache.set(name, data, None)
-            cache.set('api_v1_nodes', [name], None)
+            store.put('nodes', None, data)
         except Exception as e:
             logger.critical(e)
 
@@ -653,5 +863,10 @@ SchedulerClient = MockSchedulerClient
 # POST | GET                                /namespaces/{namespace}/pods  # noqa
 # PATCH (NI) | PUT (NI) | GET | DELETE      /namespaces/{namespace}/pods/{pod}  # noqa
 # GET                                       /namespaces/{namespace}/pods/{pod}/log  (needs to be special cased)  # noqa
+# POST | GET                                /namespaces/{namespace}/deployments  (extensions/v1beta1)  # noqa
+# PATCH (NI) | PUT      | GET | DELETE      /namespaces/{namespace}/deployments/{deployment}  # noqa
+#
+# collections can be listed a page at a time (limit, continue), watched (watch, resourceVersion)
+# and deleted by labelSelector
 
 # TODO transitions pod between the various states to emulate real life more
@@ -0,0 +1,152 @@
+"""
+Evaluation of what the status of a Pod says, done once per Pod and resourceVersion.
+
+Listing and polling look at the same Pods over and over, Kubernetes bumps the
+resourceVersion on every change so an evaluation can be reused until it does.
+"""
+from collections import defaultdict, OrderedDict
+from datetime import datetime
+import threading
+
+from django.conf import settings
+
+# evaluations kept around, enough to cover the Pods of a large cluster
+CACHE_SIZE = 10000
+
+
+def find_container(name, containers):
+    for container in containers:
+        if container['name'] == name:
+            return container
+
+    return None
+
+
+class PodStatus(object):
+    """
+    Compact record of a Pod status:
+
+    * phase: the Pod phase
+    * waiting: (reason, message) of the app container waiting to start, or None
+    * readiness: Running, Starting, Terminating or Unknown based on the readiness probe
+    * live: whether the Ready condition is not failing
+    * deletion: when the graceful termination ends, or None
+    """
+
+    __slots__ = ('phase', 'waiting', 'readiness', 'live', 'deletion')
+
+    def __init__(self, pod):
+        metadata = pod['metadata']
+        status = pod.get('status', {})
+        labels = metadata.get('labels', {})
+        # find the right container in case there are many on the pod
+        container = find_container(
+            '{}-{}'.format(labels.get('app'), labels.get('type')),
+            status.get('containerStatuses', [])
+        )
+
+        self.phase = status.get('phase', None)
+        self.waiting = None
+        if container is not None and 'waiting' in container['state']:
+            waiting = container['state']['waiting']
+            # message is not always available
+            self.waiting = (waiting['reason'], waiting.get('message', ''))
+
+        self.readiness = self._readiness(container, 'deletionTimestamp' in metadata)
+        # type = Ready is the only binary type right now
+        self.live = not any(
+            condition['type'] == 'Ready' and condition['status'] != 'True'
+            for condition in status.get('conditions', [])
+        )
+
+        self.deletion = None
+        if 'deletionTimestamp' in metadata:
+            self.deletion = datetime.strptime(
+                metadata['deletionTimestamp'],
+                settings.DEIS_DATETIME_FORMAT
+            )
+
+    @staticmethod
+    def _readiness(container, deleting):
+        if container is None:
+            # Seems like the most sensible default
+            return 'Unknown'
+
+        if not container['ready']:
+            if 'running' in container['state']:
+                return 'Starting'
+
+            if 'terminated' in container['state'] or deleting:
+                return 'Terminating'
+        else:
+            # See if k8s is in Terminating state
+            return 'Terminating' if deleting else 'Running'
+
+        # Seems like the most sensible default
+        return 'Unknown'
+
+
+class PodStatuses(object):
+    """Least recently used evaluations keyed by (uid, resourceVersion)"""
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, pod):
+        uid = pod['metadata'].get('uid', None)
+        version = pod['metadata'].get('resourceVersion', None)
+        if uid is None or version is None:
+            return PodStatus(pod)
+
+        key = (uid, str(version))
+        with self.lock:
+            status = self.items.get(key, None)
+            if status is not None:
+                self.items.move_to_end(key)
+                return status
+
+        status = PodStatus(pod)
+        with self.lock:
+            self.items[key] = status
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+        return status
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+statuses = PodStatuses()
+
+
+class PodEvents(object):
+    """
+    Events of the Pods in a Namespace, fetched with a single request the first time
+    any Pod needs them and indexed by involvedObject.uid. Meant to live for one
+    poll cycle so every Pod check in it shares the same request
+    """
+
+    def __init__(self, client, namespace):
+        self.client = client
+        self.namespace = namespace
+        self.index = None
+
+    def get(self, pod):
+        """Events of a Pod, oldest first"""
+        if self.index is None:
+            self.index = defaultdict(list)
+            response = self.client.get_namespace_events(
+                self.namespace, fields={'involvedObject.kind': 'Pod'}
+            )
+            events = response.json()['items']
+            # make sure that events are sorted
+            events.sort(key=lambda x: x['lastTimestamp'])
+            for event in events:
+                self.index[event['involvedObject'].get('uid')].append(event)
+
+        # a copy, callers pop the latest event off
+        return list(self.index.get(pod['metadata'].get('uid'), []))